@@ -0,0 +1,296 @@
+import json
+import numpy as np
+
+'''
+Nearest neighbor indexes of descriptors (e.g. invariant shape features) for
+retrieval over large catalogs, sharing a build / query / save / load interface:
+
+    exact   brute force search, blocked matrix multiplies
+    ivfpq   inverted file over a k-means coarse quantizer with product quantized
+            residuals (asymmetric distances), optional exact re-ranking
+
+    index = make_index('ivfpq', n_list=1024, n_subspace=16).build(feats)
+    dists, ids = index.query(queries, k=10)
+    index.save('catalog.npz')
+    index = load_index('catalog.npz')
+
+Distances are squared L2. Missing neighbors (an index of less than k
+descriptors) are returned with id -1 and an infinite distance.
+'''
+
+
+def squared_distances(x, y, y_sq=None):
+    '''
+    x: [n, d], y: [m, d] -> [n, m]
+    '''
+    if y_sq is None:
+        y_sq = (y**2).sum(1)
+    dist = (x**2).sum(1)[:, None] - 2 * x @ y.T + y_sq[None]
+    return np.maximum(dist, 0)
+
+
+def topk(dist, k):
+    '''
+    dist: [n, m] -> the k smallest per row [n, k] (ascending) and their column ids
+    '''
+    k = min(k, dist.shape[1])
+    if k < dist.shape[1]:
+        ids = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        ids = np.broadcast_to(np.arange(dist.shape[1]), dist.shape).copy()
+    part = np.take_along_axis(dist, ids, 1)
+    order = np.argsort(part, axis=1, kind='stable')
+    return np.take_along_axis(part, order, 1), np.take_along_axis(ids, order, 1)
+
+
+def kmeans(x, k, n_iter=20, seed=0, block_size=65536):
+    '''
+    Lloyd's k-means from k random samples, empty clusters reseeded at random samples
+    return: centroids [k, d]
+    '''
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].astype(np.float32)
+    for _ in range(n_iter):
+        assign = assign_nearest(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        sums = np.add.reduceat(x[order].astype(np.float64), starts, axis=0)
+        centroids[~empty] = (sums / counts[~empty, None]).astype(np.float32)
+        if empty.any():
+            centroids[empty] = x[rng.choice(x.shape[0], empty.sum(), replace=False)]
+    return centroids
+
+
+def assign_nearest(x, centroids, block_size=65536):
+    c_sq = (centroids**2).sum(1)
+    return np.concatenate([squared_distances(x[i:i + block_size], centroids, c_sq).argmin(1)
+                           for i in range(0, x.shape[0], block_size)])
+
+
+class DescriptorIndex():
+    '''
+    interface of the indexes: build(feats) -> self, query(queries, k) -> (dists, ids),
+    save(path) and load_index(path)
+    '''
+    name = None
+
+    def build(self, feats):
+        raise NotImplementedError('Not implemented')
+
+    def query(self, queries, k=1):
+        raise NotImplementedError('Not implemented')
+
+    def config(self):
+        return {}
+
+    def state(self):
+        return {}
+
+    def set_state(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def save(self, path):
+        np.savez(path, config=json.dumps({'type': self.name, **self.config()}), **self.state())
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+
+class ExactIndex(DescriptorIndex):
+    name = 'exact'
+
+    def __init__(self, block_size=4096):
+        self.block_size = block_size
+
+    def config(self):
+        return {'block_size': self.block_size}
+
+    def state(self):
+        return {'feats': self.feats, 'ids': self.ids}
+
+    def build(self, feats, ids=None):
+        self.feats = np.ascontiguousarray(feats, dtype=np.float32)
+        self.ids = np.arange(feats.shape[0]) if ids is None else np.asarray(ids)
+        return self
+
+    def query(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32)
+        f_sq = (self.feats**2).sum(1)
+        # k columns, padded with -1 / inf past the size of the index
+        dists = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        ids = np.full((queries.shape[0], k), -1, dtype=self.ids.dtype)
+        for i in range(0, queries.shape[0], self.block_size):
+            d, idx = topk(squared_distances(queries[i:i + self.block_size], self.feats, f_sq), k)
+            dists[i:i + d.shape[0], :d.shape[1]] = d
+            ids[i:i + d.shape[0], :d.shape[1]] = self.ids[idx]
+        return dists, ids
+
+
+class IVFPQIndex(DescriptorIndex):
+    '''
+    n_list: coarse k-means cells, n_probe of them searched per query
+    n_subspace: product quantizer sub-vectors (the descriptors are zero padded to
+                a multiple), each coded on n_bits (<= 8, one byte per sub-vector)
+    rerank: candidates re-ranked with the exact distances (0 to disable, needs keep_feats)
+    n_train: samples the quantizers are trained on, at most 64 per centroid
+    '''
+    name = 'ivfpq'
+
+    def __init__(self, n_list=256, n_subspace=8, n_bits=8, n_probe=8, rerank=0, keep_feats=False,
+                 n_train=100000, n_iter=10, seed=0):
+        assert n_bits <= 8
+        if rerank > 0 and not keep_feats:
+            raise ValueError('Re-ranking needs the descriptors, set keep_feats')
+        self.n_list = n_list
+        self.n_subspace = n_subspace
+        self.n_bits = n_bits
+        self.n_probe = n_probe
+        self.rerank = rerank
+        self.keep_feats = keep_feats
+        self.n_train = n_train
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def config(self):
+        return {'n_list': self.n_list, 'n_subspace': self.n_subspace, 'n_bits': self.n_bits,
+                'n_probe': self.n_probe, 'rerank': self.rerank, 'keep_feats': self.keep_feats,
+                'n_train': self.n_train, 'n_iter': self.n_iter, 'seed': self.seed}
+
+    def state(self):
+        state = {'centroids': self.centroids, 'codebooks': self.codebooks, 'codes': self.codes,
+                 'ids': self.ids, 'offsets': self.offsets}
+        if self.keep_feats:
+            state['feats'] = self.feats
+        return state
+
+    def _pad(self, x):
+        d_pad = -(-x.shape[1] // self.n_subspace) * self.n_subspace
+        if d_pad == x.shape[1]:
+            return x
+        return np.concatenate([x, np.zeros((x.shape[0], d_pad - x.shape[1]), dtype=x.dtype)], 1)
+
+    def build(self, feats, ids=None):
+        feats = np.ascontiguousarray(feats, dtype=np.float32)
+        n = feats.shape[0]
+        ids = np.arange(n) if ids is None else np.asarray(ids)
+        rng = np.random.RandomState(self.seed)
+        n_list = min(self.n_list, n)
+        ksub = min(2**self.n_bits, n)
+        train = feats[rng.choice(n, min(n, self.n_train, 64 * max(n_list, ksub)), replace=False)]
+
+        # coarse quantizer
+        self.centroids = kmeans(train[:64 * n_list], n_list, self.n_iter, self.seed)
+        # product quantizer of the residuals
+        train = train[:64 * ksub]
+        residuals = self._pad(train - self.centroids[assign_nearest(train, self.centroids)])
+        dsub = residuals.shape[1] // self.n_subspace
+        self.codebooks = np.stack([kmeans(np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub]), ksub,
+                                          self.n_iter, self.seed + j)
+                                   for j in range(self.n_subspace)])
+
+        # inverted lists, stored contiguously by cell
+        assign = assign_nearest(feats, self.centroids)
+        order = np.argsort(assign, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_list))])
+        self.ids = ids[order]
+        self.codes = self._encode(feats[order] - self.centroids[assign[order]])
+        if self.keep_feats:
+            self.feats = feats[order]
+        return self
+
+    def _encode(self, residuals, block_size=65536):
+        residuals = self._pad(residuals)
+        m, _, dsub = self.codebooks.shape
+        codes = np.empty((residuals.shape[0], m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = assign_nearest(np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub]),
+                                         self.codebooks[j], block_size)
+        return codes
+
+    def _decode(self, codes):
+        '''
+        codes: [n, m] -> reconstructed (padded) residuals [n, m * dsub]
+        '''
+        m = self.codebooks.shape[0]
+        return self.codebooks[np.arange(m), codes].reshape(codes.shape[0], -1)
+
+    def query(self, queries, k=1, n_probe=None, rerank=None, block_size=4096):
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(self.n_probe if n_probe is None else n_probe, self.centroids.shape[0])
+        rerank = self.rerank if rerank is None else rerank
+        n_list = self.centroids.shape[0]
+        dists, ids = [], []
+        for i in range(0, queries.shape[0], block_size):
+            block = queries[i:i + block_size]
+            d, idx = self._query_block(block, k, n_probe, rerank)
+            # queries whose probed cells hold less than k descriptors (id -1): probe more cells
+            probe = n_probe
+            short = (idx < 0).any(1)
+            while short.any() and probe < n_list:
+                probe = min(2 * probe, n_list)
+                d[short], idx[short] = self._query_block(block[short], k, probe, rerank)
+                short = (idx < 0).any(1)
+            dists.append(d)
+            ids.append(idx)
+        return np.concatenate(dists), np.concatenate(ids)
+
+    def _query_block(self, queries, k, n_probe, rerank):
+        nq = queries.shape[0]
+        n_cand = max(rerank, k) if rerank > 0 else k
+        _, probes = topk(squared_distances(queries, self.centroids), n_probe)
+
+        # candidates of every (query, probed cell): the asymmetric distances of the
+        # queries probing a cell are one matrix product between their residuals to
+        # the cell centroid and the decoded codes of the cell
+        cand_dists = np.full((nq, n_probe, n_cand), np.inf, dtype=np.float32)
+        cand_rows = np.full((nq, n_probe, n_cand), -1, dtype=np.int64)
+        flat = probes.reshape(-1)
+        order = np.argsort(flat, kind='stable')
+        cells, starts, counts = np.unique(flat[order], return_index=True, return_counts=True)
+        for cell, start, count in zip(cells, starts, counts):
+            lo, hi = self.offsets[cell], self.offsets[cell + 1]
+            if hi == lo:
+                continue
+            pairs = order[start:start + count]
+            qi, slot = pairs // n_probe, pairs % n_probe
+            residuals = self._pad(queries[qi] - self.centroids[cell])
+            d, top = topk(squared_distances(residuals, self._decode(self.codes[lo:hi])), n_cand)
+            cand_dists[qi, slot, :top.shape[1]] = d
+            cand_rows[qi, slot, :top.shape[1]] = top + lo
+
+        d, top = topk(cand_dists.reshape(nq, -1), n_cand)
+        rows = np.take_along_axis(cand_rows.reshape(nq, -1), top, 1)
+        if rerank > 0:
+            # exact distances of the candidates
+            found = rows >= 0
+            d = np.where(found, ((self.feats[np.maximum(rows, 0)] - queries[:, None])**2).sum(-1), np.inf)
+            d, top = topk(d, k)
+            rows = np.take_along_axis(rows, top, 1)
+        dists = np.full((nq, k), np.inf, dtype=np.float32)
+        ids = np.full((nq, k), -1, dtype=self.ids.dtype)
+        dists[:, :d.shape[1]] = d[:, :k]
+        ids[:, :rows.shape[1]] = np.where(rows >= 0, self.ids[np.maximum(rows, 0)], -1)[:, :k]
+        return dists, ids
+
+
+INDEXES = {
+    'exact': ExactIndex,
+    'ivfpq': IVFPQIndex,
+}
+
+
+def make_index(name, **kwargs):
+    if name not in INDEXES:
+        raise ValueError(f'Unknown descriptor index {name}, available: {list(INDEXES)}')
+    return INDEXES[name](**kwargs)
+
+
+def load_index(path):
+    data = np.load(path)
+    config = json.loads(str(data['config']))
+    index = make_index(config.pop('type'), **config)
+    index.set_state({key: data[key] for key in data.files if key != 'config'})
+    return index
@@ -1,14 +1,89 @@
+import time
 import numpy as np
 from sklearn.neighbors import KDTree
 
 # calculate mean average precision for modelnet retrieval given a set of features and labels
-def modelnet_retrieval_mAP(feats, labels, n=1):
-	db = KDTree(feats)
-	_, ids = db.query(feats, k=(n+1))
-	query_ids = ids[:,1:]
+# index: optional descriptor index (see descriptor_index) built over feats, e.g. approximate for large catalogs
+def modelnet_retrieval_mAP(feats, labels, n=1, index=None):
+	if index is None:
+		db = KDTree(feats)
+		_, ids = db.query(feats, k=(n+1))
+		query_ids = ids[:,1:]
+	else:
+		_, ids = index.query(feats, k=(n+1))
+		query_ids = drop_self(ids, n)
 
+	return 100 * precision_at(query_ids, labels, n).mean()
+
+# per query fraction of the n first neighbors of the same label, missing neighbors (id -1) counting as misses
+def precision_at(query_ids, labels, n):
 	# Nxn 
+	query_ids = query_ids[:,:n]
 	match_labels = labels[:,None].repeat(n,axis=1)
-	query_labels = labels[query_ids]
-	precision = np.sum(match_labels == query_labels,axis=1).astype(float) / n
-	return 100 * precision.mean()
\ No newline at end of file
+	query_labels = labels[np.maximum(query_ids, 0)]
+	return np.sum((match_labels == query_labels) & (query_ids >= 0),axis=1).astype(float) / n
+
+# N x (n+1) neighbors of the database items themselves -> N x n neighbors without the query item
+# (an approximate search may not return the query first, or at all; missing neighbors (id -1) are kept)
+def drop_self(ids, n):
+	is_self = ids == np.arange(ids.shape[0])[:,None]
+	# the last neighbor is dropped when the query item is not among them
+	is_self[~is_self.any(1), -1] = True
+	is_self &= np.cumsum(is_self, axis=1) == 1
+	return ids[~is_self].reshape(ids.shape[0], n)
+
+# recall vs speed of descriptor indexes against the exact search, on the retrieval of the database items
+# indexes: {name: unbuilt index}, e.g. {'ivfpq': make_index('ivfpq', n_list=1024)}
+# return: per index {'build_s', 'query_s', 'recall@k', 'mAP'}, exact search included as 'exact'
+def retrieval_report(feats, labels, indexes, n=1, k=10):
+	from SPConvNets.datasets.evaluation.descriptor_index import make_index
+
+	report = {}
+	exact_ids = None
+	for name, index in [('exact', make_index('exact'))] + list(indexes.items()):
+		start = time.time()
+		index.build(feats)
+		build_time = time.time() - start
+		start = time.time()
+		_, ids = index.query(feats, k=(max(n, k)+1))
+		query_time = time.time() - start
+		ids = drop_self(ids, max(n, k))
+		if exact_ids is None:
+			exact_ids = ids
+		hits = [len(np.intersect1d(a[:k][a[:k] >= 0], b[:k])) for a, b in zip(ids, exact_ids)]
+		# out of the exact neighbors (less than k in an index of less than k+1 items)
+		n_true = max(int((exact_ids[:,:k] >= 0).sum()), 1)
+		report[name] = {'build_s': build_time, 'query_s': query_time,
+						'recall@%d'%k: float(np.sum(hits)) / n_true, 'mAP': 100 * precision_at(ids, labels, n).mean()}
+	return report
+
+def format_report(report):
+	lines = ['%-12s %10s %10s %10s %8s' % ('index', 'build(s)', 'query(s)', 'recall', 'mAP')]
+	for name, r in report.items():
+		recall = [v for key, v in r.items() if key.startswith('recall')][0]
+		lines.append('%-12s %10.2f %10.2f %10.3f %8.2f' % (name, r['build_s'], r['query_s'], recall, r['mAP']))
+	return '\n'.join(lines)
+
+# python -m SPConvNets.datasets.evaluation.retrieval FEATS.npy LABELS.npy --n-list 1024 --n-probe 16
+if __name__ == '__main__':
+	import argparse
+	from SPConvNets.datasets.evaluation.descriptor_index import make_index
+
+	parser = argparse.ArgumentParser(description='retrieval mAP and recall vs speed of the descriptor indexes')
+	parser.add_argument('feats', type=str, help='[N, d] descriptors (.npy)')
+	parser.add_argument('labels', type=str, help='[N] labels (.npy)')
+	parser.add_argument('-n', type=int, default=1, help='neighbors of the mAP')
+	parser.add_argument('-k', type=int, default=10, help='neighbors of the recall against exact search')
+	parser.add_argument('--n-list', type=int, default=1024)
+	parser.add_argument('--n-subspace', type=int, default=16)
+	parser.add_argument('--n-probe', type=int, default=16)
+	parser.add_argument('--rerank', type=int, default=100)
+	opt = parser.parse_args()
+
+	feats = np.load(opt.feats).astype(np.float32)
+	labels = np.load(opt.labels).reshape(-1)
+	indexes = {'ivfpq': make_index('ivfpq', n_list=opt.n_list, n_subspace=opt.n_subspace, n_probe=opt.n_probe)}
+	if opt.rerank > 0:
+		indexes['ivfpq_rerank'] = make_index('ivfpq', n_list=opt.n_list, n_subspace=opt.n_subspace,
+											 n_probe=opt.n_probe, rerank=opt.rerank, keep_feats=True)
+	print(format_report(retrieval_report(feats, labels, indexes, opt.n, opt.k)))
@@ -2,9 +2,12 @@ import os
 import glob
 from os.path import join
 import numpy as np
+import torch
 from sklearn.neighbors import KDTree
-from multiprocessing import Pool
+from multiprocessing import Pool, resource_tracker
 import vgtk.pc as pctk
+from vgtk.functional import mutual_nearest_neighbor
+from vgtk.utils import pack_shared, attach_shared
 
 def read_key_point(path):
     with open(path, 'r') as fin:
@@ -18,7 +21,7 @@ def read_feature(path, descriptor_name='ours'):
     def read_np(path):
         return np.load(path)
 
-    if descriptor_name == 'ours' or 'lmvd':
+    if descriptor_name in ['ours', 'lmvd']:
         return read_np(path)
     elif descriptor_name == '3DSmooth':
         return read_npz(path)
@@ -53,54 +56,50 @@ def hom_transform(points, T, translation=True):
     return points
 
 
-def evaluate_fragment_pair(src_frag_id, tgt_frag_id,
-                           src_pc_path, tgt_pc_path, 
-                           src_kp_path, tgt_kp_path,
-                           src_feat_path, tgt_feat_path, 
-                           gt_transform, tau1=0.1, descriptor='ours'):
-    print("Evaluating frag %d and frag %d"%(src_frag_id, tgt_frag_id))
-        
-    src_point_cloud = pctk.load_ply(src_pc_path)
-    tgt_point_cloud = pctk.load_ply(tgt_pc_path)
-    src_key_point_ids = read_key_point(src_kp_path)
-    tgt_key_point_ids = read_key_point(tgt_kp_path)
-
-    src_feats = read_feature(src_feat_path, descriptor_name=descriptor)
-    tgt_feats = read_feature(tgt_feat_path, descriptor_name=descriptor)
-    assert src_feats.ndim == 2
-
-    result_log = [src_frag_id, tgt_frag_id]
-
-    src_key_point_locs = src_point_cloud[src_key_point_ids]
-    tgt_key_point_locs = tgt_point_cloud[tgt_key_point_ids]
-
-    src_KDT = KDTree(src_feats)
-    tgt_KDT = KDTree(tgt_feats)
-
+def load_fragment(pc_path, kp_path, feat_path, descriptor='ours'):
+    '''
+    return: keypoint ids [n], keypoint locations [n, 3], keypoint features [n, d]
+    '''
+    point_cloud = pctk.load_ply(pc_path)
+    key_point_ids = read_key_point(kp_path)
+    feats = read_feature(feat_path, descriptor_name=descriptor)
+    assert feats.ndim == 2
+    return key_point_ids, np.asarray(point_cloud[key_point_ids], dtype=np.float64), feats
+
+
+def match_fragment_pair(src_key_point_ids, src_key_point_locs, src_feats, src_KDT,
+                        tgt_key_point_ids, tgt_key_point_locs, tgt_feats, tgt_KDT,
+                        gt_transform, tau1=0.1):
+    '''
+    mutual nearest neighbor matching of the keypoint features of two fragments,
+    src_KDT / tgt_KDT being KDTrees of their features
+    return: see inlier_matches
+    '''
     _, src_tgt_nn_ids = tgt_KDT.query(src_feats, k=1)
     _, tgt_src_nn_ids = src_KDT.query(tgt_feats, k=1)
     # only care the closest one
-    src_tgt_nn_ids = src_tgt_nn_ids.squeeze()
-    tgt_src_nn_ids = tgt_src_nn_ids.squeeze()
-
+    src_tgt_nn_ids = src_tgt_nn_ids.reshape(-1)
+    tgt_src_nn_ids = tgt_src_nn_ids.reshape(-1)
+    return inlier_matches(src_key_point_ids, src_key_point_locs, tgt_key_point_ids, tgt_key_point_locs,
+                          src_tgt_nn_ids, tgt_src_nn_ids, gt_transform, tau1)
+
+
+def inlier_matches(src_key_point_ids, src_key_point_locs, tgt_key_point_ids, tgt_key_point_locs,
+                   src_tgt_nn_ids, tgt_src_nn_ids, gt_transform, tau1=0.1):
+    '''
+    src_tgt_nn_ids / tgt_src_nn_ids: nearest neighbor in feature space of each src / tgt keypoint
+    return: n_inlier, inlier_ratio, inlier keypoint id pairs [n_inlier, 2], number of mutual matches
+    '''
     # currently use tgt->src->tgt
-    mutual_closest_ids = (np.arange(src_tgt_nn_ids.shape[0]) == src_tgt_nn_ids[tgt_src_nn_ids])
+    mutual_closest_ids = (np.arange(tgt_src_nn_ids.shape[0]) == src_tgt_nn_ids[tgt_src_nn_ids])
     src_match_point_locs = src_key_point_locs[tgt_src_nn_ids[mutual_closest_ids]]
     tgt_match_point_locs = tgt_key_point_locs[mutual_closest_ids]
-    # n_matching = tgt_match_point_locs.shape[0]
-
-    # tgt_match_point_locs = np.hstack([tgt_match_point_locs, np.ones([n_matching, 1])])
-    # tgt_match_point_locs = tgt_match_point_locs @ gt_transform.T
-    # tgt_match_point_locs = tgt_match_point_locs[:, :3]
-
-    # src_match_point_locs = hom_transform(src_match_point_locs, gt_transform)
     tgt_match_point_locs = hom_transform(tgt_match_point_locs, gt_transform)
 
     distances = np.sqrt(np.sum((src_match_point_locs - tgt_match_point_locs)**2, 1))
     n_inlier = (distances < tau1).sum()
-    inlier_ratio = float(n_inlier) / distances.shape[0]
+    inlier_ratio = float(n_inlier) / max(distances.shape[0], 1)
 
-    ################################
     mid_tgt = np.argwhere(mutual_closest_ids)
     mid_src = tgt_src_nn_ids[mutual_closest_ids][:,None]
     select = distances < tau1
@@ -109,31 +108,77 @@ def evaluate_fragment_pair(src_frag_id, tgt_frag_id,
     kpt_mid_tgt = tgt_key_point_ids[mid_tgt[select]]
 
     kpts = np.concatenate((kpt_mid_src, kpt_mid_tgt), 1)
-    ##############################################
+    return n_inlier, inlier_ratio, kpts, distances.shape[0]
+
 
-    result_log.append(n_inlier)
-    result_log.append(inlier_ratio)
+def evaluate_fragment_pair(src_frag_id, tgt_frag_id,
+                           src_pc_path, tgt_pc_path, 
+                           src_kp_path, tgt_kp_path,
+                           src_feat_path, tgt_feat_path, 
+                           gt_transform, tau1=0.1, descriptor='ours'):
+    '''
+    single pair evaluation from the files (see SceneEvaluator to evaluate a whole scene)
+    '''
+    print("Evaluating frag %d and frag %d"%(src_frag_id, tgt_frag_id))
 
-    # print(" inlier distance min and mean: %f, %f" % (distances.min(), distances.mean()))
+    src_ids, src_locs, src_feats = load_fragment(src_pc_path, src_kp_path, src_feat_path, descriptor)
+    tgt_ids, tgt_locs, tgt_feats = load_fragment(tgt_pc_path, tgt_kp_path, tgt_feat_path, descriptor)
+    n_inlier, inlier_ratio, kpts, n_match = match_fragment_pair(src_ids, src_locs, src_feats, KDTree(src_feats),
+                                                                tgt_ids, tgt_locs, tgt_feats, KDTree(tgt_feats),
+                                                                gt_transform, tau1)
+    result_log = [src_frag_id, tgt_frag_id, n_inlier, inlier_ratio]
 
-    print(" Frag %d, %d: Found %d, N_inlier is %d, Inlier_ratio is %f" % (src_frag_id, tgt_frag_id, distances.shape[0], 
+    print(" Frag %d, %d: Found %d, N_inlier is %d, Inlier_ratio is %f" % (src_frag_id, tgt_frag_id, n_match,
                                                               n_inlier, inlier_ratio))
+    return n_inlier, inlier_ratio, result_log, kpts
 
 
-    return n_inlier, inlier_ratio, result_log, kpts
+# per worker process: the shared arrays of the current scene and the feature
+# KDTrees built so far, one per fragment
+_worker_scene = {}
+
+def _worker_fragment(layout, frag_id):
+    if _worker_scene.get('name') != layout['name']:
+        if 'shm' in _worker_scene:
+            _worker_scene['arrays'] = None
+            _worker_scene['shm'].close()
+        shm, arrays = attach_shared(layout)
+        _worker_scene.clear()
+        _worker_scene.update({'name': layout['name'], 'shm': shm, 'arrays': arrays, 'trees': {}})
+    arrays = _worker_scene['arrays']
+    ids, locs, feats = arrays['ids_%d'%frag_id], arrays['locs_%d'%frag_id], arrays['feats_%d'%frag_id]
+    trees = _worker_scene['trees']
+    if frag_id not in trees:
+        trees[frag_id] = KDTree(feats)
+    return ids, locs, feats, trees[frag_id]
+
+
+def _evaluate_pair_shared(args):
+    layout, src_frag_id, tgt_frag_id, gt_transform, tau1 = args
+    src = _worker_fragment(layout, src_frag_id)
+    tgt = _worker_fragment(layout, tgt_frag_id)
+    return match_fragment_pair(*src, *tgt, gt_transform, tau1)
+
+
+def _load_fragment_star(args):
+    return load_fragment(*args)
 
 
 TAU_RANGE = [0.05, 0.1, 0.2]
-    
-def evaluate_scene(scene_dir, feature_dir, scene_name, suffix=None, num_thread=8, tau2=0.05):
-    scene_dir = join(scene_dir, scene_name)
 
+
+def scene_paths(scene_dir, feature_dir, suffix=None):
+    '''
+    return: gt log path, point cloud / keypoint / feature path of a fragment id, descriptor name
+    '''
     if 'seq-01' in os.listdir(scene_dir):
         get_pc_path = lambda x: join(scene_dir, 'seq-01','cloud_bin_%d.ply'%x)
         get_kp_path = lambda x: join(scene_dir, 'seq-01','cloud_bin_%d.keypts.txt'%x)
+        gt_log_path = join(scene_dir, 'seq-01','gt.log')
     else:
         get_pc_path = lambda x: join(scene_dir, 'cloud_bin_%d.ply'%x)
         get_kp_path = lambda x: join(scene_dir, '01_Keypoints', 'cloud_bin_%dKeypoints.txt'%x)
+        gt_log_path = join(scene_dir, 'gt.log')
 
     if suffix is None:
         descriptor = 'ours'
@@ -145,63 +190,139 @@ def evaluate_scene(scene_dir, feature_dir, scene_name, suffix=None, num_thread=8
         # used for 3DMatch eval e.g. _cloud_bin_59.ply_0.150000_16_1.750000_3DSmoothNet.npz
         descriptor = '3DSmooth'
         get_feat_path = lambda x: join(feature_dir, '_cloud_bin_%d.ply_%s.npz'%(x,suffix))
-
-    if 'seq-01' in os.listdir(scene_dir):
-        fragment_pairs, gt_transforms = read_gt_log(join(scene_dir, 'seq-01','gt.log'))
-    else:
-        fragment_pairs, gt_transforms = read_gt_log(join(scene_dir, 'gt.log'))
-    n_inliers = []
-    inlier_ratios = []
-
-    mp_args = []
-    for fragment_pair, gt_transform in zip(fragment_pairs, gt_transforms):
-        src_frag_id, tgt_frag_id = fragment_pair[:2]
-        ##### hack
-        #if src_frag_id > 14 or tgt_frag_id > 14:
-        #    continue
-        ##### hack end
-
-        srcp = get_feat_path(src_frag_id)
-        tgtp = get_feat_path(tgt_frag_id)
-
-        if not os.path.exists(srcp) or not os.path.exists(tgtp):
-            print(f'Path at {srcp} does not exist!!')
-            continue
-        
-        mp_args.append([src_frag_id, tgt_frag_id,
-                        get_pc_path(src_frag_id),
-                        get_pc_path(tgt_frag_id),
-                        get_kp_path(src_frag_id),
-                        get_kp_path(tgt_frag_id),
-                        get_feat_path(src_frag_id),
-                        get_feat_path(tgt_frag_id),
-                        gt_transform, 0.1, descriptor])
-    
-        # evaluate_fragment_pair(*mp_args[-1])
-    
-    # import ipdb; ipdb.set_trace()
-    pool = Pool(num_thread)
-    rst = pool.starmap(evaluate_fragment_pair, mp_args)
-    n_inliers, inlier_ratios, result_log, kpts = zip(*rst)
-
-    #############################
-    if suffix == 'lmvd':
-        output_folder = join(scene_dir, "lmvd_test_kpts")
-        os.makedirs(output_folder, exist_ok=True)
-        for i, fp in enumerate(fragment_pairs):
-            src_frag_id, tgt_frag_id = fp[:2]
-            np.save(join(output_folder, f"cloud_bin_{src_frag_id}-cloud_bin_{tgt_frag_id}.keypts.npy"), kpts[i])
-
-    ############################
-
-    n_inliers = np.array(n_inliers)
-    inlier_ratios = np.array(inlier_ratios)
-    total_recall = np.mean(inlier_ratios > tau2)
-    results = np.array(result_log)
-
-    print("Total recall is %0.2f" % (total_recall * 100))
-    np.savetxt(join(feature_dir, 'recall.txt'), results, fmt='%.2f', delimiter=',')
-
-    return [(tau, 100 * np.mean(inlier_ratios > tau)) for tau in TAU_RANGE]
-
-
+    return gt_log_path, get_pc_path, get_kp_path, get_feat_path, descriptor
+
+
+class SceneEvaluator():
+    '''
+    3DMatch scene evaluation over a persistent worker pool, reusable across scenes:
+    the keypoints and features of every fragment of a scene are loaded once (in
+    parallel), then the pairs are matched
+
+    - matcher 'kdtree': in the workers, from shared memory, each worker building
+      the feature KDTree of a fragment at most once for all the pairs it evaluates
+    - matcher 'torch': in this process on device, batch_pairs pairs at a time with
+      the blocked mutual nearest neighbor search of vgtk.functional (same matches)
+
+        with SceneEvaluator(num_thread=8) as evaluator:
+            for scene in scenes:
+                recalls = evaluator.evaluate(dataset_path, feature_dir, scene)
+    '''
+    def __init__(self, num_thread=8, matcher='kdtree', device='cpu', batch_pairs=16):
+        if matcher not in ['kdtree', 'torch']:
+            raise ValueError(f'Unknown matcher {matcher}')
+        self.num_thread = num_thread
+        self.matcher = matcher
+        self.device = device
+        self.batch_pairs = batch_pairs
+        # workers share the resource tracker of this process, which then sees the
+        # shared memory attached in the workers released by the unlink here
+        resource_tracker.ensure_running()
+        self.pool = Pool(num_thread)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def evaluate(self, scene_dir, feature_dir, scene_name, suffix=None, tau1=0.1, tau2=0.05):
+        scene_dir = join(scene_dir, scene_name)
+        gt_log_path, get_pc_path, get_kp_path, get_feat_path, descriptor = scene_paths(scene_dir, feature_dir, suffix)
+        fragment_pairs, gt_transforms = read_gt_log(gt_log_path)
+
+        pairs = []
+        for fragment_pair, gt_transform in zip(fragment_pairs, gt_transforms):
+            src_frag_id, tgt_frag_id = fragment_pair[:2]
+            srcp = get_feat_path(src_frag_id)
+            tgtp = get_feat_path(tgt_frag_id)
+            if not os.path.exists(srcp) or not os.path.exists(tgtp):
+                print(f'Path at {srcp} does not exist!!')
+                continue
+            pairs.append((int(src_frag_id), int(tgt_frag_id), gt_transform))
+
+        # every fragment read once
+        frag_ids = sorted(set(i for src, tgt, _ in pairs for i in (src, tgt)))
+        fragments = self.pool.map(_load_fragment_star, [(get_pc_path(i), get_kp_path(i), get_feat_path(i), descriptor)
+                                                         for i in frag_ids])
+        fragments = dict(zip(frag_ids, fragments))
+        if self.matcher == 'torch':
+            rst = self._match_torch(fragments, pairs, tau1)
+        else:
+            rst = self._match_kdtree(fragments, pairs, tau1)
+
+        result_log = []
+        for (src_frag_id, tgt_frag_id, _), (n_inlier, inlier_ratio, kpts, n_match) in zip(pairs, rst):
+            print(" Frag %d, %d: Found %d, N_inlier is %d, Inlier_ratio is %f" % (src_frag_id, tgt_frag_id, n_match,
+                                                                      n_inlier, inlier_ratio))
+            result_log.append([src_frag_id, tgt_frag_id, n_inlier, inlier_ratio])
+
+        if suffix == 'lmvd':
+            output_folder = join(scene_dir, "lmvd_test_kpts")
+            os.makedirs(output_folder, exist_ok=True)
+            for (src_frag_id, tgt_frag_id, _), (_, _, kpts, _) in zip(pairs, rst):
+                np.save(join(output_folder, f"cloud_bin_{src_frag_id}-cloud_bin_{tgt_frag_id}.keypts.npy"), kpts)
+
+        inlier_ratios = np.array([r[1] for r in rst])
+        total_recall = np.mean(inlier_ratios > tau2)
+        results = np.array(result_log)
+
+        print("Total recall is %0.2f" % (total_recall * 100))
+        np.savetxt(join(feature_dir, 'recall.txt'), results, fmt='%.2f', delimiter=',')
+
+        return [(tau, 100 * np.mean(inlier_ratios > tau)) for tau in TAU_RANGE]
+
+    def _match_kdtree(self, fragments, pairs, tau1):
+        arrays = {}
+        for frag_id, (ids, locs, feats) in fragments.items():
+            arrays['ids_%d'%frag_id], arrays['locs_%d'%frag_id], arrays['feats_%d'%frag_id] = ids, locs, feats
+        shm, layout = pack_shared(arrays)
+        del arrays
+
+        try:
+            # pairs of the same source fragment in the same chunks, for the KDTree reuse
+            order = sorted(range(len(pairs)), key=lambda i: pairs[i][:2])
+            chunksize = max(1, len(pairs) // (4 * self.num_thread))
+            rst = [None] * len(pairs)
+            tasks = [(layout, pairs[i][0], pairs[i][1], pairs[i][2], tau1) for i in order]
+            for i, r in zip(order, self.pool.imap(_evaluate_pair_shared, tasks, chunksize)):
+                rst[i] = r
+        finally:
+            shm.close()
+            shm.unlink()
+        return rst
+
+    def _match_torch(self, fragments, pairs, tau1):
+        # pairs of the same keypoint counts are stacked into batches
+        groups = {}
+        for i, (src, tgt, _) in enumerate(pairs):
+            groups.setdefault((fragments[src][2].shape, fragments[tgt][2].shape), []).append(i)
+        rst = [None] * len(pairs)
+        for group in groups.values():
+            for start in range(0, len(group), self.batch_pairs):
+                batch = group[start:start + self.batch_pairs]
+                src_feats = torch.from_numpy(np.stack([fragments[pairs[i][0]][2] for i in batch])).to(self.device)
+                tgt_feats = torch.from_numpy(np.stack([fragments[pairs[i][1]][2] for i in batch])).to(self.device)
+                src_tgt_nn_ids, tgt_src_nn_ids, _ = mutual_nearest_neighbor(src_feats, tgt_feats)
+                src_tgt_nn_ids, tgt_src_nn_ids = src_tgt_nn_ids.cpu().numpy(), tgt_src_nn_ids.cpu().numpy()
+                for b, i in enumerate(batch):
+                    src_ids, src_locs, _ = fragments[pairs[i][0]]
+                    tgt_ids, tgt_locs, _ = fragments[pairs[i][1]]
+                    rst[i] = inlier_matches(src_ids, src_locs, tgt_ids, tgt_locs, src_tgt_nn_ids[b],
+                                            tgt_src_nn_ids[b], pairs[i][2], tau1)
+        return rst
+
+
+def evaluate_scene(scene_dir, feature_dir, scene_name, suffix=None, num_thread=8, tau2=0.05, evaluator=None):
+    '''
+    evaluator: SceneEvaluator to reuse (its worker pool) across scenes, a temporary one is used if None
+    '''
+    if evaluator is not None:
+        return evaluator.evaluate(scene_dir, feature_dir, scene_name, suffix, tau2=tau2)
+    with SceneEvaluator(num_thread) as evaluator:
+        return evaluator.evaluate(scene_dir, feature_dir, scene_name, suffix, tau2=tau2)
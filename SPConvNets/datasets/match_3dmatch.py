@@ -8,10 +8,12 @@ import scipy.io as sio
 from parse import parse
 import glob
 from sklearn.neighbors import NearestNeighbors as nnbrs
-from multiprocessing import Pool
+from multiprocessing import Pool, resource_tracker
 import vgtk.so3conv.functional as L
 import vgtk.pc as pctk
 from vgtk.functional import RigidMatrix
+from vgtk.utils import pack_shared, attach_shared
+from SPConvNets.datasets.patch_store import PatchStore, PatchWriter, write_block, save_patches, DEFAULT_DTYPE
 
 # ------------------------ utilities for 3DMatch Data ---------------------------
 
@@ -206,6 +208,63 @@ def radius_ball_search_o3d_radii(pc, kpt_indices, radii, search_radius, input_nu
             all_pc.append(subsampled)
     return all_pc
 
+def resample_patches(pc, neighbors, input_num, rng=np.random):
+    '''
+    vectorized pctk.uniform_resample_np of a block of neighborhoods:
+    a random subset without replacement of a neighborhood of at least input_num
+    points, else all its points plus random repeats (in random order)
+    neighbors: list of index lists into pc (e.g. from KDTree.query_ball_point)
+    return: [len(neighbors), input_num, 3], zero patches for neighborhoods of at most one point
+    '''
+    counts = np.array([len(indices) for indices in neighbors], dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros((len(neighbors), input_num, 3), dtype=pc.dtype)
+    flat = np.concatenate([np.asarray(indices, dtype=np.int64) for indices in neighbors])
+    starts = np.cumsum(counts) - counts
+    # random order within each neighborhood: sort on (neighborhood, random key)
+    segments = np.repeat(np.arange(len(neighbors)), counts)
+    flat = flat[np.lexsort((rng.random_sample(flat.shape[0]), segments))]
+    # patch point j: the j-th point of the shuffled neighborhood, or a random one past its size
+    j = np.arange(input_num)[None]
+    repeats = (rng.random_sample((len(neighbors), input_num)) * counts[:, None]).astype(np.int64)
+    pick = np.where(j < counts[:, None], j, repeats)
+    patches = pc[flat[np.minimum(starts[:, None] + pick, flat.shape[0] - 1)]]
+    patches[counts <= 1] = 0
+    return patches
+
+def _downsample_fragment(args):
+    pc_path, kpts_path, voxel_size = args
+    pc = pctk.load_ply(pc_path).astype(np.float64)
+    kpts = np.loadtxt(kpts_path, dtype=np.int32)
+    pc_down = np.asarray(to_o3d(pc).voxel_down_sample(voxel_size=voxel_size).points)
+    return pc[kpts], pc_down
+
+# per worker process: the downsampled fragments of the current scene (shared
+# memory) and the KDTrees built on them
+_patch_worker = {}
+
+def _patch_block(args):
+    layout, sid, start, end, spec, search_radius, input_num, scale, seed = args
+    if _patch_worker.get('name') != layout['name']:
+        if 'shm' in _patch_worker:
+            _patch_worker['arrays'] = None
+            _patch_worker['shm'].close()
+        shm, arrays = attach_shared(layout)
+        _patch_worker.clear()
+        _patch_worker.update({'name': layout['name'], 'shm': shm, 'arrays': arrays, 'trees': {}})
+    arrays, trees = _patch_worker['arrays'], _patch_worker['trees']
+    pc = arrays['pc_%d'%sid]
+    if sid not in trees:
+        # the blocks of a fragment come in order, older trees are not needed anymore
+        if len(trees) >= 2:
+            trees.pop(next(iter(trees)))
+        trees[sid] = KDTree(pc)
+    keypoints = arrays['kpts_%d'%sid][start:end]
+    neighbors = trees[sid].query_ball_point(keypoints, search_radius)
+    patches = resample_patches(pc, neighbors, input_num, np.random.RandomState(seed))
+    write_block(spec, start, patches * scale, keypoints * scale)
+    return sid, end - start
+
 import random
 class PointCloudPairSampler(data.Sampler):
 
@@ -457,44 +516,16 @@ class SceneEvalLoader(data.Dataset):
         self.grouped_path = lambda idx: \
                         os.path.join(self.data_path, 'grouped_data_r%.2f'%self.search_radius,\
                         f'grouped_cloud_bin_{idx}.npz')
-        self.readgdata = lambda idx: \
-                        np.load(self.grouped_path(idx))['arr_0']
+        self.readgdata = lambda idx: PatchStore(self.grouped_path(idx))
 
     def __len__(self):
         return len(self.kptsfiles)
 
     def __getitem__(self, index):
         frag = self.readfrag(index)
-        if os.path.exists(self.grouped_path(index)):
-            raw_clouds = self.readgdata(index).astype(np.float32)
-            if self.use_normals:      
-                kpts = self.readkptf(index)      
-                if len(frag.normals) != len(frag.points):
-                    raise RuntimeError('[!] The point cloud needs normals.')
-                normals_at_kpt = np.asarray(frag.normals)[kpts]
-                raw_clouds = np.array(transform_with_normals(raw_clouds, normals_at_kpt))
-            
-            if raw_clouds.shape[1] != self.input_num:
-                # print(f'Founde grouped pc with {raw_clouds.shape[1]} points. Downsampling them to {self.input_num}...')
-                clouds = list()
-                for pc in raw_clouds:
-                    clouds.append(self._process(pc))
-                clouds = np.array(clouds).astype(np.float32)
-            else:
-                clouds = raw_clouds
-        else:
-            kpts = self.readkptf(index)
-            outpath = self.grouped_path(index)
-            print(f"Saving precompted patches to {outpath}...")
-            clouds = list()
-            raw_clouds, _, _ = radius_ball_search_o3d(frag, kpts, self.search_radius, self.voxel_size, self.use_normals)
-            for pc in raw_clouds:
-                pc = self._process(pc)
-                # idx, pc = pctk.uniform_resample_np(pc, self.input_num)
-                clouds.append(pc)
-            clouds = np.array(clouds).astype(np.float32)
-            np.savez(outpath, clouds)
-
+        store = self.patches(index, frag)
+        normals_at_kpt = self._normals_at_kpt(index, frag)
+        clouds = self._postprocess(store[:], normals_at_kpt)
         frag = np.asarray(frag.points)
 
         data = {'clouds': torch.from_numpy(clouds).float(),\
@@ -504,6 +535,48 @@ class SceneEvalLoader(data.Dataset):
 
         return data
 
+    def patches(self, index, frag=None):
+        '''
+        the PatchStore of the keypoint patches of a fragment, computed and saved on first use
+        '''
+        if not os.path.exists(self.grouped_path(index)):
+            frag = self.readfrag(index) if frag is None else frag
+            kpts = self.readkptf(index)
+            outpath = self.grouped_path(index)
+            print(f"Saving precompted patches to {outpath}...")
+            raw_clouds, _, _ = radius_ball_search_o3d(frag, kpts, self.search_radius, self.voxel_size)
+            clouds = np.array([self._process(pc) for pc in raw_clouds]).astype(np.float32)
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            save_patches(outpath, clouds, np.asarray(frag.points)[kpts], radius=self.search_radius)
+        return self.readgdata(index)
+
+    def iter_batches(self, index, batch_size):
+        '''
+        yield the patches of a fragment batch_size keypoints at a time [b, input_num, 3],
+        read from the memory-mapped store while the previous batch is processed
+        '''
+        frag = self.readfrag(index) if self.use_normals else None
+        store = self.patches(index, frag)
+        normals_at_kpt = self._normals_at_kpt(index, frag)
+        for start, end, raw_clouds in store.iter_chunks(batch_size):
+            normals = None if normals_at_kpt is None else normals_at_kpt[start:end]
+            yield torch.from_numpy(self._postprocess(raw_clouds, normals)).float()
+
+    def _normals_at_kpt(self, index, frag):
+        if not self.use_normals:
+            return None
+        if len(frag.normals) != len(frag.points):
+            raise RuntimeError('[!] The point cloud needs normals.')
+        return np.asarray(frag.normals)[self.readkptf(index)]
+
+    def _postprocess(self, raw_clouds, normals_at_kpt=None):
+        if normals_at_kpt is not None:
+            raw_clouds = np.array(transform_with_normals(raw_clouds, normals_at_kpt))
+        if raw_clouds.shape[1] != self.input_num:
+            # print(f'Founde grouped pc with {raw_clouds.shape[1]} points. Downsampling them to {self.input_num}...')
+            raw_clouds = np.array([self._process(pc) for pc in raw_clouds])
+        return raw_clouds.astype(np.float32)
+
     def _process(self, pc):
         if pc.shape[0] != self.input_num:
             _, pc = pctk.uniform_resample_np(pc, self.input_num)
@@ -559,45 +632,73 @@ class SceneTestLoader():
 
         if self.grouped:
             if self.scene_pt < len(self.datafiles):
-                self.current_grouped_points = np.load(self.datafiles[self.scene_pt])['arr_0']
+                # memory mapped, read batch by batch
+                self.current_grouped_points = PatchStore(self.datafiles[self.scene_pt])
                 self.current_sid = parse_scene_id(self.datafiles[self.scene_pt])
         else:
             if self.scene_pt < len(self.kptsfiles):
                 self.current_kpts = np.loadtxt(self.kptsfiles[self.scene_pt], dtype=np.int32)
                 self.current_sid = parse_scene_id(self.kptsfiles[self.scene_pt])
 
-    def precompute_patches(self, scale=1.0, input_num=1024, num_worker=8):
-        # output: # fragments x 5000 x nn x 3 npy files
+    def precompute_patches(self, scale=1.0, input_num=1024, num_worker=8, voxel_size=0.015, block_size=500,
+                           dtype=DEFAULT_DTYPE):
+        '''
+        writes the # keypoints x input_num x 3 patches of every fragment to
+        grouped_data_r<radius>/grouped_cloud_bin_<id>.npz, stored in dtype (see patch_store)
+
+        the fragments are downsampled in parallel and placed once in shared memory;
+        the workers then take blocks of block_size keypoints (in fragment order, a
+        KDTree being built once per fragment and worker), resample them vectorized
+        and write them into memory-mapped .npy files per fragment, packed into the .npz
+        as soon as all its blocks are done
+        '''
         save_dir = os.path.join(self.data_path, 'grouped_data_r%.2f'%self.search_radius)
         os.makedirs(save_dir, exist_ok=True)
-        mp_args = []
-        sid_list = []
-        for kid, kptf in enumerate(self.kptsfiles):
-            kpts = np.loadtxt(kptf, dtype=np.int32)
-            sid = parse_scene_id(kptf)
-            assert str(sid) in self.pcfiles[sid]
-            # scene_pcd = pctk.load_ply(self.pcfiles[sid])
-            # mp_args.append([scene_pcd,kpts,self.search_radius, input_num, 'cloud_bin_%d'%sid])
-            scene_pcd = o3d.io.read_point_cloud(self.pcfiles[sid])
-            mp_args.append([scene_pcd, kpts, self.search_radius, 0.015, False, input_num])
-            sid_list.append(sid)
+        sid_list = [parse_scene_id(kptf) for kptf in self.kptsfiles]
+        pc_paths = {parse_scene_id(pcf): pcf for pcf in self.pcfiles}
+        assert all(sid in pc_paths for sid in sid_list)
 
+        pool = None
+        imap = lambda fn, args: map(fn, args)
         if num_worker > 1:
+            # workers share the resource tracker of this process (see SceneEvaluator)
+            resource_tracker.ensure_running()
             pool = Pool(num_worker)
-            rsts = pool.starmap(self.ball_search, mp_args)
-            for rst,sid,arg in zip(rsts,sid_list,mp_args):
-                # n_keypoints x knn x3
-                grouped_points = np.array(rst[0]) * scale
-                save_path = os.path.join(save_dir, 'grouped_cloud_bin_%d.npz'%sid)
-                np.savez(save_path, grouped_points)
-        else:
-            # non parallel method
-            for sid,arg in zip(sid_list,mp_args):
-                print("Working on cloud bin #%d"%sid)
-                rst = self.ball_search(*arg)
-                grouped_points = np.array(rst[0]) * scale
-                save_path = os.path.join(save_dir, 'grouped_cloud_bin_%d.npz'%sid)
-                np.savez(save_path, grouped_points)
+            imap = lambda fn, args: pool.imap(fn, args)
+
+        try:
+            arrays = {}
+            fragments = imap(_downsample_fragment, [(pc_paths[sid], kptf, voxel_size)
+                                                    for sid, kptf in zip(sid_list, self.kptsfiles)])
+            for sid, (keypoints, pc_down) in zip(sid_list, fragments):
+                arrays['kpts_%d'%sid], arrays['pc_%d'%sid] = keypoints, pc_down
+            shm, layout = pack_shared(arrays)
+            n_kpts = {sid: arrays['kpts_%d'%sid].shape[0] for sid in sid_list}
+            del arrays, fragments
+
+            try:
+                tasks, writers = [], {}
+                for sid in sid_list:
+                    writers[sid] = PatchWriter(os.path.join(save_dir, 'grouped_cloud_bin_%d.npz'%sid),
+                                               n_kpts[sid], input_num, dtype, self.search_radius * scale)
+                    for start in range(0, n_kpts[sid], block_size):
+                        end = min(start + block_size, n_kpts[sid])
+                        tasks.append((layout, sid, start, end, writers[sid].spec, self.search_radius, input_num,
+                                      scale, sid * 1000003 + start))
+
+                done = {sid: 0 for sid in sid_list}
+                for sid, n in imap(_patch_block, tasks):
+                    done[sid] += n
+                    if done[sid] == n_kpts[sid]:
+                        writers[sid].close()
+                        print("Saved patches of cloud bin #%d"%sid)
+            finally:
+                shm.close()
+                shm.unlink()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     def next_batch(self):
         buf = self.current_grouped_points if self.grouped else self.current_kpts
@@ -630,7 +731,7 @@ class SceneTestLoader():
     def get_patches(self, sid, idx, normalize=False):
         if self.grouped:
             assert str(sid) in self.datafilter[sid]
-            grouped_points = np.load(self.datafiles[sid], dtype=np.float32)['arr_0'][idx]
+            grouped_points = PatchStore(self.datafiles[sid])[idx]
         else:
             assert str(sid) in self.kptsfiles[sid]
             assert str(sid) in self.pcfiles[sid]
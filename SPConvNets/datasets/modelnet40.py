@@ -5,14 +5,16 @@ import glob
 import scipy.io as sio
 import torch
 import torch.utils.data as data
+import torch.utils.data.dataloader as data_utils
 import vgtk.pc as pctk
 import vgtk.point3d as p3dtk
 import vgtk.so3conv.functional as L
-from vgtk.functional import rotation_distance_np, label_relative_rotation_np
+from vgtk.functional import rotation_distance_np, label_relative_rotation_np, random_rotation_matrix, \
+                            rotation_distance
 from scipy.spatial.transform import Rotation as sciR
 
 class Dataloader_ModelNet40(data.Dataset):
-    def __init__(self, opt, mode=None):
+    def __init__(self, opt, mode=None, geometry=None):
         super(Dataloader_ModelNet40, self).__init__()
         self.opt = opt
 
@@ -35,21 +37,42 @@ class Dataloader_ModelNet40(data.Dataset):
             cats = [self.opt.cat]
             print(f"[Dataloader]: USING ONLY THE {cats[0]} CATEGORY!!")
         else:
-            cats = os.listdir(opt.dataset_path)
+            cats = list_categories(opt.dataset_path)
         print(cats)
         self.dataset_path = opt.dataset_path
         print(opt.dataset_path)
         self.all_data = []
-        
-        for cat in cats:
-            print(os.path.join(opt.dataset_path, cat, self.mode, "*.mat"))
-            for fn in glob.glob(os.path.join(opt.dataset_path, cat, self.mode, "*.mat")):
-                
-                self.all_data.append(fn)
+
+        # eval splits can be read from precomputed geometry sidecars (see write_geometry_sidecars)
+        if geometry is None:
+            geometry = self.mode != 'train' and opt.geometry_sidecars
+        self.geometry = geometry
+        if self.geometry:
+            print("[Dataloader]: USING PRECOMPUTED GEOMETRY SIDECARS!")
+        data_dir, pattern = (self.mode + GEOMETRY_SUFFIX, "*.npz") if self.geometry else (self.mode, "*.mat")
+
+        # single memory-mapped file per split (see pack_modelnet40)
+        self.packed = None
+        if not self.geometry and opt.packed_dataset:
+            self.packed = PackedModelNet40(opt.dataset_path, self.mode)
+            print("[Dataloader]: USING PACKED DATASET", self.packed.points_path)
+            cats = cats if self.opt.cat else sorted(set(self.packed.cats))
+            self.all_data = [i for i in range(len(self.packed)) if self.packed.cats[i] in cats]
+        else:
+            for cat in cats:
+                print(os.path.join(opt.dataset_path, cat, data_dir, pattern))
+                for fn in sorted(glob.glob(os.path.join(opt.dataset_path, cat, data_dir, pattern))):
+
+                    self.all_data.append(fn)
 
         print("[Dataloader] : Training dataset size:", len(self.all_data))
 
-        if self.opt.no_augmentation:
+        # raw clouds only: resampling, normalization and rotation are done batched
+        # on device by augment_batch (the batches need collate_raw)
+        self.raw = self.mode == 'train' and opt.device_augmentation
+        if self.raw:
+            print("[Dataloader]: AUGMENTING ON DEVICE!")
+        elif self.opt.no_augmentation:
             print("[Dataloader]: USING ALIGNED MODELNET LOADER!")
         else:
             print("[Dataloader]: USING ROTATED MODELNET LOADER!")
@@ -59,7 +82,19 @@ class Dataloader_ModelNet40(data.Dataset):
         return len(self.all_data)
 
     def __getitem__(self, index):
-        data = sio.loadmat(self.all_data[index])
+        if self.geometry:
+            return self._load_geometry(index)
+
+        if self.packed is not None:
+            data = self.packed[self.all_data[index]]
+        else:
+            data = sio.loadmat(self.all_data[index])
+
+        if self.raw:
+            return {'pc': torch.from_numpy(np.array(data['pc'], dtype=np.float32)),
+                    'label': torch.from_numpy(data['label'].flatten()).long(),
+                    'fn': data['name'][0],
+                   }
     
         if self.mode == 'train':
             _, pc = pctk.uniform_resample_np(data['pc'], self.opt.model.input_num)
@@ -92,6 +127,206 @@ class Dataloader_ModelNet40(data.Dataset):
                 'R_label': torch.Tensor([R_label]).long(),
                }
 
+    def _load_geometry(self, index):
+        data = np.load(self.all_data[index])
+        geometry = {k: torch.from_numpy(data[k].astype(np.int32)) for k in data.files
+                    if k.startswith('inter_idx_') or k.startswith('sample_idx_')}
+        return {'pc': torch.from_numpy(data['pc']),
+                'label': torch.from_numpy(data['label']).long(),
+                'fn': str(data['name']),
+                'R': data['R'],
+                'R_label': torch.from_numpy(data['R_label']).long(),
+                'geometry': geometry,
+                'signature': str(data['signature']),
+               }
+
+
+def collate_raw(batch):
+    '''
+    collate the raw samples of Dataloader_ModelNet40 (device augmentation):
+    clouds are zero padded to the largest one, with their sizes in 'n_points'
+    '''
+    n_points = torch.tensor([sample['pc'].shape[0] for sample in batch], dtype=torch.long)
+    pc = torch.zeros(len(batch), int(n_points.max()), 3)
+    for bi, sample in enumerate(batch):
+        pc[bi, :n_points[bi]] = sample['pc']
+    data = data_utils.default_collate([{k: v for k, v in sample.items() if k != 'pc'} for sample in batch])
+    data['pc'] = pc
+    data['n_points'] = n_points
+    return data
+
+def augment_batch(data, opt, anchors):
+    '''
+    batched counterpart of the train-mode Dataloader_ModelNet40.__getitem__, on the device
+    of the anchors: uniform resampling, normalization, random SO(3) rotation and
+    anchor label assignment for the whole batch
+    data: collate_raw batch
+    anchors: [na, 3, 3] tensor
+    '''
+    device = anchors.device
+    pc = data['pc'].to(device)
+    nb = pc.shape[0]
+
+    idx = pctk.batch_uniform_resample_index(data['n_points'].to(device), opt.model.input_num)
+    pc = pc.gather(1, idx[..., None].expand(-1, -1, 3))
+    pc = p3dtk.normalize(pc.transpose(1, 2)).transpose(1, 2)
+
+    if opt.no_augmentation:
+        R = torch.eye(3, device=device)[None].expand(nb, -1, -1)
+        R_label = torch.full((nb, 1), 29, dtype=torch.long, device=device)
+    else:
+        R = random_rotation_matrix(nb, device)
+        pc = torch.matmul(pc, R.transpose(1, 2))
+
+        _, R_label, R0 = rotation_distance(R, anchors)
+        R_label = R_label[:, None]
+        if opt.model.flag == 'rotation':
+            R = R0
+
+    data = dict(data)
+    data.update({'pc': pc.contiguous(), 'R': R, 'R_label': R_label})
+    return data
+
+
+PACKED_DIR = 'packed'
+PACKED_PREFIX = 'packed_'
+
+def list_categories(dataset_path):
+    '''
+    category folders of a dataset directory (not its files nor the packed splits)
+    '''
+    return [c for c in os.listdir(dataset_path)
+            if c != PACKED_DIR and os.path.isdir(os.path.join(dataset_path, c))]
+
+def pack_modelnet40(dataset_path, mode, cats=None):
+    '''
+    Pack the per-sample .mat files of a split ({cat}/{mode}/*.mat) into
+        packed_{mode}.bin: all points, contiguous float32 [sum(n_i), 3]
+        packed_{mode}.npz: offsets [n+1], label [n], name [n], cat [n], R [n, 3, 3], has_R [n]
+    under {dataset_path}/packed/. Points are streamed to disk, so the split never
+    needs to fit in memory.
+    '''
+    if cats is None:
+        cats = sorted(list_categories(dataset_path))
+    os.makedirs(os.path.join(dataset_path, PACKED_DIR), exist_ok=True)
+    points_path = os.path.join(dataset_path, PACKED_DIR, PACKED_PREFIX + mode + '.bin')
+    meta_path = os.path.join(dataset_path, PACKED_DIR, PACKED_PREFIX + mode + '.npz')
+
+    offsets = [0]
+    labels, names, sample_cats, Rs, has_R = [], [], [], [], []
+    with open(points_path + '.tmp', 'wb') as f:
+        for cat in cats:
+            for fn in sorted(glob.glob(os.path.join(dataset_path, cat, mode, "*.mat"))):
+                data = sio.loadmat(fn)
+                pc = np.ascontiguousarray(data['pc'], dtype=np.float32)
+                f.write(pc.tobytes())
+                offsets.append(offsets[-1] + pc.shape[0])
+                labels.append(int(data['label'].flatten()[0]))
+                names.append(data['name'][0])
+                sample_cats.append(cat)
+                has_R.append('R' in data.keys())
+                Rs.append(data['R'] if has_R[-1] else np.eye(3))
+
+    with open(meta_path + '.tmp', 'wb') as f:
+        np.savez(f, offsets=np.array(offsets, dtype=np.int64),
+                 label=np.array(labels, dtype=np.int64),
+                 name=np.array(names), cat=np.array(sample_cats),
+                 R=np.array(Rs, dtype=np.float64).reshape(-1, 3, 3),
+                 has_R=np.array(has_R, dtype=bool))
+    os.replace(points_path + '.tmp', points_path)
+    os.replace(meta_path + '.tmp', meta_path)
+    return len(labels)
+
+class PackedModelNet40():
+    '''
+    read side of pack_modelnet40: samples are zero-copy slices of the memory-mapped
+    point file, returned as the dict scipy.io.loadmat would give for the .mat
+    '''
+    def __init__(self, dataset_path, mode):
+        self.points_path = os.path.join(dataset_path, PACKED_DIR, PACKED_PREFIX + mode + '.bin')
+        meta = np.load(os.path.join(dataset_path, PACKED_DIR, PACKED_PREFIX + mode + '.npz'))
+        self.offsets = meta['offsets']
+        self.labels = meta['label']
+        self.names = meta['name']
+        self.cats = meta['cat']
+        self.R = meta['R']
+        self.has_R = meta['has_R']
+        # opened lazily, so that every loader worker maps the file itself
+        self.points = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if self.points is None:
+            self.points = np.memmap(self.points_path, dtype=np.float32, mode='r').reshape(-1, 3)
+        data = {'pc': self.points[self.offsets[index]:self.offsets[index+1]],
+                'label': self.labels[index:index+1],
+                'name': self.names[index:index+1],
+               }
+        if self.has_R[index]:
+            data['R'] = self.R[index]
+        return data
+
+GEOMETRY_SUFFIX = '_geometry'
+
+def write_geometry_sidecars(opt, model, mode='testR', batch_size=None):
+    '''
+    Offline pass over an eval split: store, per sample, the rotated and normalized
+    cloud, its labels and the neighborhoods of every inter layer of the model
+    (model.compute_neighbors) under {cat}/{mode}_geometry/{name}.npz. Index
+    arrays are kept as uint16 when the cloud is small enough.
+    '''
+    dataset = Dataloader_ModelNet40(opt, mode, geometry=False)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size or opt.batch_size,
+                                         shuffle=False, num_workers=opt.num_thread)
+    n_written = 0
+    with torch.no_grad():
+        for it, data in enumerate(loader):
+            pc = data['pc'].to(opt.device)
+            neighbors = model.compute_neighbors(pc)
+            for bi in range(pc.shape[0]):
+                fn = dataset.all_data[n_written]
+                output_path = os.path.join(os.path.dirname(os.path.dirname(fn)), mode + GEOMETRY_SUFFIX)
+                os.makedirs(output_path, exist_ok=True)
+                idx_dtype = np.uint16 if pc.shape[1] < 2**16 else np.int32
+                sidecar = {'pc': data['pc'][bi].numpy(),
+                           'label': data['label'][bi].numpy(),
+                           'name': data['fn'][bi],
+                           'R': np.asarray(data['R'][bi]),
+                           'R_label': data['R_label'][bi].numpy(),
+                           'signature': model.geometry_signature,
+                          }
+                for block_i, block_neighbors in enumerate(neighbors):
+                    for layer_i, layer_neighbors in enumerate(block_neighbors):
+                        if layer_neighbors is None or 'sample_idx' not in layer_neighbors:
+                            continue
+                        for key in ['inter_idx', 'sample_idx']:
+                            sidecar[f'{key}_{block_i}_{layer_i}'] = \
+                                layer_neighbors[key][bi].cpu().numpy().astype(idx_dtype)
+                name = os.path.splitext(os.path.basename(fn))[0]
+                np.savez(os.path.join(output_path, name + '.npz'), **sidecar)
+                n_written += 1
+    return n_written
+
+def unpack_geometry(geometry, device):
+    '''
+    batched sidecar geometry {inter_idx_b_l, sample_idx_b_l} -> the nested
+    per block / per layer neighbors accepted by ClsSO3ConvModel.forward
+    '''
+    neighbors = []
+    for key, value in geometry.items():
+        name, block_i, layer_i = key.rsplit('_', 2)
+        block_i, layer_i = int(block_i), int(layer_i)
+        while len(neighbors) <= block_i:
+            neighbors.append([])
+        while len(neighbors[block_i]) <= layer_i:
+            neighbors[block_i].append(None)
+        if neighbors[block_i][layer_i] is None:
+            neighbors[block_i][layer_i] = {}
+        neighbors[block_i][layer_i][name] = value.to(device).contiguous()
+    return neighbors
+
 # for relative rotation alignment
 class Dataloader_ModelNet40Alignment(data.Dataset):
     def __init__(self, opt, mode=None, cat=[]):
@@ -109,7 +344,7 @@ class Dataloader_ModelNet40Alignment(data.Dataset):
             cats = [cat]
             print(f"[Dataloader]: USING ONLY THE {cats[0]} CATEGORY!!")
         else:
-            cats = os.listdir(opt.dataset_path)
+            cats = list_categories(opt.dataset_path)
 
         self.dataset_path = opt.dataset_path
         self.all_data = []
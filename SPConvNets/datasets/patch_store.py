@@ -0,0 +1,183 @@
+import os
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+'''
+Storage of the grouped keypoint patches of a 3DMatch fragment
+(grouped_data_r<radius>/grouped_cloud_bin_<id>.npz), read through memory maps
+so that a range of keypoints is loaded without reading the whole file:
+
+    float32   arr_0 [n, np, 3] world coordinates (np.savez, the original format)
+    float16   patches [n, np, 3] offsets to the keypoint, centers [n, 3]
+    int16     patches [n, np, 3] offsets to the keypoint quantized on the patch
+              radius (step = radius / 32767), centers [n, 3]
+
+The half precision formats take half the space of float32. Their empty patches
+(no neighborhood) are stored with a zero center and decode to zeros, as before.
+
+    store = PatchStore('grouped_cloud_bin_0.npz')
+    for start, end, patches in store.iter_chunks(256):
+        ...
+'''
+
+PATCH_DTYPES = ['float32', 'float16', 'int16']
+DEFAULT_DTYPE = 'int16'
+_INT16_MAX = 32767
+
+
+def _member_memmap(path, name):
+    '''
+    memory map of the .npy member name of an uncompressed .npz, None if it is compressed
+    '''
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        # local file header: the data follows the name and the extra field
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ValueError(f'Invalid zip member {name} in {path}')
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+
+class PatchStore():
+    '''
+    read only view of the patches of a fragment in any of the PATCH_DTYPES,
+    indexed by keypoint (int, slice or index array) -> float32 patches
+    '''
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+        self.quantized = 'patches.npy' in names
+        key = 'patches' if self.quantized else 'arr_0'
+        self.codes = _member_memmap(path, key + '.npy')
+        if self.codes is None:
+            # compressed archive: loaded in memory
+            self.codes = np.load(path)[key]
+        if self.quantized:
+            with np.load(path) as data:
+                self.centers = data['centers']
+                self.step = float(data['step'])
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.codes.dtype.name
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx):
+        patches = np.asarray(self.codes[idx], dtype=np.float32)
+        if self.quantized:
+            if self.step != 1.0:
+                patches *= self.step
+            patches += self.centers[idx][..., None, :]
+        return patches
+
+    def iter_chunks(self, chunk_size):
+        '''
+        yield (start, end, patches) of chunk_size keypoints, the next chunk being
+        read on a thread while the current one is used
+        '''
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            pending = reader.submit(self.__getitem__, slice(0, chunk_size))
+            for start in range(0, len(self), chunk_size):
+                patches = pending.result()
+                end = start + patches.shape[0]
+                if end < len(self):
+                    pending = reader.submit(self.__getitem__, slice(end, end + chunk_size))
+                yield start, end, patches
+
+
+def encode_patches(patches, centers, dtype, step):
+    '''
+    patches: [b, np, 3] world coordinates, centers: [b, 3] their keypoints
+    return: the codes of the patches in dtype and the stored centers (zero for the empty patches)
+    '''
+    patches = np.asarray(patches, dtype=np.float32)
+    centers = np.array(centers, dtype=np.float32)
+    centers[~patches.reshape(patches.shape[0], -1).any(1)] = 0
+    offsets = patches - centers[:, None]
+    if dtype == 'int16':
+        codes = np.clip(np.rint(offsets / step), -_INT16_MAX, _INT16_MAX).astype(np.int16)
+    else:
+        codes = offsets.astype(dtype)
+    return codes, centers
+
+
+def write_block(spec, start, patches, centers=None):
+    '''
+    write the patches of keypoints start:start+len(patches) of a PatchWriter from
+    its spec (e.g. in a worker process)
+    '''
+    if spec['dtype'] == 'float32':
+        out = np.load(spec['patches'], mmap_mode='r+')
+        out[start:start + patches.shape[0]] = patches
+        out.flush()
+        return
+    codes, centers = encode_patches(patches, centers, spec['dtype'], spec['step'])
+    for key, value in [('patches', codes), ('centers', centers)]:
+        out = np.load(spec[key], mmap_mode='r+')
+        out[start:start + value.shape[0]] = value
+        out.flush()
+
+
+class PatchWriter():
+    '''
+    writes the [n, input_num, 3] patches of a fragment block by block (see
+    write_block) into .npy files next to path, packed into the .npz by close()
+    radius: patch radius, bounds the int16 offsets
+    '''
+    def __init__(self, path, n, input_num, dtype=DEFAULT_DTYPE, radius=1.0):
+        if dtype not in PATCH_DTYPES:
+            raise ValueError(f'Unknown patch dtype {dtype}, available: {PATCH_DTYPES}')
+        self.path = path
+        self.spec = {'dtype': dtype, 'step': radius / _INT16_MAX if dtype == 'int16' else 1.0}
+        self.members = {'patches': (dtype, (n, input_num, 3))}
+        if dtype != 'float32':
+            self.members['centers'] = ('float32', (n, 3))
+        for key, (member_dtype, shape) in self.members.items():
+            self.spec[key] = f'{path}.{key}.tmp.npy'
+            np.lib.format.open_memmap(self.spec[key], mode='w+', dtype=member_dtype, shape=shape).flush()
+
+    def write(self, start, patches, centers=None):
+        write_block(self.spec, start, patches, centers)
+
+    def close(self):
+        '''
+        pack the .npy files into the .npz as written by np.savez (stored, not
+        compressed, to be memory mapped), copying them without loading them
+        '''
+        names = {'patches': 'arr_0' if self.spec['dtype'] == 'float32' else 'patches', 'centers': 'centers'}
+        with zipfile.ZipFile(self.path + '.tmp', 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for key in self.members:
+                zf.write(self.spec[key], names[key] + '.npy')
+            if self.spec['dtype'] != 'float32':
+                with zf.open('step.npy', 'w') as f:
+                    np.lib.format.write_array(f, np.array(self.spec['step'], dtype=np.float64))
+        os.replace(self.path + '.tmp', self.path)
+        for key in self.members:
+            os.remove(self.spec[key])
+
+
+def save_patches(path, patches, centers, dtype=DEFAULT_DTYPE, radius=1.0):
+    writer = PatchWriter(path, patches.shape[0], patches.shape[1], dtype, radius)
+    writer.write(0, patches, centers)
+    writer.close()
@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.io as sio
+import torch
+import torch.nn.functional as F
+import vgtk.pc as pctk
+import vgtk.point3d as p3dtk
+import vgtk.so3conv.functional as L
+
+'''
+Lean inference of a trained classification model, without the trainer (no log /
+checkpoint dirs, optimizer or dataset loaders):
+
+    predictor = Predictor('params.json', 'ckpt/experiment_net_Iter1000.pth')
+    for name, pc in prefetch(list_clouds('captures/')):
+        ...
+    probs, rot_labels = predictor.predict(batch)
+
+The model is rebuilt from the params.json written at training time, so the
+run options are not needed.
+'''
+
+CLOUD_EXTENSIONS = ['.ply', '.xyz', '.mat', '.npy']
+
+
+def read_cloud(path):
+    '''
+    path: .ply, .xyz (text, x y z [...] per line), .mat (with a 'pc' entry) or .npy ([n, 3+])
+    return: [n, 3] float32 points
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.ply':
+        pc = pctk.load_ply(path)
+    elif ext == '.xyz':
+        pc = np.loadtxt(path, ndmin=2)
+    elif ext == '.mat':
+        pc = sio.loadmat(path)['pc']
+    elif ext == '.npy':
+        pc = np.load(path)
+    else:
+        raise ValueError(f'Unsupported point cloud format {ext} ({path})')
+    pc = np.asarray(pc, dtype=np.float32)
+    if pc.ndim != 2 or pc.shape[1] < 3 or pc.shape[0] == 0:
+        raise ValueError(f'Expected a [n, 3] point cloud in {path}, got shape {list(pc.shape)}')
+    return pc[:, :3]
+
+
+def list_clouds(source):
+    '''
+    source: a directory (its point cloud files, sorted), a single file, or '-' to
+            read the paths from stdin, one per line (streamed, for continuous captures)
+    '''
+    if source == '-':
+        for line in sys.stdin:
+            line = line.strip()
+            if len(line) > 0:
+                yield line
+    elif os.path.isdir(source):
+        for fn in sorted(os.listdir(source)):
+            if os.path.splitext(fn)[1].lower() in CLOUD_EXTENSIONS:
+                yield os.path.join(source, fn)
+    else:
+        yield source
+
+
+def prefetch(paths, load=read_cloud, n_workers=4, depth=16):
+    '''
+    load the files of paths on n_workers threads, at most depth files ahead of
+    the consumer, in order
+    yield: (path, points or None, error message or None)
+    '''
+    def load_safe(path):
+        try:
+            return load(path), None
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(load_safe, path)))
+            if len(pending) >= depth:
+                path, future = pending.popleft()
+                yield (path,) + future.result()
+        while len(pending) > 0:
+            path, future = pending.popleft()
+            yield (path,) + future.result()
+
+
+def preprocess(pc, input_num=None):
+    '''
+    as the eval loader: optional uniform resampling to input_num points, then
+    centering and scaling to the unit sphere
+    '''
+    if input_num is not None and pc.shape[0] != input_num:
+        _, pc = pctk.uniform_resample_np(pc, input_num)
+    return p3dtk.normalize_np(pc.T).T.astype(np.float32)
+
+
+def batch_by_size(items, batch_size, size=lambda item: item[1].shape[0]):
+    '''
+    group a stream of items into batches of batch_size items of the same size
+    (point count), a batch being emitted as soon as it is full; the partial
+    batches are flushed at the end of the stream
+    '''
+    buckets = OrderedDict()
+    for item in items:
+        bucket = buckets.setdefault(size(item), [])
+        bucket.append(item)
+        if len(bucket) == batch_size:
+            yield buckets.pop(size(item))
+    for bucket in buckets.values():
+        yield bucket
+
+
+def load_state_dict(path, device):
+    state_dict = torch.load(path, map_location=device)
+    if 'model' in state_dict and not torch.is_tensor(state_dict['model']):
+        state_dict = state_dict['model']
+    # checkpoints of DataParallel models
+    return OrderedDict((k[len('module.'):] if k.startswith('module.') else k, v) for k, v in state_dict.items())
+
+
+class Predictor():
+    '''
+    params_path: params.json of the training run (see build_model)
+    ckpt_path: model checkpoint (state dict) saved by the trainer
+    '''
+    def __init__(self, params_path, ckpt_path, device=None):
+        from SPConvNets.models.cls_so3net_pn import ClsSO3ConvModel
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        with open(params_path, 'r') as f:
+            self.params = json.load(f)
+        self.model = ClsSO3ConvModel(self.params)
+        self.model.load_state_dict(load_state_dict(ckpt_path, self.device))
+        self.model.to(self.device).eval()
+        self.attention = self.model.outblock.pooling_method.startswith('attention')
+        self.anchors = L.get_anchors(self.params['na'])
+
+    @torch.no_grad()
+    def predict(self, pcs):
+        '''
+        pcs: [nb, np, 3] array / tensor or list of [np, 3] arrays of the same size
+        return: class probabilities [nb, k] and, for attention models, the rotation
+                labels [nb] (anchor of highest attention, see rotation), else None
+        '''
+        if isinstance(pcs, (list, tuple)):
+            pcs = np.stack(pcs)
+        x = torch.as_tensor(pcs, dtype=torch.float32).to(self.device)
+        nb = x.shape[0]
+        pred, feat = self.model(x)
+        probs = F.softmax(pred, 1).cpu().numpy()
+        if not self.attention:
+            return probs, None
+        # out_feat is squeezed: [nb, na] (or [na] for a single cloud)
+        rot_labels = feat.reshape(nb, -1).argmax(1).cpu().numpy()
+        return probs, rot_labels
+
+    def rotation(self, rot_label):
+        '''
+        anchor rotation [3, 3] of a rotation label
+        '''
+        return self.anchors[rot_label]
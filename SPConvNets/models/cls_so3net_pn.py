@@ -8,6 +8,7 @@ from torch.nn.modules.batchnorm import _BatchNorm
 import time
 from collections import OrderedDict
 import json
+import hashlib
 import vgtk
 import SPConvNets.utils as M
 import vgtk.spconv.functional as L
@@ -23,13 +24,20 @@ class ClsSO3ConvModel(nn.Module):
         self.outblock = M.ClsOutBlockPointnet(params['outblock'])
         self.na_in = params['na']
         self.invariance = True
-
-    def forward(self, x, rlabel=None):
+        self.neighborhood_cache = None
+        self.geometry_signature = geometry_signature(params)
+
+    def forward(self, x, rlabel=None, neighbors=None):
+        '''
+            neighbors: optional per-block neighborhoods from compute_neighbors (e.g. loaded
+                       from a geometry sidecar), skipping the sampling and ball queries
+        '''
         # nb, np, 3 -> [nb, 3, np] x [nb, 1, np, na]
         input_x = x
         x = M.preprocess_input(x, self.na_in, False)
         for block_i, block in enumerate(self.backbone):
-            x = block(x)
+            block_neighbors = None if neighbors is None else neighbors[block_i]
+            x = block(x, cache=self.neighborhood_cache, neighbors=block_neighbors)
 
         # x = self.outblock(x.feats, rlabel)
         x = self.outblock(x, rlabel)
@@ -38,6 +46,46 @@ class ClsSO3ConvModel(nn.Module):
     def get_anchor(self):
         return self.backbone[-1].get_anchor()
 
+    def set_chunk_size(self, chunk_size):
+        '''
+            evaluate the inter convolutions over blocks of chunk_size points (None or 0 to disable)
+        '''
+        vgtk.so3conv.set_chunk_size(self, chunk_size)
+
+    def set_checkpoint(self, mode):
+        '''
+            gradient checkpointing of the backbone, one of M.CHECKPOINT_MODES ('none', 'grouping', 'block')
+        '''
+        M.set_checkpoint(self, mode)
+
+    def set_neighborhood_cache(self, cache):
+        '''
+            cache: vgtk.so3conv.NeighborhoodCache or None to disable
+        '''
+        self.neighborhood_cache = cache
+
+    def compute_neighbors(self, x):
+        '''
+            x: [nb, np, 3] -> per block, per layer {'inter_idx', 'sample_idx'} (None for intra layers)
+        '''
+        xyz = x.permute(0, 2, 1).contiguous()
+        neighbors = []
+        for block in self.backbone:
+            block_neighbors, xyz = block.compute_neighbors(xyz)
+            neighbors.append(block_neighbors)
+        return neighbors
+
+
+def geometry_signature(params):
+    '''
+        hash of the backbone settings that determine the neighborhoods, used to
+        check that precomputed geometry matches a model
+    '''
+    keys = ['stride', 'radius', 'n_neighbor', 'lazy_sample', 'pooling', 'neighbor_search']
+    layers = [[(param['type'],) + tuple(param['args'].get(k) for k in keys) for param in block]
+              for block in params['backbone']]
+    return hashlib.md5(json.dumps(layers).encode()).hexdigest()
+
 
 # Full Version
 def build_model(opt,
@@ -142,6 +190,8 @@ def build_model(opt,
                     'pooling': xyz_pooling,
                     'kanchor': na,
                     'norm': 'BatchNorm2d',
+                    'neighbor_search': opt.model.neighbor_search,
+                    'kernel_topk': opt.model.kernel_topk,
                 }
             }
             block_param.append(conv_param)
@@ -164,6 +214,13 @@ def build_model(opt,
             json.dump(params, outfile)
 
     model = ClsSO3ConvModel(params).to(device)
+    if opt.model.chunk_size > 0:
+        model.set_chunk_size(opt.model.chunk_size)
+    if opt.model.checkpoint != 'none':
+        model.set_checkpoint(opt.model.checkpoint)
+    if opt.model.neighbor_cache_mb > 0:
+        model.set_neighborhood_cache(vgtk.so3conv.NeighborhoodCache(opt.model.neighbor_cache_mb * 2**20,
+                                                                    opt.model.neighbor_cache_weights))
     return model
 
 def build_model_from(opt, outfile_path=None):
@@ -49,6 +49,18 @@ class RegSO3ConvModel(nn.Module):
     def get_anchor(self):
         return self.backbone[-1].get_anchor()
 
+    def set_chunk_size(self, chunk_size):
+        '''
+            evaluate the inter convolutions over blocks of chunk_size points (None or 0 to disable)
+        '''
+        vgtk.so3conv.set_chunk_size(self, chunk_size)
+
+    def set_checkpoint(self, mode):
+        '''
+            gradient checkpointing of the backbone, one of M.CHECKPOINT_MODES ('none', 'grouping', 'block')
+        '''
+        M.set_checkpoint(self, mode)
+
 
 # Full Version
 def build_model(opt,
@@ -153,6 +165,8 @@ def build_model(opt,
                     'activation': 'leaky_relu',
                     'pooling': xyz_pooling,
                     'kanchor': na,
+                    'neighbor_search': opt.model.neighbor_search,
+                    'kernel_topk': opt.model.kernel_topk,
                 }
             }
             block_param.append(conv_param)
@@ -175,6 +189,10 @@ def build_model(opt,
             json.dump(params, outfile)
 
     model = RegSO3ConvModel(params).to(device)
+    if opt.model.chunk_size > 0:
+        model.set_chunk_size(opt.model.chunk_size)
+    if opt.model.checkpoint != 'none':
+        model.set_checkpoint(opt.model.checkpoint)
     return model
 
 # TODO
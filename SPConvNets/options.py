@@ -41,6 +41,18 @@ net_args.add_argument('-u', '--flag', type=str, default='max',
                       help='pooling method: max | mean | attention | rotation')
 net_args.add_argument('--representation', type=str, default='quat',
                       help='how to represent rotation: quaternion | ortho6d ')
+net_args.add_argument('--neighbor-search', type=str, default='brute',
+                      help='ball query mode: brute | grid (uniform grid index, for large input clouds)')
+net_args.add_argument('--kernel-topk', type=int, default=0,
+                      help='if > 0, keep only the k most influential neighbors of each kernel point (sparse kernel weights)')
+net_args.add_argument('--chunk-size', type=int, default=0,
+                      help='if > 0, evaluate the inter convolutions over blocks of this many points (bounds inference memory)')
+net_args.add_argument('--checkpoint', type=str, default='none', choices=['none', 'grouping', 'block'],
+                      help='gradient checkpointing of the SO3 convs in training: none | grouping (inter conv grouping) | block (whole conv blocks)')
+net_args.add_argument('--neighbor-cache-mb', type=int, default=0,
+                      help='if > 0, cache the per-layer neighborhoods of seen input clouds within this budget (MB)')
+net_args.add_argument('--neighbor-cache-weights', action='store_true',
+                      help='if set, the neighborhood cache also keeps the kernel weights (inter_w)')
 
 
 
@@ -58,6 +70,10 @@ train_args.add_argument('-t', '--num-thread', default=8, type=int,
                         help='number of threads for loading data')
 train_args.add_argument('--no-augmentation', action="store_true",
                         help='no data augmentation if set true')
+train_args.add_argument('--device-augmentation', action="store_true",
+                        help='resample, normalize and rotate the training batches on device instead of in the loader workers')
+train_args.add_argument('--packed-dataset', action="store_true",
+                        help='read the splits packed by pack_modelnet.py instead of the per-sample .mat files')
 train_args.add_argument('-r','--resume-path', type=str, default=None,
                         help='Training using the pre-trained model')
 train_args.add_argument('--save-freq', type=int, default=2500,
@@ -99,6 +115,10 @@ loss_args.add_argument('--equi-alpha', type=float, default=0.0,
                        help='weight for equivariance loss')
 # Eval arguments
 eval_args = parser.add_parser("eval")
+eval_args.add_argument('--geometry-sidecars', action='store_true',
+                       help='evaluate from the precomputed geometry sidecars (see run_modelnet_geometry.py)')
+eval_args.add_argument('--profile', type=str, default=None,
+                       help='profile the first test batch per layer and stage, print the table and save it as json to this path')
 
 # Test arguments
 test_args = parser.add_parser("test")
@@ -0,0 +1,274 @@
+import json
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from SPConvNets.inference import preprocess
+
+'''
+Local inference server sharing one model between several client processes.
+
+Concurrent requests are queued and grouped into batches by a DynamicBatcher:
+a batch is run as soon as max_batch_size clouds are waiting, or max_latency
+seconds after its first request was queued. The HTTP endpoints are
+
+    POST /predict   {"points": [[x, y, z], ...]} (or a raw float32 [n, 3] body
+                    with Content-Type application/octet-stream)
+                    -> {"label", "probs", "rot_label", "rotation"}
+    GET  /health    {"status": "ok", "device", "warmup_s"}
+    GET  /metrics   request / batch counters, batch size and latency statistics
+
+    server = InferenceServer(Predictor('params.json', 'model.pth'), port=8700)
+    server.serve_forever()      # or server.start() to serve on a thread
+    Client('http://127.0.0.1:8700').predict(points)
+'''
+
+
+class DynamicBatcher():
+    '''
+    predict_fn: list of [np, 3] arrays of the same size -> per cloud results
+    max_batch_size: clouds per batch
+    max_latency: seconds a request waits for its batch to fill
+    '''
+    def __init__(self, predict_fn, max_batch_size=8, max_latency=0.01, window=1000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        # metrics
+        self._lock = threading.Lock()
+        self.n_request = 0
+        self.n_batch = 0
+        self.n_error = 0
+        self._batch_sizes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._batch_times = deque(maxlen=window)
+        self._thread = threading.Thread(target=self._loop, name='DynamicBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, pc):
+        '''
+        queue a preprocessed cloud, return a Future of its result
+        '''
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('The batcher is closed')
+            self._queue.append((pc, future, time.time()))
+            self._cond.notify()
+        return future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while len(self._queue) == 0:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            # the deadline of the oldest request
+            deadline = self._queue[0][2] + self.max_latency
+            while len(self._queue) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            # the clouds of a batch must have the same size: the oldest request's,
+            # the others stay queued for the next batch
+            n_point = self._queue[0][0].shape[0]
+            batch, rest = [], deque()
+            while len(self._queue) > 0:
+                request = self._queue.popleft()
+                if len(batch) < self.max_batch_size and request[0].shape[0] == n_point:
+                    batch.append(request)
+                else:
+                    rest.append(request)
+            self._queue = rest
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.time()
+            try:
+                results = self.predict_fn([pc for pc, _, _ in batch])
+            except Exception as e:
+                with self._lock:
+                    self.n_error += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.time()
+            with self._lock:
+                self.n_request += len(batch)
+                self.n_batch += 1
+                self._batch_sizes.append(len(batch))
+                self._batch_times.append(end - start)
+                self._latencies.extend(end - queued for _, _, queued in batch)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1e3
+            metrics = {
+                'requests': self.n_request,
+                'batches': self.n_batch,
+                'errors': self.n_error,
+                'queued': len(self._queue),
+                'max_batch_size': self.max_batch_size,
+                'max_latency_ms': 1e3 * self.max_latency,
+                'mean_batch_size': float(np.mean(self._batch_sizes)) if len(self._batch_sizes) > 0 else 0.0,
+                'mean_batch_time_ms': 1e3 * float(np.mean(self._batch_times)) if len(self._batch_times) > 0 else 0.0,
+            }
+        for q in [50, 90, 99]:
+            metrics[f'latency_p{q}_ms'] = float(np.percentile(latencies, q)) if len(latencies) > 0 else 0.0
+        return metrics
+
+
+class InferenceServer(ThreadingHTTPServer):
+    '''
+    predictor: SPConvNets.inference.Predictor
+    input_num: points per cloud, the requests are resampled and normalized as in evaluation
+    '''
+    daemon_threads = True
+
+    def __init__(self, predictor, host='127.0.0.1', port=8700, max_batch_size=8, max_latency=0.01,
+                 input_num=1024, warmup=True):
+        self.predictor = predictor
+        self.input_num = input_num
+        self.batcher = DynamicBatcher(self.predict_batch, max_batch_size, max_latency)
+        self.warmup_time = self.warmup(max_batch_size) if warmup else None
+        self._thread = None
+        super(InferenceServer, self).__init__((host, port), _Handler)
+
+    def warmup(self, batch_size):
+        '''
+        one forward at the full batch size (allocator, kernel and anchor setup), return its time
+        '''
+        pcs = [preprocess(np.random.rand(self.input_num, 3).astype(np.float32) - 0.5, None)
+               for _ in range(batch_size)]
+        start = time.time()
+        self.predictor.predict(pcs)
+        return time.time() - start
+
+    def predict_batch(self, pcs):
+        probs, rot_labels = self.predictor.predict(pcs)
+        results = []
+        for i in range(len(pcs)):
+            result = {'label': int(probs[i].argmax()), 'probs': probs[i].tolist()}
+            if rot_labels is not None:
+                result['rot_label'] = int(rot_labels[i])
+                result['rotation'] = self.predictor.rotation(rot_labels[i]).astype(np.float64).tolist()
+            results.append(result)
+        return results
+
+    def predict(self, points):
+        '''
+        points: [n, 3] array, blocks until the result of its batch
+        '''
+        points = np.asarray(points, dtype=np.float32)
+        if points.ndim != 2 or points.shape[1] != 3 or points.shape[0] == 0:
+            raise ValueError(f'Expected [n, 3] points, got shape {list(points.shape)}')
+        return self.batcher.submit(preprocess(points, self.input_num)).result()
+
+    def health(self):
+        return {'status': 'ok', 'device': str(self.predictor.device), 'warmup_s': self.warmup_time}
+
+    def start(self):
+        '''
+        serve on a background thread (e.g. for a loopback client in the same process)
+        '''
+        self._thread = threading.Thread(target=self.serve_forever, name='InferenceServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.batcher.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.server.health())
+        elif self.path == '/metrics':
+            self._reply(200, self.server.batcher.metrics())
+        else:
+            self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type') == 'application/octet-stream':
+                points = np.frombuffer(body, dtype=np.float32).reshape(-1, 3)
+            else:
+                points = json.loads(body)['points']
+            result = self.server.predict(points)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+            return
+        except Exception as e:
+            self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        # no line per request
+        pass
+
+
+class Client():
+    '''
+    client of an InferenceServer, sending the points as raw float32
+    '''
+    def __init__(self, url='http://127.0.0.1:8700', timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def predict(self, points):
+        data = np.ascontiguousarray(points, dtype=np.float32).tobytes()
+        request = urllib.request.Request(self.url + '/predict', data=data,
+                                         headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def health(self):
+        return self._get('/health')
+
+    def metrics(self):
+        return self._get('/metrics')
@@ -149,15 +149,17 @@ class Trainer(vgtk.Trainer):
 
         # set up where to store the output feature
         all_results = dict()
-        for scene in select:
-            assert osp.isdir(osp.join(self.opt.dataset_path, scene))
-            print(f"Working on scene {scene}...")
-            target_folder = osp.join('data/evaluate/3DMatch/', self.opt.experiment_id, scene, f'{self.opt.model.output_num}_dim')
-            self._setup_eval_datasets(scene)
-            self._generate(target_folder)
-            # recalls: [tau, ratio]
-            results = eval3dmatch.evaluate_scene(self.opt.dataset_path, target_folder, scene)
-            all_results[scene] = results        
+        # one worker pool for all the scenes
+        with eval3dmatch.SceneEvaluator(num_thread=8, matcher='torch', device=self.opt.device) as evaluator:
+            for scene in select:
+                assert osp.isdir(osp.join(self.opt.dataset_path, scene))
+                print(f"Working on scene {scene}...")
+                target_folder = osp.join('data/evaluate/3DMatch/', self.opt.experiment_id, scene, f'{self.opt.model.output_num}_dim')
+                self._setup_eval_datasets(scene)
+                self._generate(target_folder)
+                # recalls: [tau, ratio]
+                results = eval3dmatch.evaluate_scene(self.opt.dataset_path, target_folder, scene, evaluator=evaluator)
+                all_results[scene] = results
         self._write_csv(all_results)
         print("Done!")
 
@@ -171,21 +173,15 @@ class Trainer(vgtk.Trainer):
 
             ################### EVAL LOADER ###############################3
             from tqdm import tqdm
-            for it, data in enumerate(self.dataset_eval):
-                sid = data['sid'].item()
-                # scene = data['scene']
-
+            dataset_eval = self.dataset_eval.dataset
+            for sid in range(len(dataset_eval)):
                 checknan = lambda tensor: torch.sum(torch.isnan(tensor))
                 
                 print("\nWorking on fragment id", sid)
-                n_keypoints = data['clouds'].shape[0]
-                # 5000 x N x 3
-                clouds = data['clouds'].to(self.opt.device).squeeze()
-                npt = clouds.shape[0]
-
+                # 5000 x N x 3 patches, streamed from the memory-mapped store batch by batch
                 feature_buffer = []
-                for bi in tqdm(range(0, npt, bs)):
-                    in_tensor_test = clouds[bi : min(npt,bi+bs)]
+                for in_tensor_test in tqdm(dataset_eval.iter_batches(sid, bs)):
+                    in_tensor_test = in_tensor_test.to(self.opt.device)
                     feature, _ = self.model(in_tensor_test)
                     feature_np = feature.detach().cpu().numpy()
                     if checknan(feature).item() > 0:
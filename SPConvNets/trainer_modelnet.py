@@ -1,5 +1,7 @@
 from importlib import import_module
 from SPConvNets import Dataloader_ModelNet40
+from SPConvNets.datasets.modelnet40 import unpack_geometry, collate_raw, augment_batch
+import vgtk.so3conv.functional as L
 from tqdm import tqdm
 import torch
 import vgtk
@@ -29,7 +31,10 @@ class Trainer(vgtk.Trainer):
             self.dataset = torch.utils.data.DataLoader(dataset, \
                                                         batch_size=self.opt.batch_size, \
                                                         shuffle=True, \
-                                                        num_workers=self.opt.num_thread)
+                                                        num_workers=self.opt.num_thread, \
+                                                        collate_fn=collate_raw if dataset.raw else None)
+            if dataset.raw:
+                self.anchors = torch.from_numpy(L.get_anchors()).float().to(self.opt.device)
             self.dataset_iter = iter(self.dataset)
 
         dataset_test = Dataloader_ModelNet40(self.opt, 'testR')
@@ -77,6 +82,8 @@ class Trainer(vgtk.Trainer):
         self.iter_counter += 1
 
     def _optimize(self, data):
+        if self.opt.device_augmentation:
+            data = augment_batch(data, self.opt, self.anchors)
         in_tensors = data['pc'].to(self.opt.device)
         bdim = in_tensors.shape[0]
         in_label = data['label'].to(self.opt.device).reshape(-1)
@@ -164,8 +171,20 @@ class Trainer(vgtk.Trainer):
                 bdim = in_tensors.shape[0]
                 in_label = data['label'].to(self.opt.device).reshape(-1)
                 in_Rlabel = data['R_label'].to(self.opt.device) if self.opt.debug_mode == 'knownatt' else None
+
+                neighbors = None
+                if 'geometry' in data:
+                    if any(s != self.model.geometry_signature for s in data['signature']):
+                        raise ValueError('Geometry sidecars were generated for a different backbone configuration')
+                    neighbors = unpack_geometry(data['geometry'], self.opt.device)
                                 
-                pred, feat = self.model(in_tensors, in_Rlabel)
+                if it == 0 and self.opt.profile is not None:
+                    with vgtk.profiler.Profiler(self.model) as prof:
+                        pred, feat = self.model(in_tensors, in_Rlabel, neighbors)
+                    self.logger.log('Profile', '\n' + prof.table())
+                    prof.save_json(self.opt.profile)
+                else:
+                    pred, feat = self.model(in_tensors, in_Rlabel, neighbors)
                 try: 
 
                     if self.attention_model:
@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
 
 import vgtk.spconv as zptk
 import vgtk.so3conv as sptk
@@ -22,6 +23,54 @@ def preprocess_input(x, na, add_center=True):
     xyz = x[:,:,:3]
     return zptk.SphericalPointCloud(xyz.permute(0,2,1).contiguous(), sptk.get_occupancy_features(x, na, add_center), None)
 
+CHECKPOINT_MODES = ['none', 'grouping', 'block']
+
+def checkpoint_module(module, fn, *args):
+    '''
+    gradient checkpoint of fn(*args) (a forward of module): the activations are
+    recomputed in the backward pass, with the running statistics of the batch
+    norms of module restored after the recomputation so they are only updated once
+    '''
+    n_calls = [0]
+
+    def run(*args):
+        n_calls[0] += 1
+        if n_calls[0] == 1:
+            return fn(*args)
+        norms = [m for m in module.modules() if isinstance(m, _BatchNorm) and m.track_running_stats]
+        stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in norms]
+        try:
+            return fn(*args)
+        finally:
+            # also reached when the recomputation stops early, once the needed activations are recovered
+            with torch.no_grad():
+                for m, (mean, var, n) in zip(norms, stats):
+                    m.running_mean.copy_(mean)
+                    m.running_var.copy_(var)
+                    m.num_batches_tracked.copy_(n)
+
+    return checkpoint(run, *args, use_reentrant=False)
+
+def set_checkpoint(module, mode):
+    '''
+    gradient checkpointing of the SO3 conv layers of module, one of CHECKPOINT_MODES:
+        'none': disabled
+        'grouping': the grouped features and basic conv of every inter conv
+        'block': every inter / separable conv block (inter, intra and skip convs, norms)
+    neighborhoods and kernel weights are always computed once, outside of the recomputation
+    '''
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f'No such checkpoint mode {mode}')
+    for m in module.modules():
+        if isinstance(m, sptk.InterSO3Conv):
+            m.checkpoint = mode == 'grouping'
+        elif isinstance(m, (InterSO3ConvBlock, SeparableSO3ConvBlock)):
+            m.checkpoint = mode == 'block'
+    # no nested checkpoints: the inter block of a separable block runs within its checkpoint
+    for m in module.modules():
+        if isinstance(m, SeparableSO3ConvBlock):
+            m.inter_conv.checkpoint = False
+
 def get_inter_kernel_size(band):
     return np.arange(band + 1).sum() + 1
 
@@ -88,7 +137,8 @@ class PropagationBlock(nn.Module):
 class InterSO3ConvBlock(nn.Module):
     def __init__(self, dim_in, dim_out, kernel_size, stride,
                  radius, sigma, n_neighbor, multiplier, kanchor=60,
-                 lazy_sample=None, norm=None, activation='relu', pooling='none', dropout_rate=0):
+                 lazy_sample=None, norm=None, activation='relu', pooling='none', dropout_rate=0,
+                 neighbor_search='brute', kernel_topk=0):
         super(InterSO3ConvBlock, self).__init__()
 
         if lazy_sample is None:
@@ -103,7 +153,8 @@ class InterSO3ConvBlock(nn.Module):
         pooling_method = None if pooling == 'none' else pooling
         self.conv = sptk.InterSO3Conv(dim_in, dim_out, kernel_size, stride,
                                       radius, sigma, n_neighbor, kanchor=kanchor,
-                                      lazy_sample=lazy_sample, pooling=pooling_method)
+                                      lazy_sample=lazy_sample, pooling=pooling_method,
+                                      neighbor_search=neighbor_search, kernel_topk=kernel_topk)
         self.norm = nn.InstanceNorm2d(dim_out, affine=False) if norm is None else norm(dim_out)
 
         if activation is None:
@@ -112,10 +163,17 @@ class InterSO3ConvBlock(nn.Module):
             self.relu = getattr(F, activation)
 
         self.dropout = nn.Dropout(dropout_rate) if dropout_rate > 0 else None
+        self.checkpoint = False
+
+    def forward(self, x, inter_idx=None, inter_w=None, cache=None, sample_idx=None):
+        if self.checkpoint and self.conv.pooling is None and torch.is_grad_enabled():
+            inter_idx, inter_w, sample_idx, _ = self.conv.neighborhood(x.xyz, inter_idx, inter_w, cache, sample_idx)
+            return checkpoint_module(self, self._forward, x, inter_idx, inter_w, None, sample_idx)
+        return self._forward(x, inter_idx, inter_w, cache, sample_idx)
 
-    def forward(self, x, inter_idx=None, inter_w=None):
+    def _forward(self, x, inter_idx=None, inter_w=None, cache=None, sample_idx=None):
         input_x = x
-        inter_idx, inter_w, sample_idx, x = self.conv(x, inter_idx, inter_w)
+        inter_idx, inter_w, sample_idx, x = self.conv(x, inter_idx, inter_w, cache=cache, sample_idx=sample_idx)
         feat = self.norm(x.feats)
         # feat = x.feats
 
@@ -125,6 +183,9 @@ class InterSO3ConvBlock(nn.Module):
             feat = self.dropout(feat)
         return inter_idx, inter_w, sample_idx, zptk.SphericalPointCloud(x.xyz, feat, x.anchors)
 
+    def compute_neighbors(self, xyz):
+        return self.conv.compute_neighbors(xyz)
+
 
 class BasicSO3ConvBlock(nn.Module):
     def __init__(self, params):
@@ -145,11 +206,19 @@ class BasicSO3ConvBlock(nn.Module):
             self.blocks.append(conv)
         self.params = params
 
-    def forward(self, x):
+    def forward(self, x, cache=None, neighbors=None):
+        '''
+            cache: optional vgtk.so3conv.NeighborhoodCache reused by the inter convolutions
+            neighbors: optional precomputed neighborhoods, as returned by compute_neighbors
+        '''
         inter_idx, inter_w = None, None
-        for conv, param in zip(self.blocks, self.params):
+        for li, (conv, param) in enumerate(zip(self.blocks, self.params)):
             if param['type'] in ['inter', 'inter_block', 'separable_block']:
-                inter_idx, inter_w, _, x = conv(x, inter_idx, inter_w)
+                sample_idx = None
+                if neighbors is not None and inter_idx is None:
+                    inter_idx = neighbors[li]['inter_idx']
+                    sample_idx = neighbors[li].get('sample_idx')
+                inter_idx, inter_w, _, x = conv(x, inter_idx, inter_w, cache=cache, sample_idx=sample_idx)
                 # import ipdb; ipdb.set_trace()
 
                 if param['args']['stride'] > 1:
@@ -162,6 +231,26 @@ class BasicSO3ConvBlock(nn.Module):
 
         return x
 
+    def compute_neighbors(self, xyz):
+        '''
+            neighborhoods of every layer of the block, following the reuse policy of forward
+            xyz: [nb, 3, p] -> list (per layer) of {'inter_idx', 'sample_idx'} (None for intra layers), xyz
+        '''
+        neighbors = []
+        inter_idx = None
+        for conv, param in zip(self.blocks, self.params):
+            if param['type'] in ['inter', 'inter_block', 'separable_block']:
+                if inter_idx is None:
+                    inter_idx, sample_idx, xyz = conv.compute_neighbors(xyz)
+                    neighbors.append({'inter_idx': inter_idx, 'sample_idx': sample_idx})
+                else:
+                    neighbors.append({'inter_idx': inter_idx})
+                if param['args']['stride'] > 1:
+                    inter_idx = None
+            else:
+                neighbors.append(None)
+        return neighbors, xyz
+
     def get_anchor(self):
         return torch.from_numpy(sptk.get_anchors())
 
@@ -192,14 +281,22 @@ class SeparableSO3ConvBlock(nn.Module):
         self.skip_conv = nn.Conv2d(dim_in, dim_out, 1)
         self.norm = nn.InstanceNorm2d(dim_out, affine=False) if norm is None else norm(dim_out)
         self.relu = getattr(F, params['activation'])
+        self.checkpoint = False
 
 
-    def forward(self, x, inter_idx, inter_w):
+    def forward(self, x, inter_idx, inter_w, cache=None, sample_idx=None):
         '''
             inter, intra conv with skip connection
         '''
+        conv = self.inter_conv.conv
+        if self.checkpoint and conv.pooling is None and torch.is_grad_enabled():
+            inter_idx, inter_w, sample_idx, _ = conv.neighborhood(x.xyz, inter_idx, inter_w, cache, sample_idx)
+            return checkpoint_module(self, self._forward, x, inter_idx, inter_w, None, sample_idx)
+        return self._forward(x, inter_idx, inter_w, cache, sample_idx)
+
+    def _forward(self, x, inter_idx, inter_w, cache=None, sample_idx=None):
         skip_feature = x.feats
-        inter_idx, inter_w, sample_idx, x = self.inter_conv(x, inter_idx, inter_w)
+        inter_idx, inter_w, sample_idx, x = self.inter_conv(x, inter_idx, inter_w, cache=cache, sample_idx=sample_idx)
 
         if self.use_intra:
             x = self.intra_conv(x)
@@ -211,6 +308,9 @@ class SeparableSO3ConvBlock(nn.Module):
         x_out = zptk.SphericalPointCloud(x.xyz, x.feats + skip_feature, x.anchors)
         return inter_idx, inter_w, sample_idx, x_out
 
+    def compute_neighbors(self, xyz):
+        return self.inter_conv.compute_neighbors(xyz)
+
     def get_anchor(self):
         return torch.from_numpy(sptk.get_anchors())
 
@@ -0,0 +1,4 @@
+'''
+Benchmarks of the vgtk operators and the SO3 backbones, see __main__.py:
+python -m benchmarks run --out results.json
+'''
@@ -0,0 +1,82 @@
+import argparse
+import torch
+
+from . import common, ops, models
+
+'''
+Benchmark suite of the vgtk operators and the SO3 backbones.
+
+Run the operator and model benchmarks and store the results:
+python -m benchmarks run --suites ops models --points 512 1024 2048 4096 8192 --anchors 1 20 40 60 \
+    --batch-sizes 1 4 --out results.json
+
+Compare two result files (e.g. of two commits), flagging results more than
+--threshold slower or faster; exits with status 1 if anything got slower:
+python -m benchmarks compare base.json results.json --threshold 0.1
+'''
+
+
+def run(opt):
+    device = torch.device(opt.device)
+    torch.manual_seed(opt.seed)
+    results = []
+    if 'ops' in opt.suites:
+        results += ops.run(opt, device)
+    if 'models' in opt.suites:
+        results += models.run(opt, device)
+    if opt.out is not None:
+        common.save_results(opt.out, common.environment(device), results)
+        print(f'[Benchmark] {len(results)} results saved to {opt.out}')
+
+
+def compare(opt):
+    base, new = common.load_results(opt.base), common.load_results(opt.new)
+    rows = common.compare(base, new, opt.threshold)
+    print('base: %s\nnew:  %s' % (base['environment'].get('commit'), new['environment'].get('commit')))
+    print('%-24s %-70s %12s %12s %8s' % ('name', 'params', 'base (ms)', 'new (ms)', 'ratio'))
+    for name, params, t_base, t_new, ratio, status in rows:
+        flag = '' if status == 'ok' else status
+        print('%-24s %-70s %12.2f %12.2f %8.3f %s' % (name, common.format_params(params)[:70], 1e3 * t_base,
+                                                      1e3 * t_new, ratio, flag))
+    n_slower = sum(row[-1] == 'slower' for row in rows)
+    print(f'{len(rows)} compared, {n_slower} slower, {sum(row[-1] == "faster" for row in rows)} faster')
+    return 1 if n_slower > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='vgtk operator / model benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_args = sub.add_parser('run')
+    run_args.add_argument('--suites', type=str, nargs='+', default=['ops', 'models'], choices=['ops', 'models'])
+    run_args.add_argument('--ops', type=str, nargs='+', default=ops.OPS, choices=ops.OPS)
+    run_args.add_argument('--models', type=str, nargs='+', default=list(models.MODELS), choices=list(models.MODELS))
+    run_args.add_argument('--points', type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192],
+                          help='point counts of the operator benchmarks')
+    run_args.add_argument('--model-points', type=int, nargs='+', default=[1024, 2048],
+                          help='input point counts of the model benchmarks')
+    run_args.add_argument('--anchors', type=int, nargs='+', default=[1, 20, 40, 60])
+    run_args.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+    run_args.add_argument('--channels', type=int, default=32, help='feature channels of the operator benchmarks')
+    run_args.add_argument('--stride', type=int, default=2)
+    run_args.add_argument('--radius', type=float, default=0.2)
+    run_args.add_argument('--n-neighbor', type=int, default=32)
+    run_args.add_argument('--search-radius', type=float, default=0.4, help='input radius of the InvSO3ConvModel')
+    run_args.add_argument('--neighbor-search', type=str, default='brute', choices=['brute', 'grid'])
+    run_args.add_argument('--kernel-topk', type=int, default=0)
+    run_args.add_argument('--checkpoint', type=str, default='none', choices=['none', 'grouping', 'block'])
+    run_args.add_argument('--repeat', type=int, default=3)
+    run_args.add_argument('--seed', type=int, default=0)
+    run_args.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    run_args.add_argument('--out', type=str, default=None, help='json file of the results')
+
+    compare_args = sub.add_parser('compare')
+    compare_args.add_argument('base', type=str)
+    compare_args.add_argument('new', type=str)
+    compare_args.add_argument('--threshold', type=float, default=0.1, help='relative time change flagged')
+
+    opt = parser.parse_args()
+    if opt.command == 'run':
+        run(opt)
+    else:
+        exit(compare(opt))
@@ -0,0 +1,100 @@
+import json
+import os
+import platform
+import subprocess
+import time
+import torch
+
+'''
+Timing, result files and regression comparison shared by the benchmarks.
+
+A result file is a json dict {'environment': {...}, 'results': [...]}, each
+result being {'name', 'params', 'time', ...} with times in seconds (mean over
+the repeats, after one warmup call). Results of two files are matched on
+(name, params).
+'''
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timeit(fn, device, n_repeat):
+    '''
+    fn is called once to warm up, then n_repeat times
+    return: the output of the last call, mean time per call (s)
+    '''
+    out = fn()
+    synchronize(device)
+    start = time.time()
+    for _ in range(n_repeat):
+        out = fn()
+    synchronize(device)
+    return out, (time.time() - start) / n_repeat
+
+
+def git_commit():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(device):
+    env = {
+        'commit': git_commit(),
+        'torch': torch.__version__,
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+    }
+    if device.type == 'cuda':
+        env['gpu'] = torch.cuda.get_device_name(device)
+    return env
+
+
+def save_results(path, env, results):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'environment': env, 'results': results}, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def result_key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(base, new, threshold=0.1, field='time'):
+    '''
+    base, new: result files (as loaded by load_results)
+    return: rows (name, params, base time, new time, ratio, status) for the results
+            present in both, status being 'slower' / 'faster' when the time changed by
+            more than threshold (relative), 'ok' otherwise
+    '''
+    base_results = {result_key(r): r for r in base['results']}
+    rows = []
+    for r in new['results']:
+        b = base_results.get(result_key(r))
+        if b is None or b.get(field) is None or r.get(field) is None:
+            continue
+        ratio = r[field] / max(b[field], 1e-12)
+        if ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((r['name'], r['params'], b[field], r[field], ratio, status))
+    return rows
+
+
+def format_params(params):
+    return ' '.join(f'{k}={v}' for k, v in params.items())
@@ -0,0 +1,85 @@
+import contextlib
+import io
+from importlib import import_module
+from types import SimpleNamespace
+import torch
+
+from .common import timeit, synchronize
+
+'''
+Full model benchmarks: forward (eval mode, no grad) and forward + backward
+(train mode, sum of the outputs as loss) of the backbones as built by
+build_model from the run options, on random clouds.
+'''
+
+MODELS = {
+    'cls': 'SPConvNets.models.cls_so3net_pn',
+    'inv': 'SPConvNets.models.inv_so3net_pn',
+}
+
+
+def model_options(opt, device, n, na):
+    '''
+    the subset of SPConvNets.options read by build_model
+    '''
+    model = SimpleNamespace(input_num=n, kanchor=na, dropout_rate=0.0, flag='attention', kpconv=False,
+                            search_radius=opt.search_radius, neighbor_search=opt.neighbor_search,
+                            kernel_topk=opt.kernel_topk, chunk_size=0, checkpoint=opt.checkpoint,
+                            neighbor_cache_mb=0, neighbor_cache_weights=False)
+    return SimpleNamespace(device=device, model=model, train_loss=SimpleNamespace(temperature=3))
+
+
+def bench_model(opt, device, name, nb, n, na):
+    # build_model prints the layer settings
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = getattr(import_module(MODELS[name]), 'build_model')(model_options(opt, device, n, na))
+    x = torch.rand(nb, n, 3, device=device) - 0.5
+
+    model.eval()
+    with torch.no_grad():
+        _, t_forward = timeit(lambda: model(x), device, opt.repeat)
+
+    if nb == 1:
+        # batch norms need more than one sample per channel in training
+        return t_forward, None, None
+
+    model.train()
+    def step():
+        model.zero_grad()
+        out = model(x)
+        loss = sum(o.sum() for o in (out if isinstance(out, (tuple, list)) else [out]) if torch.is_tensor(o))
+        loss.backward()
+    _, t_step = timeit(step, device, opt.repeat)
+
+    peak = None
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device)
+    return t_forward, t_step, peak
+
+
+def run(opt, device, log=print):
+    results = []
+    for name in opt.models:
+        for n in opt.model_points:
+            for nb in opt.batch_sizes:
+                for na in opt.anchors:
+                    params = {'points': n, 'batch_size': nb, 'anchors': na, 'search_radius': opt.search_radius,
+                              'neighbor_search': opt.neighbor_search, 'kernel_topk': opt.kernel_topk,
+                              'checkpoint': opt.checkpoint}
+                    try:
+                        t_forward, t_step, peak = bench_model(opt, device, name, nb, n, na)
+                    except RuntimeError as e:
+                        results.append({'name': f'{name}_forward', 'params': params, 'time': None, 'error': str(e)})
+                        log(f'[Benchmark] {name} {params} failed: {e}')
+                        continue
+                    results.append({'name': f'{name}_forward', 'params': params, 'time': t_forward})
+                    msg = '%10.2fms forward' % (1e3 * t_forward)
+                    if t_step is not None:
+                        results.append({'name': f'{name}_forward_backward', 'params': params, 'time': t_step,
+                                        'peak_memory': peak})
+                        msg += ' %10.2fms forward+backward' % (1e3 * t_step)
+                    log('[Benchmark] %-24s %-40s %s' % (name, f'points={n} batch={nb} anchors={na}', msg))
+    return results
@@ -0,0 +1,96 @@
+import torch
+
+import vgtk.pc as pctk
+import vgtk.spconv as zptk
+import vgtk.so3conv as sptk
+import vgtk.so3conv.functional as L
+
+from .common import timeit
+
+'''
+Operator benchmarks: sampling / neighbor search and the SO3 conv groupings on
+random clouds in [-0.5, 0.5]^3, for every (points, batch size, anchors) of the
+run options. Forward only.
+'''
+
+OPS = ['ball_query_index', 'furthest_sample_index', 'inter_so3conv_grouping',
+       'intra_so3conv_grouping', 'PointnetSO3Conv']
+
+
+def random_cloud(nb, n, device):
+    return (torch.rand(nb, 3, n, device=device) - 0.5).contiguous()
+
+
+def bench_ball_query_index(opt, device, nb, n, na):
+    support = random_cloud(nb, n, device)
+    query = support[:, :, :n // opt.stride].contiguous()
+    _, t = timeit(lambda: pctk.ball_query_index(query, support, opt.radius, opt.n_neighbor,
+                                                search=opt.neighbor_search), device, opt.repeat)
+    return {'radius': opt.radius, 'n_neighbor': opt.n_neighbor, 'stride': opt.stride,
+            'neighbor_search': opt.neighbor_search}, t
+
+
+def bench_furthest_sample_index(opt, device, nb, n, na):
+    pc = random_cloud(nb, n, device)
+    _, t = timeit(lambda: pctk.furthest_sample_index(pc, n // opt.stride, False), device, opt.repeat)
+    return {'stride': opt.stride}, t
+
+
+def bench_inter_so3conv_grouping(opt, device, nb, n, na):
+    xyz = random_cloud(nb, n, device)
+    feats = torch.randn(nb, opt.channels, n, na, device=device)
+    anchors = torch.from_numpy(L.get_anchors(na)).to(device)
+    kernels = torch.from_numpy(L.get_sphereical_kernel_points_from_ply(0.7 * opt.radius, 1)).to(device)
+    sigma = 0.5 * opt.radius**2
+    _, t = timeit(lambda: L.inter_so3conv_grouping(xyz, feats, opt.stride, opt.n_neighbor, anchors, kernels,
+                                                   opt.radius, sigma, lazy_sample=False,
+                                                   neighbor_search=opt.neighbor_search,
+                                                   kernel_topk=opt.kernel_topk), device, opt.repeat)
+    return {'channels': opt.channels, 'radius': opt.radius, 'n_neighbor': opt.n_neighbor, 'stride': opt.stride,
+            'neighbor_search': opt.neighbor_search, 'kernel_topk': opt.kernel_topk}, t
+
+
+def bench_intra_so3conv_grouping(opt, device, nb, n, na):
+    if na != 60:
+        # the intra conv is only defined on the 60 anchors
+        return None, None
+    intra_idx = torch.from_numpy(L.get_intra_idx()).long().to(device)
+    feats = torch.randn(nb, opt.channels, n, na, device=device)
+    _, t = timeit(lambda: L.intra_so3conv_grouping(intra_idx, feats), device, opt.repeat)
+    return {'channels': opt.channels}, t
+
+
+def bench_PointnetSO3Conv(opt, device, nb, n, na):
+    conv = sptk.PointnetSO3Conv(opt.channels, 2 * opt.channels, na).to(device).eval()
+    x = zptk.SphericalPointCloud(random_cloud(nb, n, device), torch.randn(nb, opt.channels, n, na, device=device),
+                                 None)
+    with torch.no_grad():
+        _, t = timeit(lambda: conv(x), device, opt.repeat)
+    return {'channels': opt.channels}, t
+
+
+def run(opt, device, log=print):
+    results = []
+    for name in opt.ops:
+        bench = globals()['bench_' + name]
+        for n in opt.points:
+            for nb in opt.batch_sizes:
+                # sampling and neighbor search do not depend on the anchors
+                anchors = [None] if name in ['ball_query_index', 'furthest_sample_index'] else opt.anchors
+                for na in anchors:
+                    params = {'points': n, 'batch_size': nb}
+                    if na is not None:
+                        params['anchors'] = na
+                    try:
+                        extra, t = bench(opt, device, nb, n, na)
+                    except RuntimeError as e:
+                        # e.g. out of memory: recorded, the sweep goes on
+                        results.append({'name': name, 'params': params, 'time': None, 'error': str(e)})
+                        log(f'[Benchmark] {name} {params} failed: {e}')
+                        continue
+                    if t is None:
+                        continue
+                    params.update(extra)
+                    results.append({'name': name, 'params': params, 'time': t})
+                    log('[Benchmark] %-24s %-40s %10.2fms' % (name, f'points={n} batch={nb} anchors={na}', 1e3 * t))
+    return results
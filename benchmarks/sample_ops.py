@@ -0,0 +1,63 @@
+import argparse
+import torch
+
+import vgtk.ops as ops
+import vgtk.pc as pctk
+
+from .common import timeit
+
+"""
+Benchmark of the pure pytorch ball query / furthest point sampling in
+vgtk.pc.sample against the native kernels (cuda if available, else the cpu
+extension). Indices are compared element for element.
+
+Usage:
+python -m benchmarks.sample_ops --points 2048 4096 8192 --batch-size 8
+"""
+
+
+def run(opt):
+    device = torch.device(opt.device)
+    native = 'cuda' if device.type == 'cuda' else 'cpu'
+    if native not in ops.available('ball_query', device):
+        print(f'[Benchmark] no native {native} extension found, timing the pytorch implementation only')
+        native = None
+
+    torch.manual_seed(opt.seed)
+    print('%8s %6s | %12s %12s %8s | %12s %12s %8s' % ('points', 'query', 'bq torch', 'bq native', 'match',
+                                                       'fps torch', 'fps native', 'match'))
+    for n in opt.points:
+        support = (torch.rand(opt.batch_size, 3, n, device=device) - 0.5).contiguous()
+        n_query = n // opt.stride
+        query = support[:, :, :n_query].contiguous()
+
+        bq_ref, t_bq_ref = timeit(lambda: pctk.ball_query_index(query, support, opt.radius, opt.n_sample,
+                                                                backend='torch'), device, opt.repeat)
+        fps_ref, t_fps_ref = timeit(lambda: pctk.furthest_sample_index(support, n_query, False,
+                                                                       backend='torch'), device, opt.repeat)
+        if native is not None:
+            bq, t_bq = timeit(lambda: pctk.ball_query_index(query, support, opt.radius, opt.n_sample,
+                                                            backend=native), device, opt.repeat)
+            fps, t_fps = timeit(lambda: pctk.furthest_sample_index(support, n_query, False,
+                                                                   backend=native), device, opt.repeat)
+            bq_match = '%.6f' % (bq == bq_ref).float().mean().item()
+            fps_match = '%.6f' % (fps == fps_ref).float().mean().item()
+        else:
+            t_bq = t_fps = float('nan')
+            bq_match = fps_match = '-'
+
+        print('%8d %6d | %10.2fms %10.2fms %8s | %10.2fms %10.2fms %8s' % (n, n_query,
+              1e3 * t_bq_ref, 1e3 * t_bq, bq_match, 1e3 * t_fps_ref, 1e3 * t_fps, fps_match))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ball query / furthest point sampling benchmark')
+    parser.add_argument('--points', type=int, nargs='+', default=[2048, 4096, 8192])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--stride', type=int, default=4)
+    parser.add_argument('--radius', type=float, default=0.2)
+    parser.add_argument('--n-sample', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    run(parser.parse_args())
@@ -1,14 +1,16 @@
 import os
+import argparse
+import json
+import zlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from scipy.io import savemat
-from scipy.spatial.transform import Rotation
-import random
 
 """
 This script processes a dataset of XYZ files and converts them into PLY and MAT files in a specified folder structure.
 
 The input folder should have the following structure:
-folder/object/object_number.xyz
+folder/object/test/object_number.xyz
 
 The script creates a new folder structure with the following format:
 newfolder/object/train (containing .ply and .mat files)
@@ -18,77 +20,88 @@ newfolder/object/testR (containing only .mat files with assigned rotation angles
 The script randomly splits the files for each object into train (80%) and test (20%) sets.
 The testR folder contains the same files as the test folder but with an assigned rotation matrix in the .mat files.
 
-Note: The script is currently set to process a maximum of 40 objects (MAX_OBJECTS) due to model constraints.
-      The point clouds are also reduced by a factor of 4 (vertices[::4]) to accommodate GPU constraints.
-      To change the number of points per object, modify the vertices[::4] line.
+Objects and files are visited in sorted order and every random draw (train/test split per object, rotation per
+file) is derived from --seed, so rebuilding the dataset gives the same splits and rotations. The label of every
+object is recorded in newfolder/objects.json with the build options (--stride, --seed, --train-ratio): a rebuild
+keeps the labels of the known objects and appends the new ones, and files whose outputs already exist are skipped,
+which makes it cheap to rebuild after adding new objects. Changing a build option converts every file again.
 
-Input:
-    input_folder: The path to the input folder containing the XYZ files.
-    output_folder: The path to the output folder where the new folder structure will be created.
+Note: The script processes a maximum of 40 objects (--max-objects) due to model constraints.
+      The point clouds are also reduced by a factor of 4 (--stride) to accommodate GPU constraints.
 
 Usage:
-    Specify the input_folder and output_folder paths in the script and run it.
-    The script will process the XYZ files and create the new folder structure with PLY and MAT files.
+    python createYCB40.py 3dsgrasp_ycb_train_test_split/gt YCB40 --workers 8 --seed 0
 """
 
 MAX_OBJECTS = 40
-def generate_random_rotation_matrix():
+MANIFEST = 'objects.json'
+SPLITS = ["train", "test", "testR"]
+
+# binary little endian vertex layout of the output PLY files
+PLY_VERTEX = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                       ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+def generate_random_rotation_matrix(rng=np.random):
     """
     Generate a random rotation matrix.
 
+    Args:
+        rng: The random generator used to draw the angles.
+
     Returns:
-        R: A random rotatio    """
+        R: A random rotation matrix.
+    """
     # Generate random rotation angles (in radians)
-    angles = np.random.uniform(0, 2*np.pi, size=3)
-    
+    angles = rng.uniform(0, 2*np.pi, size=3)
+
     # Create rotation matrices for each axis
     Rx = np.array([[1, 0, 0],
                    [0, np.cos(angles[0]), -np.sin(angles[0])],
                    [0, np.sin(angles[0]), np.cos(angles[0])]])
-    
+
     Ry = np.array([[np.cos(angles[1]), 0, np.sin(angles[1])],
                    [0, 1, 0],
                    [-np.sin(angles[1]), 0, np.cos(angles[1])]])
-    
+
     Rz = np.array([[np.cos(angles[2]), -np.sin(angles[2]), 0],
                    [np.sin(angles[2]), np.cos(angles[2]), 0],
                    [0, 0, 1]])
-    
+
     # Combine the rotation matrices
     R = Rz @ Ry @ Rx
-    
+
     return R
 
-def convert_xyz_to_ply_and_mat(xyz_file, ply_file, mat_file, object_name, object_id, rotated_mat_file=None):
+def read_xyz(xyz_file):
     """
-    Convert an XYZ file to PLY and MAT files.
+    Read a whitespace separated XYZ file.
 
     Args:
         xyz_file: The path to the input XYZ file.
-        ply_file: The path to the output PLY file.
-        mat_file: The path to the output MAT file.
-        object_name: The name of the object.
-        object_id: The ID of the object.
-        rotated_mat_file: The path to the output rotated MAT file (optional).
-    """
-    # Read the .xyz file
-    points = np.loadtxt(xyz_file)
-
-    # Extract the coordinates
-    x = points[:, 0]
-    y = points[:, 1]
-    z = points[:, 2]
 
-    # Create the vertex array for PLY
-    vertices = np.column_stack((x, y, z))[::4]
-
-    # Assign default colors for PLY (you can modify this if needed)
-    colors = np.full((len(vertices), 3), [255, 255, 255])
+    Returns:
+        points: [n, c] array, with c the number of columns of the first line.
+    """
+    with open(xyz_file, 'r') as file:
+        n_col = len(file.readline().split())
+    points = np.fromfile(xyz_file, sep=' ')
+    if n_col == 0 or points.size % n_col != 0:
+        # irregular file (comments, missing values): fall back to the slow parser
+        return np.loadtxt(xyz_file, ndmin=2)
+    return points.reshape(-1, n_col)
+
+def write_ply(ply_file, vertices, colors):
+    """
+    Write a binary PLY file with float vertices and uchar colors.
 
-    # Define the PLY header
+    Args:
+        ply_file: The path to the output PLY file.
+        vertices: [n, 3] array of coordinates.
+        colors: [n, 3] array of colors in [0, 255].
+    """
     ply_header = [
         "ply",
-        "format ascii 1.0",
+        "format binary_little_endian 1.0",
         f"element vertex {len(vertices)}",
         "property float x",
         "property float y",
@@ -98,12 +111,47 @@ def convert_xyz_to_ply_and_mat(xyz_file, ply_file, mat_file, object_name, object
         "property uchar blue",
         "end_header"
     ]
+    data = np.empty(len(vertices), dtype=PLY_VERTEX)
+    data['x'], data['y'], data['z'] = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+    data['red'], data['green'], data['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+    with open(ply_file, 'wb') as file:
+        file.write(('\n'.join(ply_header) + '\n').encode('ascii'))
+        data.tofile(file)
+
+def save_mat(mat_file, data_dict):
+    """
+    Save a MAT file through a temporary file, so that an interrupted run never leaves a partial output behind.
+    """
+    savemat(mat_file + '.tmp', data_dict, appendmat=False)
+    os.replace(mat_file + '.tmp', mat_file)
+
+def convert_xyz_to_ply_and_mat(xyz_file, ply_file, mat_file, object_name, object_id, rotated_mat_file=None,
+                               stride=4, rng=np.random):
+    """
+    Convert an XYZ file to PLY and MAT files.
+
+    Args:
+        xyz_file: The path to the input XYZ file.
+        ply_file: The path to the output PLY file.
+        mat_file: The path to the output MAT file.
+        object_name: The name of the object.
+        object_id: The ID of the object.
+        rotated_mat_file: The path to the output rotated MAT file (optional).
+        stride: Keep one point out of stride.
+        rng: The random generator used to draw the rotation of the rotated MAT file.
+    """
+    # Read the .xyz file
+    points = read_xyz(xyz_file)
+
+    # Create the vertex array for PLY
+    vertices = np.ascontiguousarray(points[::stride, :3])
+
+    # Assign default colors for PLY (you can modify this if needed)
+    colors = np.full((len(vertices), 3), 255, dtype=np.uint8)
 
     # Save the PLY file
-    with open(ply_file, 'w') as file:
-        file.write('\n'.join(ply_header) + '\n')
-        for vertex, color in zip(vertices, colors):
-            file.write(f"{vertex[0]} {vertex[1]} {vertex[2]} {color[0]} {color[1]} {color[2]}\n")
+    write_ply(ply_file + '.tmp', vertices, colors)
+    os.replace(ply_file + '.tmp', ply_file)
 
     # Create a dictionary to store the data for MAT
     file_id = os.path.splitext(os.path.basename(xyz_file))[0]
@@ -119,104 +167,215 @@ def convert_xyz_to_ply_and_mat(xyz_file, ply_file, mat_file, object_name, object
         'cat': np.array([object_name])
     }
 
-    # Save the data as a .mat file
-    savemat(mat_file, data_dict)
-
     if rotated_mat_file is not None:
         # Generate a random rotation matrix
-        R = generate_random_rotation_matrix()
-        # Apply the rotation to the reduced coordinates
+        R = generate_random_rotation_matrix(rng)
         # Create a dictionary to store the data for the rotated MAT file
-        rotated_data_dict = {
-            '__header__': 'MATLAB 5.0 MAT-file Platform: posix, Created on: Wed May 08 03:57:13 2024',
-            '__version__': '1.0',
-            '__globals__': [],
-            'pc': vertices,
-            'name': np.array([object_name + "_" + file_id]),
-            'label': np.array([[object_id]]),
-            'cat': np.array([object_name]),
-            'R': R
-        }
+        rotated_data_dict = dict(data_dict, R=R)
 
         # Save the rotated data as a .mat file
-        savemat(rotated_mat_file, rotated_data_dict)
+        save_mat(rotated_mat_file, rotated_data_dict)
+
+    # Save the data as a .mat file (written last: marks the file as converted)
+    save_mat(mat_file, data_dict)
+
+def convert_task(task):
+    """
+    Process pool entry point: convert one file unless all of its outputs already exist.
+
+    Args:
+        task: (xyz_file, ply_file, mat_file, object_name, object_id, rotated_mat_file, stride, seed)
+
+    Returns:
+        True if the file was converted, False if it was skipped.
+    """
+    xyz_file, ply_file, mat_file, object_name, object_id, rotated_mat_file, stride, seed = task
+    if all(os.path.exists(f) for f in task_outputs(task)):
+        return False
+    # per file generator: the rotation does not depend on the order or the worker processing the file
+    rng = np.random.default_rng([seed, zlib.crc32(mat_file.encode())])
+    convert_xyz_to_ply_and_mat(xyz_file, ply_file, mat_file, object_name, object_id, rotated_mat_file,
+                               stride, rng)
+    return True
+
+def list_objects(input_folder):
+    """
+    The object folders of the input folder, sorted.
+    """
+    return sorted(f for f in os.listdir(input_folder) if os.path.isdir(os.path.join(input_folder, f)))
+
+def load_manifest(output_folder):
+    """
+    The manifest of a previous build: {"objects": object names, the index being the label, "stride", "seed",
+    "train_ratio"}, or None.
+    """
+    manifest_path = os.path.join(output_folder, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+def save_manifest(output_folder, manifest):
+    manifest_path = os.path.join(output_folder, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def assign_object_ids(object_folders, known_objects=(), max_objects=MAX_OBJECTS):
+    """
+    Label the objects: the known objects (of a previous build) keep their label, the new objects get the next
+    labels in sorted order, up to max_objects labels.
+
+    Args:
+        object_folders: The names of the objects of the input folder.
+        known_objects: The object names of the previous build, the index being the label.
+        max_objects: The maximum number of objects (labels).
 
-def process_files(input_folder, output_folder):
+    Returns:
+        objects: The object names, the index being the label (known objects missing from the input included).
+    """
+    objects = list(known_objects)
+    if len(objects) > max_objects:
+        raise ValueError(f"The dataset already has {len(objects)} objects, more than --max-objects {max_objects}")
+    for object_folder in sorted(object_folders):
+        if object_folder not in objects and len(objects) < max_objects:
+            objects.append(object_folder)
+    return objects
+
+def list_tasks(input_folder, output_folder, objects, stride=4, seed=0, train_ratio=0.8):
+    """
+    Create the output folder structure and list the conversion of every XYZ file.
+
+    Args:
+        input_folder: The path to the input folder containing the XYZ files.
+        output_folder: The path to the output folder where the new folder structure will be created.
+        objects: The object names, the index being the label (see assign_object_ids).
+        stride: Keep one point out of stride.
+        seed: The seed of the train/test splits and of the rotations.
+        train_ratio: The fraction of the files of each object used for training.
+
+    Returns:
+        tasks: A list of arguments of convert_task.
+    """
+    tasks = []
+    object_folders = set(list_objects(input_folder))
+    for object_id, object_folder in enumerate(objects):
+        if object_folder not in object_folders:
+            continue
+        object_path = os.path.join(input_folder, object_folder)
+
+        # Create the train, test and testR folders in the output object folder
+        output_object_folder = os.path.join(output_folder, object_folder)
+        output_train_folder = os.path.join(output_object_folder, "train")
+        output_test_folder = os.path.join(output_object_folder, "test")
+        output_testR_folder = os.path.join(output_object_folder, "testR")
+        for folder in [output_train_folder, output_test_folder, output_testR_folder]:
+            os.makedirs(folder, exist_ok=True)
+
+        test_folder = os.path.join(object_path, "test")
+        if not os.path.isdir(test_folder):
+            continue
+
+        # Get a sorted list of .xyz files in the test folder and shuffle it with the object's own generator
+        xyz_files = sorted(file for file in os.listdir(test_folder) if file.endswith(".xyz"))
+        rng = np.random.default_rng([seed, zlib.crc32(object_folder.encode())])
+        xyz_files = [xyz_files[i] for i in rng.permutation(len(xyz_files))]
+
+        # Split the files into train and test sets
+        split_index = int(len(xyz_files) * train_ratio)
+        for i, xyz_file in enumerate(xyz_files):
+            xyz_path = os.path.join(test_folder, xyz_file)
+            file_id = os.path.splitext(xyz_file)[0]
+            output_name = f"{object_folder}_{file_id}"
+            if i < split_index:
+                tasks.append((xyz_path, os.path.join(output_train_folder, output_name + ".ply"),
+                              os.path.join(output_train_folder, output_name + ".mat"),
+                              object_folder, object_id, None, stride, seed))
+            else:
+                tasks.append((xyz_path, os.path.join(output_test_folder, output_name + ".ply"),
+                              os.path.join(output_test_folder, output_name + ".mat"),
+                              object_folder, object_id, os.path.join(output_testR_folder, output_name + ".mat"),
+                              stride, seed))
+    return tasks
+
+def task_outputs(task):
+    _, ply_file, mat_file, _, _, rotated_mat_file, _, _ = task
+    return [ply_file, mat_file] + ([rotated_mat_file] if rotated_mat_file is not None else [])
+
+def remove_outputs(output_folder, object_folders, keep=()):
+    """
+    Remove the PLY and MAT files of the train, test and testR folders of the objects that are not in keep.
+
+    Returns:
+        The number of removed files.
+    """
+    keep = set(keep)
+    n_removed = 0
+    for object_folder in object_folders:
+        for split in SPLITS:
+            folder = os.path.join(output_folder, object_folder, split)
+            if not os.path.isdir(folder):
+                continue
+            for file in os.listdir(folder):
+                path = os.path.join(folder, file)
+                if file.endswith(('.ply', '.mat', '.tmp')) and path not in keep:
+                    os.remove(path)
+                    n_removed += 1
+    return n_removed
+
+def process_files(input_folder, output_folder, workers=None, max_objects=MAX_OBJECTS, stride=4, seed=0,
+                  train_ratio=0.8):
     """
     Process the XYZ files in the input folder and create the new folder structure with PLY and MAT files.
 
     Args:
         input_folder: The path to the input folder containing the XYZ files.
         output_folder: The path to the output folder where the new folder structure will be created.
+        workers: The number of worker processes (all cores if None, in process if <= 1).
+        max_objects, stride, seed, train_ratio: see list_tasks.
+
+    Returns:
+        (number of converted files, number of skipped files, number of removed stale files)
     """
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
-
-    # Initialize object ID counter
-    object_id = 0
-
-    # Iterate over the object folders
-    for object_folder in os.listdir(input_folder):
-        if object_id >= MAX_OBJECTS:
-            break 
-        object_path = os.path.join(input_folder, object_folder)
-        if os.path.isdir(object_path):
-            # Create the object folder in the output directory
-            output_object_folder = os.path.join(output_folder, object_folder)
-            os.makedirs(output_object_folder, exist_ok=True)
-
-            # Create the train folder in the output object folder
-            output_train_folder = os.path.join(output_object_folder, "train")
-            os.makedirs(output_train_folder, exist_ok=True)
-
-            # Create the test folder in the output object folder
-            output_test_folder = os.path.join(output_object_folder, "test")
-            os.makedirs(output_test_folder, exist_ok=True)
-
-            # Create the testR folder in the output object folder
-            output_testR_folder = os.path.join(output_object_folder, "testR")
-            os.makedirs(output_testR_folder, exist_ok=True)
-
-            # Iterate over the test folders
-            test_folder = os.path.join(object_path, "test")
-            if os.path.isdir(test_folder):
-                # Get a list of .xyz files in the test folder
-                xyz_files = [file for file in os.listdir(test_folder) if file.endswith(".xyz")]
-                
-                # Shuffle the list of files randomly
-                random.shuffle(xyz_files)
-                
-                # Calculate the split index
-                split_index = int(len(xyz_files) * 0.8)
-                
-                # Split the files into train and test sets
-                train_files = xyz_files[:split_index]
-                test_files = xyz_files[split_index:]
-                
-                # Process train files
-                for xyz_file in train_files:
-                    xyz_path = os.path.join(test_folder, xyz_file)
-                    file_id = os.path.splitext(xyz_file)[0]
-                    ply_file = os.path.join(output_train_folder, f"{object_folder}_{file_id}.ply")
-                    mat_file = os.path.join(output_train_folder, f"{object_folder}_{file_id}.mat")
-                    convert_xyz_to_ply_and_mat(xyz_path, ply_file, mat_file, object_folder, object_id)
-                
-                # Process test files
-                for xyz_file in test_files:
-                    xyz_path = os.path.join(test_folder, xyz_file)
-                    file_id = os.path.splitext(xyz_file)[0]
-                    ply_file = os.path.join(output_test_folder, f"{object_folder}_{file_id}.ply")
-                    mat_file = os.path.join(output_test_folder, f"{object_folder}_{file_id}.mat")
-                    rotated_mat_file = os.path.join(output_testR_folder, f"{object_folder}_{file_id}.mat")
-                    convert_xyz_to_ply_and_mat(xyz_path, ply_file, mat_file, object_folder, object_id, rotated_mat_file)
-
-            # Increment object ID for the next object
-            object_id += 1
-
-
-# Specify the input and output folders
-input_folder = "3dsgrasp_ycb_train_test_split/gt"
-output_folder = "YCB40"
-
-# Process the files
-process_files(input_folder, output_folder)
\ No newline at end of file
+    manifest = load_manifest(output_folder)
+    options = {'stride': stride, 'seed': seed, 'train_ratio': train_ratio}
+    # the outputs of a build without manifest or with other options are not reused
+    reuse = manifest is not None and all(manifest.get(key) == value for key, value in options.items())
+    object_folders = list_objects(input_folder)
+    objects = assign_object_ids(object_folders, manifest['objects'] if manifest is not None else (), max_objects)
+    tasks = list_tasks(input_folder, output_folder, objects, stride, seed, train_ratio)
+
+    # outputs of other splits, of objects past max_objects (built before the manifest) or of other options,
+    # removed before the manifest is written so that an interrupted build resumes correctly
+    keep = [f for task in tasks for f in task_outputs(task)] if reuse else []
+    n_removed = remove_outputs(output_folder, object_folders, keep)
+    save_manifest(output_folder, dict(options, objects=objects))
+
+    if workers is not None and workers <= 1:
+        converted = [convert_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            converted = list(executor.map(convert_task, tasks, chunksize=8))
+
+    n_converted = sum(converted)
+    return n_converted, len(tasks) - n_converted, n_removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build the YCB40 dataset from the 3DSGrasp YCB split')
+    parser.add_argument('input_folder', type=str, nargs='?', default="3dsgrasp_ycb_train_test_split/gt")
+    parser.add_argument('output_folder', type=str, nargs='?', default="YCB40")
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the train/test splits and the rotations')
+    parser.add_argument('--stride', type=int, default=4, help='keep one point out of stride')
+    parser.add_argument('--max-objects', type=int, default=MAX_OBJECTS)
+    parser.add_argument('--train-ratio', type=float, default=0.8)
+    args = parser.parse_args()
+
+    # Process the files
+    n_converted, n_skipped, n_removed = process_files(args.input_folder, args.output_folder, args.workers,
+                                                      args.max_objects, args.stride, args.seed, args.train_ratio)
+    print(f"Converted {n_converted} files, skipped {n_skipped} already converted files, "
+          f"removed {n_removed} stale files")
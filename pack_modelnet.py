@@ -0,0 +1,24 @@
+import argparse
+import time
+from SPConvNets.datasets.modelnet40 import pack_modelnet40
+
+"""
+This script packs the splits of a ModelNet40 / YCB40 dataset directory (one .mat file per sample under
+<category>/<split>/) into one contiguous point file and one index file per split, written under PATH_TO_DATASET/packed/:
+python pack_modelnet.py PATH_TO_DATASET --splits train test testR
+
+The packed splits are then used by the ModelNet40 loader with the --packed-dataset flag:
+CUDA_VISIBLE_DEVICES=0 python run_modelnet.py experiment -d PATH_TO_DATASET --packed-dataset
+"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack a ModelNet40 / YCB40 dataset directory')
+    parser.add_argument('dataset_path', type=str)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test', 'testR'])
+    args = parser.parse_args()
+
+    for split in args.splits:
+        start = time.time()
+        n = pack_modelnet40(args.dataset_path, split)
+        print(f"[Pack] {split}: {n} samples in {time.time() - start:.1f}s")
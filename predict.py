@@ -0,0 +1,89 @@
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from SPConvNets.inference import Predictor, list_clouds, prefetch, preprocess, batch_by_size
+
+"""
+This script classifies point clouds with a trained classification model, without setting up the trainer.
+
+To classify the .ply / .xyz / .mat / .npy files of a folder, use the following command:
+CUDA_VISIBLE_DEVICES=0 python predict.py -p PATH_TO_PARAMS_JSON -r PATH_TO_MODEL -i PATH_TO_FOLDER -o predictions.jsonl
+
+- PATH_TO_PARAMS_JSON is the params.json written in the model dir of the training run.
+- PATH_TO_MODEL is the trained model checkpoint.
+- Use -i - to read the file paths from stdin, one per line (e.g. from a capture process), with a small batch size
+  (batches are only run once full, or at the end of the input).
+
+Each line of the output is the json record of one input file:
+{"file": ..., "label": ..., "class": ..., "probs": [...], "rot_label": ..., "rotation": [[...], [...], [...]]}
+with the class probabilities and, for attention models, the label of the anchor rotation of highest attention (the
+rotation of the input cloud w.r.t. the canonical pose, up to the anchor resolution). Files that cannot be read are
+reported as {"file": ..., "error": ...}.
+
+The clouds are resampled to --input-num points (the input number of the training run), centered and scaled to the
+unit sphere as in evaluation, and batched by point count.
+"""
+
+
+def records(predictor, batch, names):
+    probs, rot_labels = predictor.predict([pc for _, pc in batch])
+    for i, (path, _) in enumerate(batch):
+        label = int(probs[i].argmax())
+        record = {'file': path, 'label': label}
+        if names is not None:
+            record['class'] = names[label]
+        record['probs'] = [round(float(p), 6) for p in probs[i]]
+        if rot_labels is not None:
+            record['rot_label'] = int(rot_labels[i])
+            record['rotation'] = np.round(predictor.rotation(rot_labels[i]).astype(np.float64), 6).tolist()
+        yield record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batch inference of a classification model')
+    parser.add_argument('-p', '--params', type=str, required=True, help='params.json of the training run')
+    parser.add_argument('-r', '--resume-path', type=str, required=True, help='model checkpoint')
+    parser.add_argument('-i', '--input', type=str, required=True, help='folder, file, or - for paths on stdin')
+    parser.add_argument('-o', '--out', type=str, default=None, help='output jsonl file (default: stdout)')
+    parser.add_argument('--input-num', type=int, default=1024, help='points per cloud (0 to keep the clouds as is)')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-thread', type=int, default=4, help='file reader threads')
+    parser.add_argument('--prefetch', type=int, default=32, help='files read ahead')
+    parser.add_argument('--classes', type=str, default=None, help='text file of the class names, one per line')
+    parser.add_argument('--device', type=str, default=None)
+    opt = parser.parse_args()
+
+    names = None
+    if opt.classes is not None:
+        with open(opt.classes, 'r') as f:
+            names = [line.strip() for line in f if len(line.strip()) > 0]
+
+    start = time.time()
+    predictor = Predictor(opt.params, opt.resume_path, opt.device)
+    print(f'[Predict] model loaded on {predictor.device} in {time.time() - start:.2f}s', file=sys.stderr)
+
+    out = sys.stdout if opt.out is None else open(opt.out, 'w')
+    input_num = opt.input_num if opt.input_num > 0 else None
+
+    def clouds():
+        for path, pc, error in prefetch(list_clouds(opt.input), n_workers=opt.num_thread, depth=opt.prefetch):
+            if error is not None:
+                out.write(json.dumps({'file': path, 'error': error}) + '\n')
+                out.flush()
+                continue
+            yield path, preprocess(pc, input_num)
+
+    n_cloud = 0
+    start = time.time()
+    try:
+        for batch in batch_by_size(clouds(), opt.batch_size):
+            for record in records(predictor, batch, names):
+                out.write(json.dumps(record) + '\n')
+            out.flush()
+            n_cloud += len(batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f'[Predict] {n_cloud} clouds classified in {time.time() - start:.2f}s', file=sys.stderr)
@@ -39,7 +39,9 @@ if __name__ == '__main__':
 
     if opt.mode == 'train':
         # overriding training parameters here
-        opt.batch_size = 6
+        if opt.model.checkpoint == 'none':
+            # activation memory bound; checkpointed models keep the given batch size
+            opt.batch_size = 6
         opt.train_lr.decay_rate = 0.5
         opt.train_lr.decay_step = 20000
         opt.train_loss.attention_loss_type = 'default'
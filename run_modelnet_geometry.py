@@ -0,0 +1,32 @@
+from importlib import import_module
+from SPConvNets.datasets.modelnet40 import write_geometry_sidecars
+from SPConvNets.options import opt
+import time
+
+"""
+This script precomputes the geometry sidecars of a ModelNet40 / YCB40 eval split for the classification model.
+
+For every sample of the split (fixed rotation R stored in the .mat), the rotated and normalized point cloud, its labels
+and the sampled centers / ball query neighborhoods of every layer of the backbone built from the current options are
+written to PATH_TO_DATASET/<category>/testR_geometry/<name>.npz:
+CUDA_VISIBLE_DEVICES=0 python run_modelnet_geometry.py experiment -d PATH_TO_DATASET
+
+Evaluation can then skip the sampling and neighbor search entirely:
+CUDA_VISIBLE_DEVICES=0 python run_modelnet.py experiment -d PATH_TO_DATASET -r PATH_TO_MODEL --run-mode eval --geometry-sidecars
+
+The neighborhoods only depend on the backbone configuration (input number, strides, radii, neighbor search), which
+is hashed into each sidecar and checked at evaluation time; the model weights are not needed.
+"""
+
+
+if __name__ == '__main__':
+    opt.model.flag = 'attention'
+    opt.model.model = "cls_so3net_pn"
+
+    module = import_module('SPConvNets.models')
+    model = getattr(module, opt.model.model).build_model_from(opt, None)
+    model.eval()
+
+    start = time.time()
+    n_written = write_geometry_sidecars(opt, model, 'testR')
+    print(f"[Geometry] wrote {n_written} sidecars in {time.time() - start:.1f}s")
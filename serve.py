@@ -0,0 +1,48 @@
+import argparse
+from SPConvNets.inference import Predictor
+from SPConvNets.serving import InferenceServer
+
+"""
+This script serves a trained classification model over http, so that several processes (e.g. the robot processes
+of a grasping stack) share one copy of the model.
+
+To start the server, use the following command:
+CUDA_VISIBLE_DEVICES=0 python serve.py -p PATH_TO_PARAMS_JSON -r PATH_TO_MODEL --port 8700
+
+- PATH_TO_PARAMS_JSON is the params.json written in the model dir of the training run.
+- PATH_TO_MODEL is the trained model checkpoint.
+- Concurrent requests are batched: a batch runs once --max-batch-size clouds are queued, or --max-latency-ms after
+  its first request.
+
+Clients post [n, 3] clouds to /predict, see SPConvNets/serving.py:
+from SPConvNets.serving import Client
+Client('http://127.0.0.1:8700').predict(points)   # {"label", "probs", "rot_label", "rotation"}
+
+GET /health and GET /metrics report the server status and the batching / latency statistics.
+"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inference server of a classification model')
+    parser.add_argument('-p', '--params', type=str, required=True, help='params.json of the training run')
+    parser.add_argument('-r', '--resume-path', type=str, required=True, help='model checkpoint')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--input-num', type=int, default=1024, help='points per cloud')
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-latency-ms', type=float, default=10.0)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--no-warmup', action='store_true')
+    opt = parser.parse_args()
+
+    predictor = Predictor(opt.params, opt.resume_path, opt.device)
+    server = InferenceServer(predictor, opt.host, opt.port, opt.max_batch_size, 1e-3 * opt.max_latency_ms,
+                             opt.input_num, warmup=not opt.no_warmup)
+    print(f'[Serve] model on {predictor.device}, warmup {server.warmup_time}s, listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
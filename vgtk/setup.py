@@ -1,6 +1,6 @@
 import os
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+from torch.utils.cpp_extension import BuildExtension, CppExtension, CUDAExtension, CUDA_HOME
 
 #############################################################
 #############################################################
@@ -8,7 +8,7 @@ from torch.utils.cpp_extension import BuildExtension, CUDAExtension
 
 PACKAGE_NAME = 'vgtk'
 EXT_MODULES = ['gathering', 'grouping', 'zpconv']
-PACKAGES = ['app', 'cuda', 'functional', 'point3d', 'pc', 'mesh', 'voxel', 'spconv', 'so3conv', 'transform', 'data.anchors']
+PACKAGES = ['app', 'cpu', 'cuda', 'functional', 'ops', 'point3d', 'pc', 'mesh', 'voxel', 'spconv', 'so3conv', 'transform', 'data.anchors']
 INSTALL_REQUIREMENTS = ['numpy',
                         'torch',
                         'torchvision', 
@@ -34,8 +34,19 @@ def cuda_extension(package_name, ext):
     return CUDAExtension(ext_name, [ext_cpp, ext_cu])
 
 
+def cpu_extension(package_name, ext):
+    ext_name = f"{package_name}.cpu.{ext}"
+    ext_cpp = f"{package_name}/cpu/{ext}_cpu.cpp"
+    return CppExtension(ext_name, [ext_cpp],
+                        extra_compile_args=['-O3', '-fopenmp'],
+                        extra_link_args=['-fopenmp'])
+
+
 pkg_name = PACKAGE_NAME
-ext_modules = [cuda_extension(pkg_name, ext) for ext in EXT_MODULES]
+# the cpu extensions are always built, the cuda ones only when a toolkit is available
+ext_modules = [cpu_extension(pkg_name, ext) for ext in EXT_MODULES]
+if CUDA_HOME is not None:
+    ext_modules += [cuda_extension(pkg_name, ext) for ext in EXT_MODULES]
 pkgs = [pkg_name] + [f"{pkg_name}.{pkg}" for pkg in PACKAGES]
 install_reqs = [req for req in INSTALL_REQUIREMENTS]
 
@@ -48,7 +59,7 @@ setup(
     version='0.0.1',
     name=pkg_name,
     packages=pkgs,
-    package_data={'':['*.ply']},
+    package_data={'':['*.ply', '*.npz']},
     include_package_data=True,
     install_requires=install_reqs,
     ext_modules=ext_modules,
@@ -1,4 +1,6 @@
 from . import functional
+from . import ops
+from . import profiler
 from . import point3d
 # from . import image
 # from . import mesh
@@ -0,0 +1,102 @@
+#include <cmath>
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include <torch/torch.h>
+#include <vector>
+
+// C++ interface
+#define CHECK_CPU(x) TORCH_CHECK(!x.is_cuda(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be contiguous")
+#define CHECK_INPUT(x) CHECK_CPU(x); CHECK_CONTIGUOUS(x)
+
+
+// parallel over (b, c), each task owns one output row so no reduction is shared
+template <typename scalar_t>
+void gather_points_forward_cpu_kernel(int b, int c, int n, int m,
+    const scalar_t* __restrict__ points, // [b, c, n]
+    const int* __restrict__ idx,         // [b, m]
+    float* __restrict__ out) {           // [b, c, m]
+
+    at::parallel_for(0, (int64_t)b * c, 16, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const int* batch_idx = idx + (bc / c) * m;
+        const scalar_t* row = points + bc * n;
+        float* out_row = out + bc * m;
+        for (int j = 0; j < m; ++j) {
+          out_row[j] = row[batch_idx[j]];
+        }
+      }
+    });
+}
+
+template <typename scalar_t>
+void gather_points_backward_cpu_kernel(int b, int c, int n, int m,
+    const scalar_t* __restrict__ grad_out, // [b, c, m]
+    const int* __restrict__ idx,           // [b, m]
+    scalar_t* __restrict__ grad_points) {  // [b, c, n]
+
+    at::parallel_for(0, (int64_t)b * c, 16, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const int* batch_idx = idx + (bc / c) * m;
+        const scalar_t* grad_row = grad_out + bc * m;
+        scalar_t* out_row = grad_points + bc * n;
+        for (int j = 0; j < m; ++j) {
+          out_row[batch_idx[j]] += grad_row[j];
+        }
+      }
+    });
+}
+
+
+at::Tensor gather_points_forward(
+    at::Tensor support_points, //[nb, c_in, nsupport]
+    at::Tensor grouped_indices //[nb, nsample]
+  ){
+
+  CHECK_INPUT(support_points);
+  CHECK_INPUT(grouped_indices);
+
+  at::Tensor output = torch::zeros({support_points.size(0), support_points.size(1), grouped_indices.size(1)},
+    at::device(support_points.device()).dtype(at::ScalarType::Float));
+
+  AT_DISPATCH_FLOATING_TYPES(support_points.scalar_type(), "gather_points_forward_cpu", ([&] {
+    gather_points_forward_cpu_kernel<scalar_t>(support_points.size(0), support_points.size(1),
+        support_points.size(2), grouped_indices.size(1),
+        support_points.data_ptr<scalar_t>(),
+        grouped_indices.data_ptr<int>(),
+        output.data_ptr<float>());
+  }));
+
+  // output: [nb, c_in, nsample]
+  return output;
+}
+
+at::Tensor gather_points_backward(
+    at::Tensor grad_out,        //[nb, c_in, nsample]
+    at::Tensor grouped_indices, //[nb, nsample]
+    int npoint
+  ){
+
+  CHECK_INPUT(grad_out);
+  CHECK_INPUT(grouped_indices);
+
+  at::Tensor output = torch::zeros({grad_out.size(0), grad_out.size(1), npoint},
+    at::device(grad_out.device()).dtype(grad_out.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(grad_out.scalar_type(), "gather_points_backward_cpu", ([&] {
+    gather_points_backward_cpu_kernel<scalar_t>(grad_out.size(0), grad_out.size(1),
+        npoint, grouped_indices.size(1),
+        grad_out.data_ptr<scalar_t>(),
+        grouped_indices.data_ptr<int>(),
+        output.data_ptr<scalar_t>());
+  }));
+
+  // output: [nb, c_in, nsupport]
+  return output;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("gather_points_forward", &gather_points_forward, "gathering forward (CPU)");
+  m.def("gather_points_backward", &gather_points_backward, "gathering backward (CPU)");
+}
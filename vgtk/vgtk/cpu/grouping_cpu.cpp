@@ -0,0 +1,161 @@
+#include <cmath>
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include <torch/torch.h>
+#include <vector>
+
+// C++ interface
+#define CHECK_CPU(x) TORCH_CHECK(!x.is_cuda(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be contiguous")
+#define CHECK_INPUT(x) CHECK_CPU(x); CHECK_CONTIGUOUS(x)
+
+
+// ball query, same semantics as ball_query_cuda_kernel:
+// the first nsample points (in index order) within radius are kept,
+// and missing slots are filled by repeating the hits cyclically.
+template <typename scalar_t>
+void ball_query_cpu_kernel(int b, int n, int m, float radius,
+    int nsample,
+    const scalar_t* __restrict__ new_xyz, // (b, 3, m)
+    const scalar_t* __restrict__ xyz,     // (b, 3, n)
+    int* __restrict__ idx) {              // (b, m, nsample)
+
+    const scalar_t radius2 = radius * radius;
+
+    at::parallel_for(0, (int64_t)b * m, 256, [&](int64_t begin, int64_t end) {
+      for (int64_t bj = begin; bj < end; ++bj) {
+        const int bn = bj / m;
+        const int j = bj % m;
+        const scalar_t* batch_xyz = xyz + (int64_t)bn * 3 * n;
+        const scalar_t* batch_new_xyz = new_xyz + (int64_t)bn * 3 * m;
+        int* batch_idx = idx + ((int64_t)bn * m + j) * nsample;
+
+        const scalar_t new_x = batch_new_xyz[0 * m + j];
+        const scalar_t new_y = batch_new_xyz[1 * m + j];
+        const scalar_t new_z = batch_new_xyz[2 * m + j];
+
+        int cnt = 0;
+        for (int k = 0; k < n && cnt < nsample; ++k) {
+            const scalar_t x = batch_xyz[0 * n + k];
+            const scalar_t y = batch_xyz[1 * n + k];
+            const scalar_t z = batch_xyz[2 * n + k];
+            const scalar_t d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) + (new_z - z) * (new_z - z);
+            if (d2 < radius2) {
+                batch_idx[cnt] = k;
+                ++cnt;
+            }
+        }
+
+        if (cnt < nsample - 1) {
+            for (int k = 0; k + cnt < nsample; ++k) {
+                batch_idx[k + cnt] = batch_idx[k];
+            }
+        }
+      }
+    });
+}
+
+
+// furthest point sampling, same semantics as furthest_point_sampling_cuda_kernel:
+// starts from index 0, skips points at the origin (shadow / padding points)
+// and breaks ties towards the lower index.
+template <typename scalar_t>
+void furthest_point_sampling_cpu_kernel(int b, int n, int m,
+    const scalar_t* __restrict__ dataset, // (b, 3, n)
+    scalar_t* __restrict__ temp,          // (b, n)
+    int* __restrict__ idxs) {             // (b, m)
+
+    if (m <= 0)
+        return;
+
+    at::parallel_for(0, b, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bn = begin; bn < end; ++bn) {
+        const scalar_t* batch_data = dataset + bn * 3 * n;
+        scalar_t* batch_temp = temp + bn * n;
+        int* batch_idxs = idxs + bn * m;
+
+        int old = 0;
+        batch_idxs[0] = old;
+        for (int j = 1; j < m; j++) {
+            int besti = 0;
+            scalar_t best = -1;
+            const scalar_t x1 = batch_data[0 * n + old];
+            const scalar_t y1 = batch_data[1 * n + old];
+            const scalar_t z1 = batch_data[2 * n + old];
+            for (int k = 0; k < n; k++) {
+                const scalar_t x2 = batch_data[0 * n + k];
+                const scalar_t y2 = batch_data[1 * n + k];
+                const scalar_t z2 = batch_data[2 * n + k];
+                const scalar_t mag = (x2 * x2) + (y2 * y2) + (z2 * z2);
+                if (mag <= 1e-3)
+                    continue;
+
+                const scalar_t d = (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1) +
+                    (z2 - z1) * (z2 - z1);
+                const scalar_t d2 = std::min(d, batch_temp[k]);
+                batch_temp[k] = d2;
+                if (d2 > best) {
+                    best = d2;
+                    besti = k;
+                }
+            }
+            old = besti;
+            batch_idxs[j] = old;
+        }
+      }
+    });
+}
+
+
+at::Tensor ball_query(
+    at::Tensor new_xyz,  // (b,3,m)
+    at::Tensor xyz,      // (b,3,n)
+    const float radius,
+    const int nsample) {
+
+    CHECK_INPUT(new_xyz);
+    CHECK_INPUT(xyz);
+
+    at::Tensor idx =
+    torch::zeros({new_xyz.size(0), new_xyz.size(2), nsample},
+             at::device(new_xyz.device()).dtype(at::ScalarType::Int));
+
+    AT_DISPATCH_FLOATING_TYPES(xyz.scalar_type(), "ball_query_cpu", ([&] {
+      ball_query_cpu_kernel<scalar_t>(xyz.size(0), xyz.size(2), new_xyz.size(2), radius, nsample,
+          new_xyz.data_ptr<scalar_t>(),
+          xyz.data_ptr<scalar_t>(),
+          idx.data_ptr<int>());
+    }));
+
+    // output: idx(b, m, nsample)
+    return idx;
+}
+
+at::Tensor furthest_point_sampling(
+    at::Tensor source_xyz, // [b, 3, p]
+    const int m) {
+
+    CHECK_INPUT(source_xyz);
+
+    // [nb, nq]
+    at::Tensor tmp = torch::full({source_xyz.size(0), source_xyz.size(2)},
+      1e10, at::device(source_xyz.device()).dtype(source_xyz.dtype()));
+    // [nb, m]
+    at::Tensor sampled_idx = torch::zeros({source_xyz.size(0), m},
+      at::device(source_xyz.device()).dtype(at::ScalarType::Int));
+
+    AT_DISPATCH_FLOATING_TYPES(source_xyz.scalar_type(), "furthest_point_sampling_cpu", ([&] {
+      furthest_point_sampling_cpu_kernel<scalar_t>(source_xyz.size(0), source_xyz.size(2), m,
+          source_xyz.data_ptr<scalar_t>(),
+          tmp.data_ptr<scalar_t>(),
+          sampled_idx.data_ptr<int>());
+    }));
+
+    return sampled_idx;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("ball_query", &ball_query, "ball query (CPU)");
+  m.def("furthest_point_sampling", &furthest_point_sampling, "furthest point sampling (CPU)");
+}
@@ -0,0 +1,472 @@
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include <torch/torch.h>
+#include <vector>
+
+// C++ interface
+
+#define CHECK_CPU(x) TORCH_CHECK(!x.is_cuda(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be contiguous")
+#define CHECK_INPUT(x) CHECK_CPU(x); CHECK_CONTIGUOUS(x)
+
+// channel block handled by one task in the scatter-style backward passes
+#define CHANNEL_BLOCK 16
+
+
+// InterZPConv Grouping
+// np: n sample, nq: n point
+// Features are processed channel-last ([b, nq, na, c]) so that the innermost
+// loop runs over contiguous channels; each task owns one sample point, so the
+// forward pass needs no atomics. Zero kernel weights are skipped.
+template <typename scalar_t>
+void spherical_conv_forward_cpu_kernel(
+    const int* __restrict__ anchor_neighbors,         // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ anchor_weights,      // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ support_point_feats, // [b, nq, na, c_in]
+    scalar_t* __restrict__ anchor_feats,              // [b, np, ks, na, c_in]
+    int nb, int np, int nq, int na, int ks, int ann, int c_in) {
+
+    at::parallel_for(0, (int64_t)nb * np, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bp = begin; bp < end; ++bp) {
+        const int64_t bn = bp / np;
+        const int* neighbors = anchor_neighbors + bp * na * ks * ann;
+        const scalar_t* weights = anchor_weights + bp * na * ks * ann;
+        const scalar_t* feats = support_point_feats + bn * nq * na * c_in;
+        scalar_t* out = anchor_feats + bp * ks * na * c_in;
+
+        for (int an = 0; an < na; an++) {
+          for (int k = 0; k < ks; k++) {
+            scalar_t* dst = out + ((int64_t)k * na + an) * c_in;
+            const int offset = (an * ks + k) * ann;
+            for (int ni = 0; ni < ann; ni++) {
+              const scalar_t w = weights[offset + ni];
+              if (w == 0)
+                continue;
+              const scalar_t* src = feats + ((int64_t)neighbors[offset + ni] * na + an) * c_in;
+              for (int ci = 0; ci < c_in; ci++) {
+                dst[ci] += w * src[ci];
+              }
+            }
+          }
+        }
+      }
+    });
+}
+
+
+// each task owns a block of channels of one batch, so the scatter into
+// support points is race free
+template <typename scalar_t>
+void spherical_conv_backward_cpu_kernel(
+    const int* __restrict__ anchor_neighbors,          // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ anchor_weights,       // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ grad_anchor_feats,    // [b, np, ks, na, c_in]
+    scalar_t* __restrict__ grad_support_point_feats,   // [b, nq, na, c_in]
+    int nb, int np, int nq, int na, int ks, int ann, int c_in) {
+
+    const int n_block = (c_in + CHANNEL_BLOCK - 1) / CHANNEL_BLOCK;
+
+    at::parallel_for(0, (int64_t)nb * n_block, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const int64_t bn = bc / n_block;
+        const int c0 = (bc % n_block) * CHANNEL_BLOCK;
+        const int c1 = std::min(c0 + CHANNEL_BLOCK, c_in);
+        scalar_t* grad_feats = grad_support_point_feats + bn * nq * na * c_in;
+
+        for (int pn = 0; pn < np; pn++) {
+          const int64_t bp = bn * np + pn;
+          const int* neighbors = anchor_neighbors + bp * na * ks * ann;
+          const scalar_t* weights = anchor_weights + bp * na * ks * ann;
+          const scalar_t* grad = grad_anchor_feats + bp * ks * na * c_in;
+          for (int an = 0; an < na; an++) {
+            for (int k = 0; k < ks; k++) {
+              const scalar_t* src = grad + ((int64_t)k * na + an) * c_in;
+              const int offset = (an * ks + k) * ann;
+              for (int ni = 0; ni < ann; ni++) {
+                const scalar_t w = weights[offset + ni];
+                if (w == 0)
+                  continue;
+                scalar_t* dst = grad_feats + ((int64_t)neighbors[offset + ni] * na + an) * c_in;
+                for (int ci = c0; ci < c1; ci++) {
+                  dst[ci] += w * src[ci];
+                }
+              }
+            }
+          }
+        }
+      }
+    });
+}
+
+// Fused InterZPConv Grouping
+// Neighborhood shared by all anchors and kernel points ([b, np, ann] indices)
+// with dense kernel weights [b, np, na, ks, ann]: the neighbor features are
+// gathered and contracted against the weights in one pass, so the grouped
+// features [b, c_in, np, ann, na] are never materialized.
+template <typename scalar_t>
+void fused_conv_forward_cpu_kernel(
+    const int* __restrict__ neighbors_idx,            // [b, np, ann]
+    const scalar_t* __restrict__ anchor_weights,      // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ support_point_feats, // [b, nq, na, c_in]
+    scalar_t* __restrict__ anchor_feats,              // [b, c_in, ks, np, na]
+    int nb, int np, int nq, int na, int ks, int ann, int c_in) {
+
+    at::parallel_for(0, (int64_t)nb * np, 1, [&](int64_t begin, int64_t end) {
+      // per point accumulator [ks, na, c_in]
+      std::vector<scalar_t> tile((int64_t)ks * na * c_in);
+      for (int64_t bp = begin; bp < end; ++bp) {
+        const int64_t bn = bp / np;
+        const int64_t pn = bp % np;
+        const int* neighbors = neighbors_idx + bp * ann;
+        const scalar_t* weights = anchor_weights + bp * na * ks * ann;
+        const scalar_t* feats = support_point_feats + bn * nq * na * c_in;
+        std::fill(tile.begin(), tile.end(), scalar_t(0));
+
+        // most kernel weights are exactly zero (neighbors outside the kernel support)
+        for (int an = 0; an < na; an++) {
+          for (int k = 0; k < ks; k++) {
+            const scalar_t* w = weights + (an * ks + k) * ann;
+            scalar_t* dst = tile.data() + ((int64_t)k * na + an) * c_in;
+            for (int ni = 0; ni < ann; ni++) {
+              const scalar_t wn = w[ni];
+              if (wn == 0)
+                continue;
+              const scalar_t* src = feats + ((int64_t)neighbors[ni] * na + an) * c_in;
+              for (int ci = 0; ci < c_in; ci++) {
+                dst[ci] += wn * src[ci];
+              }
+            }
+          }
+        }
+
+        // [ks, na, c_in] -> anchor_feats[bn, :, :, pn, :]
+        for (int ci = 0; ci < c_in; ci++) {
+          for (int k = 0; k < ks; k++) {
+            scalar_t* out = anchor_feats + (((bn * c_in + ci) * ks + k) * np + pn) * na;
+            const scalar_t* src = tile.data() + (int64_t)k * na * c_in + ci;
+            for (int an = 0; an < na; an++) {
+              out[an] = src[(int64_t)an * c_in];
+            }
+          }
+        }
+      }
+    });
+}
+
+
+template <typename scalar_t>
+void fused_conv_backward_cpu_kernel(
+    const int* __restrict__ neighbors_idx,             // [b, np, ann]
+    const scalar_t* __restrict__ anchor_weights,       // [b, np, na, ks, ann]
+    const scalar_t* __restrict__ grad_anchor_feats,    // [b, np, ks, na, c_in]
+    scalar_t* __restrict__ grad_support_point_feats,   // [b, nq, na, c_in]
+    int nb, int np, int nq, int na, int ks, int ann, int c_in) {
+
+    const int n_block = (c_in + CHANNEL_BLOCK - 1) / CHANNEL_BLOCK;
+
+    at::parallel_for(0, (int64_t)nb * n_block, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const int64_t bn = bc / n_block;
+        const int c0 = (bc % n_block) * CHANNEL_BLOCK;
+        const int c1 = std::min(c0 + CHANNEL_BLOCK, c_in);
+        scalar_t* grad_feats = grad_support_point_feats + bn * nq * na * c_in;
+
+        for (int pn = 0; pn < np; pn++) {
+          const int64_t bp = bn * np + pn;
+          const int* neighbors = neighbors_idx + bp * ann;
+          const scalar_t* weights = anchor_weights + bp * na * ks * ann;
+          const scalar_t* grad = grad_anchor_feats + bp * ks * na * c_in;
+          for (int ni = 0; ni < ann; ni++) {
+            scalar_t* dst_point = grad_feats + (int64_t)neighbors[ni] * na * c_in;
+            for (int an = 0; an < na; an++) {
+              scalar_t* dst = dst_point + (int64_t)an * c_in;
+              for (int k = 0; k < ks; k++) {
+                const scalar_t w = weights[(an * ks + k) * ann + ni];
+                if (w == 0)
+                  continue;
+                const scalar_t* src = grad + ((int64_t)k * na + an) * c_in;
+                for (int ci = c0; ci < c1; ci++) {
+                  dst[ci] += w * src[ci];
+                }
+              }
+            }
+          }
+        }
+      }
+    });
+}
+
+// IntraZPConv Grouping
+// the anchor neighborhood is shared by all points, each task owns one
+// (batch, channel) slice
+template <typename scalar_t>
+void intraspherical_conv_forward_cpu_kernel(
+    const int* __restrict__ anchor_neighbors,         // [na_out, ann]
+    const scalar_t* __restrict__ anchor_weights,      // [na_out, ks, ann]
+    const scalar_t* __restrict__ support_point_feats, // [b, c_in, np, na_in]
+    scalar_t* __restrict__ anchor_feats,              // [b, c_in, ks, np, na_out]
+    int nb, int np, int na_in, int na_out, int ks, int ann, int c_in) {
+
+    at::parallel_for(0, (int64_t)nb * c_in, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const scalar_t* feats = support_point_feats + bc * np * na_in;
+        scalar_t* out = anchor_feats + bc * ks * np * na_out;
+        for (int pn = 0; pn < np; pn++) {
+          const scalar_t* feat = feats + (int64_t)pn * na_in;
+          for (int k = 0; k < ks; k++) {
+            scalar_t* dst = out + ((int64_t)k * np + pn) * na_out;
+            for (int an = 0; an < na_out; an++) {
+              const int* neighbors = anchor_neighbors + an * ann;
+              const scalar_t* weights = anchor_weights + (an * ks + k) * ann;
+              scalar_t acc = 0;
+              for (int ni = 0; ni < ann; ni++) {
+                acc += weights[ni] * feat[neighbors[ni]];
+              }
+              dst[an] += acc;
+            }
+          }
+        }
+      }
+    });
+}
+
+
+template <typename scalar_t>
+void intraspherical_conv_backward_cpu_kernel(
+    const int* __restrict__ anchor_neighbors,        // [na_out, ann]
+    const scalar_t* __restrict__ anchor_weights,     // [na_out, ks, ann]
+    const scalar_t* __restrict__ grad_anchor_feats,  // [b, c_in, ks, np, na_out]
+    scalar_t* __restrict__ grad_support_point_feats, // [b, c_in, np, na_in]
+    int nb, int np, int na_in, int na_out, int ks, int ann, int c_in) {
+
+    at::parallel_for(0, (int64_t)nb * c_in, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t bc = begin; bc < end; ++bc) {
+        const scalar_t* grad = grad_anchor_feats + bc * ks * np * na_out;
+        scalar_t* grad_feats = grad_support_point_feats + bc * np * na_in;
+        for (int pn = 0; pn < np; pn++) {
+          scalar_t* grad_feat = grad_feats + (int64_t)pn * na_in;
+          for (int k = 0; k < ks; k++) {
+            const scalar_t* src = grad + ((int64_t)k * np + pn) * na_out;
+            for (int an = 0; an < na_out; an++) {
+              const int* neighbors = anchor_neighbors + an * ann;
+              const scalar_t* weights = anchor_weights + (an * ks + k) * ann;
+              const scalar_t g = src[an];
+              for (int ni = 0; ni < ann; ni++) {
+                grad_feat[neighbors[ni]] += weights[ni] * g;
+              }
+            }
+          }
+        }
+      }
+    });
+}
+
+
+at::Tensor inter_zpconv_forward(
+    at::Tensor anchor_neighbors, // [b, np, na, ks, ann]
+    at::Tensor anchor_weights,  // [b, np, na, ks, ann]
+    at::Tensor support_point_feats // [b, c_in, nq, na]
+    ) {
+  CHECK_INPUT(anchor_neighbors);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(support_point_feats);
+
+  const int nb = anchor_neighbors.size(0);
+  const int np = anchor_neighbors.size(1);
+  const int na = anchor_neighbors.size(2);
+  const int ks = anchor_neighbors.size(3);
+  const int ann = anchor_neighbors.size(4);
+  const int c_in = support_point_feats.size(1);
+  const int nq = support_point_feats.size(2);
+
+  // channel-last layouts: [b, nq, na, c_in] -> [b, np, ks, na, c_in]
+  at::Tensor feats_t = support_point_feats.permute({0, 2, 3, 1}).contiguous();
+  at::Tensor anchor_feats_t = torch::zeros({nb, np, ks, na, c_in},
+    at::device(support_point_feats.device()).dtype(support_point_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(support_point_feats.scalar_type(), "inter_zpconv_forward_cpu", ([&] {
+    spherical_conv_forward_cpu_kernel<scalar_t>(
+        anchor_neighbors.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        feats_t.data_ptr<scalar_t>(),
+        anchor_feats_t.data_ptr<scalar_t>(),
+        nb, np, nq, na, ks, ann, c_in);
+  }));
+
+  // output: [b, c_in, ks, np, na]
+  return anchor_feats_t.permute({0, 4, 2, 1, 3}).contiguous();
+}
+
+at::Tensor inter_zpconv_backward(
+    at::Tensor anchor_neighbors, // [b, np, na, ks, ann]
+    at::Tensor anchor_weights,  // [b, np, na, ks, ann]
+    at::Tensor grad_anchor_feats, // [b, c_in, ks, np, na]
+    const int npoint
+    ) {
+  CHECK_INPUT(anchor_neighbors);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(grad_anchor_feats);
+
+  const int nb = anchor_neighbors.size(0);
+  const int np = anchor_neighbors.size(1);
+  const int na = anchor_neighbors.size(2);
+  const int ks = anchor_neighbors.size(3);
+  const int ann = anchor_neighbors.size(4);
+  const int c_in = grad_anchor_feats.size(1);
+
+  // channel-last layouts: [b, np, ks, na, c_in] -> [b, nq, na, c_in]
+  at::Tensor grad_t = grad_anchor_feats.permute({0, 3, 2, 4, 1}).contiguous();
+  at::Tensor grad_support_point_feats_t = torch::zeros({nb, npoint, na, c_in},
+    at::device(grad_anchor_feats.device()).dtype(grad_anchor_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(grad_anchor_feats.scalar_type(), "inter_zpconv_backward_cpu", ([&] {
+    spherical_conv_backward_cpu_kernel<scalar_t>(
+        anchor_neighbors.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        grad_t.data_ptr<scalar_t>(),
+        grad_support_point_feats_t.data_ptr<scalar_t>(),
+        nb, np, npoint, na, ks, ann, c_in);
+  }));
+
+  // output: [b, c_in, nq, na]
+  return grad_support_point_feats_t.permute({0, 3, 1, 2}).contiguous();
+}
+
+at::Tensor inter_zpconv_fused_forward(
+    at::Tensor neighbors_idx, // [b, np, ann]
+    at::Tensor anchor_weights,  // [b, np, na, ks, ann]
+    at::Tensor support_point_feats // [b, c_in, nq, na]
+    ) {
+  CHECK_INPUT(neighbors_idx);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(support_point_feats);
+
+  const int nb = anchor_weights.size(0);
+  const int np = anchor_weights.size(1);
+  const int na = anchor_weights.size(2);
+  const int ks = anchor_weights.size(3);
+  const int ann = anchor_weights.size(4);
+  const int c_in = support_point_feats.size(1);
+  const int nq = support_point_feats.size(2);
+  TORCH_CHECK(neighbors_idx.size(1) == np && neighbors_idx.size(2) == ann,
+              "neighbors_idx must be [b, np, ann] matching anchor_weights [b, np, na, ks, ann]");
+
+  // channel-last input: [b, nq, na, c_in]
+  at::Tensor feats_t = support_point_feats.permute({0, 2, 3, 1}).contiguous();
+  at::Tensor anchor_feats = torch::empty({nb, c_in, ks, np, na},
+    at::device(support_point_feats.device()).dtype(support_point_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(support_point_feats.scalar_type(), "inter_zpconv_fused_forward_cpu", ([&] {
+    fused_conv_forward_cpu_kernel<scalar_t>(
+        neighbors_idx.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        feats_t.data_ptr<scalar_t>(),
+        anchor_feats.data_ptr<scalar_t>(),
+        nb, np, nq, na, ks, ann, c_in);
+  }));
+
+  return anchor_feats;
+}
+
+at::Tensor inter_zpconv_fused_backward(
+    at::Tensor neighbors_idx, // [b, np, ann]
+    at::Tensor anchor_weights,  // [b, np, na, ks, ann]
+    at::Tensor grad_anchor_feats, // [b, c_in, ks, np, na]
+    const int npoint
+    ) {
+  CHECK_INPUT(neighbors_idx);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(grad_anchor_feats);
+
+  const int nb = anchor_weights.size(0);
+  const int np = anchor_weights.size(1);
+  const int na = anchor_weights.size(2);
+  const int ks = anchor_weights.size(3);
+  const int ann = anchor_weights.size(4);
+  const int c_in = grad_anchor_feats.size(1);
+
+  // channel-last layouts: [b, np, ks, na, c_in] -> [b, nq, na, c_in]
+  at::Tensor grad_t = grad_anchor_feats.permute({0, 3, 2, 4, 1}).contiguous();
+  at::Tensor grad_support_point_feats_t = torch::zeros({nb, npoint, na, c_in},
+    at::device(grad_anchor_feats.device()).dtype(grad_anchor_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(grad_anchor_feats.scalar_type(), "inter_zpconv_fused_backward_cpu", ([&] {
+    fused_conv_backward_cpu_kernel<scalar_t>(
+        neighbors_idx.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        grad_t.data_ptr<scalar_t>(),
+        grad_support_point_feats_t.data_ptr<scalar_t>(),
+        nb, np, npoint, na, ks, ann, c_in);
+  }));
+
+  // output: [b, c_in, nq, na]
+  return grad_support_point_feats_t.permute({0, 3, 1, 2}).contiguous();
+}
+
+at::Tensor intra_zpconv_forward(
+    at::Tensor anchor_neighbors, // [na_out, ann]
+    at::Tensor anchor_weights,  // [na_out, ks, ann]
+    at::Tensor support_point_feats // [b, c_in, np, na_in]
+    ) {
+  CHECK_INPUT(anchor_neighbors);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(support_point_feats);
+
+  // output: [b, c_in, ks, np, na_out]
+  at::Tensor anchor_feats = torch::zeros({support_point_feats.size(0), support_point_feats.size(1), anchor_weights.size(1),
+    support_point_feats.size(2), anchor_neighbors.size(0)},
+    at::device(support_point_feats.device()).dtype(support_point_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(support_point_feats.scalar_type(), "intra_zpconv_forward_cpu", ([&] {
+    intraspherical_conv_forward_cpu_kernel<scalar_t>(
+        anchor_neighbors.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        support_point_feats.data_ptr<scalar_t>(),
+        anchor_feats.data_ptr<scalar_t>(),
+        support_point_feats.size(0), support_point_feats.size(2), support_point_feats.size(3),
+        anchor_neighbors.size(0), anchor_weights.size(1), anchor_neighbors.size(1),
+        support_point_feats.size(1));
+  }));
+
+  return anchor_feats;
+}
+
+at::Tensor intra_zpconv_backward(
+    at::Tensor anchor_neighbors, // [na_out, ann]
+    at::Tensor anchor_weights,  // [na_out, ks, ann]
+    at::Tensor grad_anchor_feats, // [b, c_in, ks, np, na_out]
+    const int anchor_in
+    ) {
+  CHECK_INPUT(anchor_neighbors);
+  CHECK_INPUT(anchor_weights);
+  CHECK_INPUT(grad_anchor_feats);
+
+  // output: [b, c_in, np, na_in]
+  at::Tensor grad_support_point_feats = torch::zeros({grad_anchor_feats.size(0), grad_anchor_feats.size(1),
+    grad_anchor_feats.size(3), anchor_in},
+    at::device(grad_anchor_feats.device()).dtype(grad_anchor_feats.dtype()));
+
+  AT_DISPATCH_FLOATING_TYPES(grad_anchor_feats.scalar_type(), "intra_zpconv_backward_cpu", ([&] {
+    intraspherical_conv_backward_cpu_kernel<scalar_t>(
+        anchor_neighbors.data_ptr<int>(),
+        anchor_weights.data_ptr<scalar_t>(),
+        grad_anchor_feats.data_ptr<scalar_t>(),
+        grad_support_point_feats.data_ptr<scalar_t>(),
+        grad_anchor_feats.size(0), grad_anchor_feats.size(3), anchor_in,
+        anchor_neighbors.size(0), anchor_weights.size(1), anchor_neighbors.size(1),
+        grad_anchor_feats.size(1));
+  }));
+
+  return grad_support_point_feats;
+}
+
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("inter_zpconv_forward", &inter_zpconv_forward, "inter conv forward (CPU)");
+  m.def("inter_zpconv_backward", &inter_zpconv_backward, "inter conv backward (CPU)");
+  m.def("inter_zpconv_fused_forward", &inter_zpconv_fused_forward, "fused inter conv forward (CPU)");
+  m.def("inter_zpconv_fused_backward", &inter_zpconv_fused_backward, "fused inter conv backward (CPU)");
+  m.def("intra_zpconv_forward", &intra_zpconv_forward, "intra conv forward (CPU)");
+  m.def("intra_zpconv_backward", &intra_zpconv_backward, "intra conv backward (CPU)");
+}
@@ -0,0 +1,5 @@
+from vgtk.so3conv.anchors import ANCHOR_TABLE_PATH, save_anchor_table
+
+# regenerate the shipped anchor table: python -m vgtk.data.anchors
+table = save_anchor_table()
+print(f'Wrote {ANCHOR_TABLE_PATH}: ' + ', '.join(f'{k} {None if v is None else v.shape}' for k, v in table.items()))
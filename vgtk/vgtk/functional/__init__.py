@@ -1 +1,2 @@
-from .rotation import *
\ No newline at end of file
+from .rotation import *
+from .matching import *
@@ -0,0 +1,79 @@
+import torch
+
+'''
+Exact nearest neighbor / mutual nearest neighbor matching of descriptor sets by
+blocked matrix multiplies (cpu threads or gpu), for one pair or a batch of pairs.
+
+The squared distances ||a||^2 - 2 a.b + ||b||^2 are computed in float64 by
+default, so that the matches agree with a KDTree on float32 descriptors up to
+exact ties.
+'''
+
+
+def _as_batch(x, dtype):
+    x = torch.as_tensor(x)
+    batched = x.dim() == 3
+    x = x if batched else x.unsqueeze(0)
+    return x.to(dtype), batched
+
+
+def _blocked_min(query, support, block_size, with_columns=False):
+    '''
+    query: [b, n, d], support: [b, m, d]
+    return: row-wise min distance / argmin [b, n] and, if with_columns, the
+            column-wise ones [b, m], evaluating block_size rows at a time
+    '''
+    b, n, _ = query.shape
+    m = support.shape[1]
+    sq_support = (support**2).sum(-1).unsqueeze(1)
+    row_dist = query.new_empty(b, n)
+    row_idx = torch.empty(b, n, dtype=torch.long, device=query.device)
+    if with_columns:
+        col_dist = query.new_full((b, m), float('inf'))
+        col_idx = torch.zeros(b, m, dtype=torch.long, device=query.device)
+    for start in range(0, n, block_size):
+        q = query[:, start:start + block_size]
+        # [b, nq, m]
+        dist = torch.baddbmm(sq_support, q, support.transpose(1, 2), alpha=-2)
+        dist += (q**2).sum(-1, keepdim=True)
+        row_dist[:, start:start + q.shape[1]], row_idx[:, start:start + q.shape[1]] = dist.min(2)
+        if with_columns:
+            block_dist, block_idx = dist.min(1)
+            # strict: the first row of equal distance is kept, as in a single min
+            update = block_dist < col_dist
+            col_dist = torch.where(update, block_dist, col_dist)
+            col_idx = torch.where(update, block_idx + start, col_idx)
+    if with_columns:
+        return row_dist, row_idx, col_dist, col_idx
+    return row_dist, row_idx
+
+
+def nearest_neighbor(query, support, block_size=2048, dtype=torch.float64):
+    '''
+    query: [n, d] or [b, n, d], support: [m, d] or [b, m, d]
+    return: squared distances and indices in support of the nearest neighbor of each query, [n] or [b, n]
+    '''
+    query, batched = _as_batch(query, dtype)
+    support, _ = _as_batch(support, dtype)
+    dist, idx = _blocked_min(query, support.to(query.device), block_size)
+    return (dist, idx) if batched else (dist[0], idx[0])
+
+
+def mutual_nearest_neighbor(src, tgt, block_size=2048, dtype=torch.float64):
+    '''
+    src: [n, d] or [b, n, d], tgt: [m, d] or [b, m, d] descriptors (b fragment pairs)
+    return: src_tgt_nn_ids [(b,) n] (nearest tgt of each src), tgt_src_nn_ids [(b,) m]
+            (nearest src of each tgt) and mutual [(b,) m], true where the nearest
+            src of a tgt has this tgt as nearest neighbor:
+            mutual = src_tgt_nn_ids[tgt_src_nn_ids] == arange(m)
+    '''
+    src, batched = _as_batch(src, dtype)
+    tgt, _ = _as_batch(tgt, dtype)
+    tgt = tgt.to(src.device)
+    # a single distance matrix for both directions
+    _, src_tgt_nn_ids, _, tgt_src_nn_ids = _blocked_min(src, tgt, block_size, with_columns=True)
+    mutual = torch.gather(src_tgt_nn_ids, 1, tgt_src_nn_ids) == \
+        torch.arange(tgt.shape[1], device=src.device).unsqueeze(0)
+    if not batched:
+        return src_tgt_nn_ids[0], tgt_src_nn_ids[0], mutual[0]
+    return src_tgt_nn_ids, tgt_src_nn_ids, mutual
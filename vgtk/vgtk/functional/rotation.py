@@ -1,5 +1,4 @@
 import numpy as np
-import trimesh
 from scipy.spatial.transform import Rotation as sciR
 
 
@@ -240,6 +239,7 @@ def icosahedron_so3_trimesh(mesh_path, gsize=3, use_quats=False):
     # 20 faces, 12 vertices
     # root = vgtk.__path__[0]
     # mesh_path = os.path.join(root, 'data', 'anchors/sphere12.ply')
+    import trimesh
     mesh = trimesh.load(mesh_path)
     mesh.fix_normals()
     face_idx = mesh.faces
@@ -353,23 +353,13 @@ def icosahedron_so3_trimesh(mesh_path, gsize=3, use_quats=False):
 def rotation_distance_np(r0, r1):
     '''
     tip: r1 is usally the anchors
+    r0: [3, 3] or [nb, 3, 3], r1: [na, 3, 3]
+    return: traces [(nb,) na] of the relative rotations r1^T r0 (higher is closer),
+            nearest index in r1 [(nb,)] and the relative rotations [(nb,) na, 3, 3]
     '''
-    if r0.ndim == 3:
-        bidx = np.zeros(r0.shape[0]).astype(np.int32)
-        traces = np.zeros([r0.shape[0], r1.shape[0]]).astype(np.int32)
-        for bi in range(r0.shape[0]):
-            diff_r = np.matmul(r1, r0[bi].T)
-            traces[bi] = np.einsum('bii->b', diff_r)
-            bidx[bi] = np.argmax(traces[bi])
-        return traces, bidx
-    else:
-        # diff_r = np.matmul(r0, r1.T)
-        # return np.einsum('ii', diff_r)
-
-        diff_r = np.matmul(np.transpose(r1,(0,2,1)), r0)
-        traces = np.einsum('bii->b', diff_r)
-
-        return traces, np.argmax(traces), diff_r
+    diff_r = np.matmul(np.swapaxes(r1, -1, -2), r0[..., None, :, :])
+    traces = np.einsum('...aii->...a', diff_r)
+    return traces, np.argmax(traces, axis=-1), diff_r
 
 
 '''
@@ -420,6 +410,14 @@ def compute_rotation_matrix_from_quaternion(quaternion):
     return matrix
 
 
+# uniformly distributed random rotations: normalized gaussian quaternions -> [nb, 3, 3]
+def random_rotation_matrix(nb, device=None, dtype=torch.float32):
+    qw, qx, qy, qz = torch.nn.functional.normalize(torch.randn(nb, 4, device=device, dtype=dtype), dim=1).unbind(1)
+    return torch.stack([1-2*(qy*qy+qz*qz), 2*(qx*qy-qz*qw), 2*(qx*qz+qy*qw),
+                        2*(qx*qy+qz*qw), 1-2*(qx*qx+qz*qz), 2*(qy*qz-qx*qw),
+                        2*(qx*qz-qy*qw), 2*(qy*qz+qx*qw), 1-2*(qx*qx+qy*qy)], 1).view(nb, 3, 3)
+
+
 #euler_sin_cos batch*6
 #output cuda batch*3*3 matrices in the rotation order of XZ'Y'' (intrinsic) or YZX (extrinsic)
 def compute_rotation_matrix_from_euler_sin_cos(euler_sin_cos):
@@ -522,8 +520,36 @@ def so3_mean(Rs, weights=None):
 
 
 def label_relative_rotation_np(anchors, T):
-    T_from_anchors = np.einsum('abc,bj,ijk -> aick', anchors, T, anchors)
-    label = np.argmax(np.einsum('abii->ab', T_from_anchors),axis=1)
-    idxs = np.vstack([np.arange(label.shape[0]), label]).T
-    R_target = T_from_anchors[idxs[:,0], idxs[:,1]]
-    return R_target, label
\ No newline at end of file
+    '''
+    anchors: [na, 3, 3], T: [3, 3] or [nb, 3, 3]
+    return: R_target [(nb,) na, 3, 3], the relative rotations A_a^T T A_label[a] closest to identity,
+            and label [(nb,) na]
+    '''
+    T_from_anchor = np.einsum('abc,...bj->...acj', anchors, T)
+    # trace(A_a^T T A_i), without forming all the na x na products
+    traces = np.einsum('...akl,ilk->...ai', T_from_anchor, anchors)
+    label = np.argmax(traces, axis=-1)
+    R_target = np.matmul(T_from_anchor, anchors[label])
+    return R_target, label
+
+
+# torch counterparts of rotation_distance_np and label_relative_rotation_np (batched, on device)
+def rotation_distance(r0, r1):
+    '''
+    r0: [(nb,) 3, 3], r1: [na, 3, 3]
+    return: traces [(nb,) na], nearest index [(nb,)], relative rotations r1^T r0 [(nb,) na, 3, 3]
+    '''
+    diff_r = torch.einsum('aji,...jk->...aik', r1, r0)
+    traces = diff_r.diagonal(dim1=-2, dim2=-1).sum(-1)
+    return traces, traces.argmax(-1), diff_r
+
+def label_relative_rotation(anchors, T):
+    '''
+    anchors: [na, 3, 3], T: [(nb,) 3, 3]
+    return: R_target [(nb,) na, 3, 3], label [(nb,) na]
+    '''
+    T_from_anchor = torch.einsum('abc,...bj->...acj', anchors, T)
+    traces = torch.einsum('...akl,ilk->...ai', T_from_anchor, anchors)
+    label = traces.argmax(-1)
+    R_target = torch.matmul(T_from_anchor, anchors[label])
+    return R_target, label
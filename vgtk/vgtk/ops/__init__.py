@@ -0,0 +1,149 @@
+'''
+Device-dispatch registry for the native point cloud operators.
+
+Operators are registered by name with one import target per backend, e.g.
+
+    register('ball_query', 'cuda', 'vgtk.cuda.grouping:ball_query')
+
+and resolved on first use for the device of the input tensors:
+
+    ops.get('ball_query', xyz.device)(query, xyz, radius, n_sample)
+
+Backends are tried in order (cuda -> torch on gpu, cpu -> torch on cpu), so
+the compiled extensions are only imported when an op is actually called and a
+missing extension falls through to the next implementation.
+'''
+
+import importlib
+import torch
+
+
+# backend search order per device type
+BACKEND_ORDER = {
+    'cuda': ['cuda', 'torch'],
+    'cpu': ['cpu', 'torch'],
+}
+
+_REGISTRY = {}
+_RESOLVED = {}
+_FAILED_MODULES = {}
+
+
+def register(name, backend, target):
+    '''
+    name: op name
+    backend: 'cuda' | 'cpu' | 'torch'
+    target: 'module:attribute' import path or a callable
+    '''
+    _REGISTRY.setdefault(name, {})[backend] = target
+    for key in [k for k in _RESOLVED if k[0] == name]:
+        del _RESOLVED[key]
+
+
+def _device_type(device):
+    if isinstance(device, torch.Tensor):
+        return device.device.type
+    if isinstance(device, str):
+        return torch.device(device).type
+    return device.type
+
+
+def _load(target):
+    if callable(target):
+        return target
+    module_name, attr = target.split(':')
+    if module_name in _FAILED_MODULES:
+        raise _FAILED_MODULES[module_name]
+    try:
+        module = importlib.import_module(module_name)
+    except (ImportError, OSError) as e:
+        _FAILED_MODULES[module_name] = ImportError(f'{module_name}: {e}')
+        raise _FAILED_MODULES[module_name]
+    return getattr(module, attr)
+
+
+def _candidates(name, device_type, backend):
+    if name not in _REGISTRY:
+        raise KeyError(f'Op {name} is not registered')
+    if backend is not None:
+        return [backend]
+    return BACKEND_ORDER.get(device_type, ['torch'])
+
+
+def get(name, device, backend=None):
+    '''
+    resolve op name for a device (torch.device, device string or tensor),
+    optionally forcing a backend
+    '''
+    device_type = _device_type(device)
+    key = (name, device_type, backend)
+    if key in _RESOLVED:
+        return _RESOLVED[key]
+
+    errors = []
+    for candidate in _candidates(name, device_type, backend):
+        target = _REGISTRY[name].get(candidate)
+        if target is None:
+            continue
+        try:
+            fn = _load(target)
+        except ImportError as e:
+            errors.append(str(e))
+            continue
+        _RESOLVED[key] = fn
+        return fn
+
+    msg = f'No implementation of {name} available for device {device_type}'
+    if len(errors) > 0:
+        msg += ' (' + '; '.join(errors) + ')'
+    raise RuntimeError(msg)
+
+
+def available(name, device):
+    '''
+    list the backends of an op that can be loaded for a device
+    '''
+    backends = []
+    for candidate in _candidates(name, _device_type(device), None):
+        target = _REGISTRY[name].get(candidate)
+        if target is None:
+            continue
+        try:
+            _load(target)
+        except ImportError:
+            continue
+        backends.append(candidate)
+    return backends
+
+
+def is_native(name, device):
+    '''
+    whether a compiled (cuda / cpu) implementation is available for a device
+    '''
+    return any(b != 'torch' for b in available(name, device))
+
+
+################################# Registration ##############################
+
+for _op in ['ball_query', 'furthest_point_sampling']:
+    register(_op, 'cuda', f'vgtk.cuda.grouping:{_op}')
+    register(_op, 'cpu', f'vgtk.cpu.grouping:{_op}')
+register('ball_query', 'torch', 'vgtk.pc.sample:ball_query_index_torch')
+register('furthest_point_sampling', 'torch', 'vgtk.pc.sample:furthest_point_sampling_torch')
+
+register('initial_anchor_query', 'cuda', 'vgtk.cuda.grouping:initial_anchor_query')
+
+for _op in ['gather_points_forward', 'gather_points_backward']:
+    register(_op, 'cuda', f'vgtk.cuda.gathering:{_op}')
+    register(_op, 'cpu', f'vgtk.cpu.gathering:{_op}')
+    register(_op, 'torch', f'vgtk.ops.torch_ops:{_op}')
+
+# gather + contract with a neighborhood shared by all anchors (no grouped features)
+for _op in ['inter_zpconv_fused_forward', 'inter_zpconv_fused_backward']:
+    register(_op, 'cpu', f'vgtk.cpu.zpconv:{_op}')
+
+for _op in ['inter_zpconv_forward', 'inter_zpconv_backward',
+            'intra_zpconv_forward', 'intra_zpconv_backward']:
+    register(_op, 'cuda', f'vgtk.cuda.zpconv:{_op}')
+    register(_op, 'cpu', f'vgtk.cpu.zpconv:{_op}')
+    register(_op, 'torch', f'vgtk.ops.torch_ops:{_op}')
@@ -0,0 +1,104 @@
+import torch
+
+'''
+Pure pytorch implementations of the native operators, used when no compiled
+extension is available for a device. Signatures and output layouts follow the
+bindings in vgtk/cuda and vgtk/cpu.
+'''
+
+
+################################# Gathering ##############################
+
+# [nb, c_in, n] x [nb, m] -> [nb, c_in, m]
+def gather_points_forward(support_points, grouped_indices):
+    b, c, _ = support_points.shape
+    idx = grouped_indices.long().unsqueeze(1).expand(-1, c, -1)
+    return torch.gather(support_points, 2, idx).float()
+
+# [nb, c_in, m] x [nb, m] -> [nb, c_in, npoint]
+def gather_points_backward(grad_out, grouped_indices, npoint):
+    b, c, _ = grad_out.shape
+    idx = grouped_indices.long().unsqueeze(1).expand(-1, c, -1)
+    grad_points = grad_out.new_zeros(b, c, npoint)
+    return grad_points.scatter_add_(2, idx, grad_out)
+
+
+################################# Inter ZPConv ##############################
+
+# flat index into channel-last features [b, nq*na, c]
+def _inter_flat_index(anchor_neighbors, k):
+    b, p, a, ks, ann = anchor_neighbors.shape
+    anchor_range = torch.arange(a, device=anchor_neighbors.device).view(1, 1, a, 1)
+    return (anchor_neighbors[:, :, :, k].long() * a + anchor_range).view(b, -1)
+
+
+def inter_zpconv_forward(anchor_neighbors, anchor_weights, support_point_feats):
+    '''
+    anchor_neighbors:       [b, np, na, ks, ann]
+    anchor_weights:         [b, np, na, ks, ann]
+    support_point_feats:    [b, c_in, nq, na]
+    return:                 [b, c_in, ks, np, na]
+    '''
+    b, p, a, ks, ann = anchor_neighbors.shape
+    c = support_point_feats.shape[1]
+    feats = support_point_feats.permute(0, 2, 3, 1).reshape(b, -1, c)
+
+    # one kernel point at a time to bound the gathered buffer
+    anchor_feats = []
+    for k in range(ks):
+        idx = _inter_flat_index(anchor_neighbors, k)
+        grouped = batched_gather(feats, idx).view(b, p, a, ann, c)
+        grouped = (grouped * anchor_weights[:, :, :, k, :, None]).sum(3)
+        anchor_feats.append(grouped.permute(0, 3, 1, 2))
+    return torch.stack(anchor_feats, 2).contiguous()
+
+
+def inter_zpconv_backward(anchor_neighbors, anchor_weights, grad_anchor_feats, npoint):
+    '''
+    grad_anchor_feats:      [b, c_in, ks, np, na]
+    return:                 [b, c_in, npoint, na]
+    '''
+    b, p, a, ks, ann = anchor_neighbors.shape
+    c = grad_anchor_feats.shape[1]
+    grad_feats = grad_anchor_feats.new_zeros(b, npoint * a, c)
+
+    for k in range(ks):
+        idx = _inter_flat_index(anchor_neighbors, k)
+        # [b, np, na, 1, c] x [b, np, na, ann, 1]
+        grad = grad_anchor_feats[:, :, k].permute(0, 2, 3, 1).unsqueeze(3) * \
+               anchor_weights[:, :, :, k, :, None]
+        grad_feats.scatter_add_(1, idx.unsqueeze(2).expand(-1, -1, c), grad.reshape(b, -1, c))
+    return grad_feats.view(b, npoint, a, c).permute(0, 3, 1, 2).contiguous()
+
+
+def batched_gather(x, idx):
+    '''
+    x: [b, n, c], idx: [b, m] -> [b, m, c]
+    '''
+    return torch.gather(x, 1, idx.unsqueeze(2).expand(-1, -1, x.shape[2]))
+
+
+################################# Intra ZPConv ##############################
+
+def intra_zpconv_forward(anchor_neighbors, anchor_weights, support_point_feats):
+    '''
+    anchor_neighbors:       [na_out, ann]
+    anchor_weights:         [na_out, ks, ann]
+    support_point_feats:    [b, c_in, np, na_in]
+    return:                 [b, c_in, ks, np, na_out]
+    '''
+    a, ks, ann = anchor_weights.shape
+    b, c, p, _ = support_point_feats.shape
+    grouped = torch.index_select(support_point_feats, 3, anchor_neighbors.long().view(-1)).view(b, c, p, a, ann)
+    return torch.einsum('bcpan,akn->bckpa', grouped, anchor_weights).contiguous()
+
+
+def intra_zpconv_backward(anchor_neighbors, anchor_weights, grad_anchor_feats, anchor_in):
+    '''
+    grad_anchor_feats:      [b, c_in, ks, np, na_out]
+    return:                 [b, c_in, np, na_in]
+    '''
+    b, c, ks, p, a = grad_anchor_feats.shape
+    grad = torch.einsum('bckpa,akn->bcpan', grad_anchor_feats, anchor_weights).reshape(b, c, p, -1)
+    grad_feats = grad_anchor_feats.new_zeros(b, c, p, anchor_in)
+    return grad_feats.index_add_(3, anchor_neighbors.long().view(-1), grad)
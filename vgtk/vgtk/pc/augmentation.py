@@ -204,8 +204,8 @@ def jitter_point_cloud(data, sigma=0.01, clip=0.05):
     return jittered_data
 
 
-from sklearn.neighbors import NearestNeighbors as nnbrs
 def crop_point_cloud(data, k=0.05):
+  from sklearn.neighbors import NearestNeighbors as nnbrs
   N, C = data.shape
 
   crop_center = data[np.random.randint(N)]
@@ -3,9 +3,54 @@ import numpy as np
 from plyfile import PlyElement, PlyData
 
 
+# ply scalar types -> little endian numpy types
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': '<i2', 'int16': '<i2', 'ushort': '<u2', 'uint16': '<u2',
+             'int': '<i4', 'int32': '<i4', 'uint': '<u4', 'uint32': '<u4',
+             'float': '<f4', 'float32': '<f4', 'double': '<f8', 'float64': '<f8'}
+
+
+def _read_binary_vertices(file_name):
+    '''
+    memory-map the vertex element of a binary little endian ply file
+    return None if the file is not in that format (or the vertex element is not
+    the first one, or has list properties), so that the caller falls back to plyfile
+    '''
+    with open(file_name, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            return None
+        header = []
+        while True:
+            line = f.readline()
+            if not line:
+                return None
+            line = line.decode('ascii', errors='replace').split()
+            if len(line) == 0 or line[0] in ['comment', 'obj_info']:
+                continue
+            if line[0] == 'end_header':
+                break
+            header.append(line)
+        offset = f.tell()
+
+    if len(header) < 2 or header[0][:2] != ['format', 'binary_little_endian'] \
+            or header[1][:2] != ['element', 'vertex']:
+        return None
+    n_vertex = int(header[1][2])
+    fields = []
+    for line in header[2:]:
+        if line[0] != 'property':
+            break
+        if line[1] == 'list' or line[1] not in PLY_TYPES:
+            return None
+        fields.append((line[2], PLY_TYPES[line[1]]))
+    return np.memmap(file_name, dtype=np.dtype(fields), mode='r', offset=offset, shape=(n_vertex,))
+
+
 def load_ply(file_name, with_faces=False, with_color=False, with_normal=False):
-    ply_data = PlyData.read(file_name)
-    vertices = ply_data['vertex']
+    vertices = None if with_faces else _read_binary_vertices(file_name)
+    if vertices is None:
+        ply_data = PlyData.read(file_name)
+        vertices = ply_data['vertex']
     points = np.vstack([vertices['x'], vertices['y'], vertices['z']]).T
     ret_val = [points]
 
@@ -14,9 +59,9 @@ def load_ply(file_name, with_faces=False, with_color=False, with_normal=False):
         ret_val.append(faces)
 
     if with_color:
-        r = np.vstack(ply_data['vertex']['red'])
-        g = np.vstack(ply_data['vertex']['green'])
-        b = np.vstack(ply_data['vertex']['blue'])
+        r = np.vstack(vertices['red'])
+        g = np.vstack(vertices['green'])
+        b = np.vstack(vertices['blue'])
         color = np.hstack((r, g, b))
         ret_val.append(color)
 
@@ -31,20 +76,16 @@ def load_ply(file_name, with_faces=False, with_color=False, with_normal=False):
     return (pc, normals) if with_normal else pc
 
 
-
-def save_ply(filepath, color_pc, c=None, use_color=False, use_normal=False, verbose=False):
+def save_ply(filepath, color_pc, c=None, use_color=False, use_normal=False, verbose=False, binary=True):
+    '''
+    color_pc: [n, 3 (+3 normal) (+3 color | +1 intensity)] points
+    c: 'r' | 'g' | 'b' | [r, g, b] uniform color (scaled by the intensity if given)
+    binary: write a binary little endian body in one shot, else "%.4f" ascii
+    '''
     # if verbose:
     #     print("Writing color pointcloud to: ", filepath)
-    
-    f = open(filepath, 'w')
-    f.write("ply\n")
-    f.write("format ascii 1.0\n")
-    f.write('element vertex '+str(int(color_pc.shape[0])) + '\n')
-    f.write('property float x\nproperty float y\nproperty float z\n')
-    if use_normal:
-        f.write('property float nx\nproperty float ny\nproperty float nz\n')
-    f.write('property uchar red\nproperty uchar green\nproperty uchar blue\n')
-    f.write("end_header\n")
+    color_pc = np.asarray(color_pc)
+    n = int(color_pc.shape[0])
 
     if c == 'r':
         color = [255, 0, 0]
@@ -56,38 +97,42 @@ def save_ply(filepath, color_pc, c=None, use_color=False, use_normal=False, verb
         color = c
     else:
         color = [255,255,255]
-    
+
     # default_normal = 0.0
     color_range = range(6,9) if use_normal else range(3,6)
 
-    for i in range(color_pc.shape[0]):
-        #f.write("v")
-        row = list(color_pc[i,:])
-        for j in range(3):
-            f.write("%.4f " % float(row[j]))
-
-        # ---------------- normal ---------------
-        if use_normal:
-            for t in range(3,6):
-                f.write("%.4f " % float(row[t]))
-        # else:
-        #     for t in range(3):
-        #         f.write("%.4f " % float(default_normal))
-
-
-        # ---------------- color ----------------    
-        if use_color:
-            if color_pc.shape[1] == 4:
-                # only intensity provided
-                for t in range(3):
-                    f.write(str(int(color[t] * row[3])) + ' ')
-            else:
-                for t in color_range:
-                    f.write(str(int(row[t])) + ' ')
+    # ---------------- color ----------------
+    if use_color:
+        if color_pc.shape[1] == 4:
+            # only intensity provided
+            colors = np.asarray(color, dtype=np.float64)[None] * color_pc[:, 3:4]
         else:
-            for t in range(3):
-                f.write(str(int(color[t])) + ' ')
-
-        f.write("\n")
-    f.write("\n")
-    f.close()
\ No newline at end of file
+            colors = color_pc[:, color_range[0]:color_range[-1]+1]
+    else:
+        colors = np.broadcast_to(np.asarray(color, dtype=np.float64), (n, 3))
+    # truncated toward zero, as int()
+    colors = np.trunc(colors)
+
+    fields = ['x', 'y', 'z'] + (['nx', 'ny', 'nz'] if use_normal else [])
+    columns = [color_pc[:, :len(fields)], colors]
+
+    with open(filepath, 'wb') as f:
+        header = ["ply",
+                  "format binary_little_endian 1.0" if binary else "format ascii 1.0",
+                  'element vertex ' + str(n)]
+        header += ['property float ' + name for name in fields]
+        header += ['property uchar red', 'property uchar green', 'property uchar blue', 'end_header']
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+
+        if binary:
+            vertex = np.empty(n, dtype=[(name, '<f4') for name in fields] +
+                                       [(name, 'u1') for name in ['red', 'green', 'blue']])
+            for i, name in enumerate(fields):
+                vertex[name] = columns[0][:, i]
+            for i, name in enumerate(['red', 'green', 'blue']):
+                vertex[name] = np.clip(columns[1][:, i], 0, 255)
+            vertex.tofile(f)
+        else:
+            fmt = ' '.join(['%.4f'] * len(fields) + ['%d'] * 3) + ' '
+            np.savetxt(f, np.hstack(columns).astype(np.float64), fmt=fmt, newline='\n')
+            f.write(b'\n')
@@ -2,7 +2,8 @@ import time
 import numpy as np
 import torch
 
-import vgtk.cuda.grouping as cuda_nn
+import vgtk.ops as ops
+import vgtk.profiler as profiler
 import vgtk.utils as utils
 
 '''
@@ -36,6 +37,29 @@ def uniform_resample_np(pc, n_sample, label=None, batch=False):
         return idx, pc[idx], label[idx]
 
 
+# batched uniformly random resample (torch)
+# n_points: [nb] number of valid points per (padded) cloud -> [nb, n_sample] long
+def batch_uniform_resample_index(n_points, n_sample):
+    '''
+    as uniform_resample_index_np for every cloud of a batch: a random subset without
+    replacement if the cloud has enough points, else all points plus random repeats
+    '''
+    nb = n_points.shape[0]
+    device = n_points.device
+    n_points = n_points.long()
+    n_max = int(n_points.max())
+
+    # random permutation of the valid points of each cloud (padding sorted last)
+    keys = torch.rand(nb, n_max, device=device)
+    keys.masked_fill_(torch.arange(n_max, device=device)[None] >= n_points[:, None], 2.0)
+    perm = keys.argsort(dim=1)
+
+    slots = torch.arange(n_sample, device=device)
+    repeats = (torch.rand(nb, n_sample, device=device) * n_points[:, None]).long()
+    perm = perm.gather(1, slots.clamp(max=n_max-1)[None].expand(nb, -1))
+    return torch.where(slots[None] < n_points[:, None], perm, repeats)
+
+
 # nearest neighbor
 def knn_index_np(pc, k, batch=False):
     raise NotImplementedError('knn is not implemented')
@@ -51,16 +75,170 @@ def group_nd(pc, idx):
 
 # ball query
 # [b, 3, n] x [b, 3, m] x r x k -> [b, n, k]
-def ball_query_index(query_points, support_points, radius, n_sample):
+# search: 'brute' scans every support point per query, 'grid' buckets the
+# support points in a uniform grid first (same result, near linear in n)
+def ball_query_index(query_points, support_points, radius, n_sample, backend=None, search='brute'):
     # TODO remove permute
     # query_points = query_points.permute(0,2,1).contiguous()
     # support_points = support_points.permute(0,2,1).contiguous()
-    idx = cuda_nn.ball_query(query_points, support_points, radius, n_sample)
+    if search not in ['brute', 'grid']:
+        raise ValueError(f'Not recognized neighbor search {search}')
+    b, _, m = query_points.shape
+    with profiler.record('ball_query', 8 * b * m * support_points.shape[2]) as rec:
+        if search == 'grid':
+            idx = ball_query_index_grid(query_points, support_points, radius, n_sample)
+        else:
+            idx = ops.get('ball_query', support_points.device, backend)(query_points, support_points, radius, n_sample)
+        rec.output(idx)
     return idx
 
 
+# squared distances with the same operation order as the native kernels
+# [b, 3, m] x [b, 3, n] -> [b, m, n]
+def _squared_distance(query_points, support_points):
+    d2 = (query_points[:, 0, :, None] - support_points[:, 0, None, :])**2
+    d2 += (query_points[:, 1, :, None] - support_points[:, 1, None, :])**2
+    d2 += (query_points[:, 2, :, None] - support_points[:, 2, None, :])**2
+    return d2
+
+# pad first-hit indices like ball_query_cuda_kernel: rows with fewer than
+# n_sample - 1 hits repeat their hits cyclically, empty rows stay zero
+# [b, m, k] x [b, m] -> [b, m, k]
+def _pad_ball_query_index(first_idx, count):
+    n_sample = first_idx.shape[-1]
+    slots = torch.arange(n_sample, device=first_idx.device).view(1, 1, -1)
+    count = count.unsqueeze(-1)
+    repeat = (count < n_sample - 1) & (count > 0)
+    src = torch.where(repeat, slots % count.clamp(min=1), slots)
+    idx = torch.gather(first_idx, 2, src)
+    valid = (slots < count) | repeat
+    return torch.where(valid, idx, torch.zeros_like(idx)).int()
+
+def ball_query_index_torch(query_points, support_points, radius, n_sample, chunk_size=None):
+    '''
+    reference ball query in pytorch, matching ball_query_cuda_kernel index for index:
+    the first n_sample support points (in index order) with squared distance
+    below radius**2, padded by repeating the hits
+    query_points: [b, 3, m]
+    support_points: [b, 3, n]
+    chunk_size: number of query points per block, defaults to a ~64MB distance buffer
+    return: [b, m, n_sample] int
+    '''
+    b, _, m = query_points.shape
+    n = support_points.shape[2]
+    if chunk_size is None:
+        chunk_size = max(1, 2**24 // max(1, b * n))
+    # radius**2 is evaluated in single precision as in the kernel
+    radius2 = (torch.tensor(radius, dtype=torch.float32) ** 2).item()
+    k = min(n_sample, n)
+    support_range = torch.arange(n, device=support_points.device)
+
+    idx = []
+    for start in range(0, m, chunk_size):
+        query = query_points[:, :, start:start+chunk_size]
+        within = _squared_distance(query, support_points) < radius2
+        # smallest k indices among the hits, non-hits are keyed past the end
+        key = torch.where(within, support_range, n)
+        first_idx = key.topk(k, dim=2, largest=False, sorted=True)[0]
+        if k < n_sample:
+            first_idx = torch.cat((first_idx, first_idx.new_full((*first_idx.shape[:2], n_sample - k), n)), 2)
+        count = within.sum(2).clamp(max=n_sample)
+        idx.append(_pad_ball_query_index(first_idx, count))
+    return torch.cat(idx, 1).contiguous()
+
+
+# cells are slightly larger than the radius so that any support point within
+# the radius of a query lies in one of the 27 cells around it despite rounding
+GRID_CELL_RATIO = 1.001
+GRID_OFFSETS = torch.stack(torch.meshgrid(*[torch.arange(-1, 2)]*3, indexing='ij'), -1).view(-1, 3)
+
+def ball_query_index_grid(query_points, support_points, radius, n_sample, chunk_size=None):
+    '''
+    grid accelerated ball query with the same output as ball_query_index_torch:
+    support points are bucketed by cell (one sort per batch) and each query
+    only tests the points of the 27 surrounding cells
+    query_points: [b, 3, m]
+    support_points: [b, 3, n]
+    chunk_size: number of query points per block, defaults to ~2**24 candidates
+    return: [b, m, n_sample] int
+    '''
+    b, _, m = query_points.shape
+    n = support_points.shape[2]
+    device = support_points.device
+    radius2 = (torch.tensor(radius, dtype=torch.float32) ** 2).item()
+
+    # cell coordinates relative to the per-batch bounding box of both sets
+    origin = torch.minimum(support_points.min(2)[0], query_points.min(2)[0]).unsqueeze(2)
+    extent = torch.maximum(support_points.max(2)[0], query_points.max(2)[0]).unsqueeze(2) - origin
+    cell = radius * GRID_CELL_RATIO
+    dims = (extent.max(0)[0].view(3) / cell).floor().long() + 1
+    # coarsen far-flung grids so keys fit in int64 (larger cells stay exact)
+    while b * dims.prod().item() >= 2**62:
+        cell *= 2
+        dims = (extent.max(0)[0].view(3) / cell).floor().long() + 1
+
+    def cell_of(points):
+        return ((points - origin) / cell).floor().long().clamp(min=0).minimum(dims.view(1, 3, 1) - 1)
+
+    def key_of(cells, batch):
+        return ((batch * dims[0] + cells[..., 0]) * dims[1] + cells[..., 1]) * dims[2] + cells[..., 2]
+
+    batch_range = torch.arange(b, device=device)
+    support_keys = key_of(cell_of(support_points).permute(0, 2, 1), batch_range.view(b, 1))
+    sorted_keys, order = torch.sort(support_keys.view(-1), stable=True)
+
+    query_cells = cell_of(query_points).permute(0, 2, 1).reshape(-1, 3)
+    query_batch = batch_range.view(b, 1).expand(-1, m).reshape(-1)
+    offsets = GRID_OFFSETS.to(device)
+    flat_query = query_points.permute(0, 2, 1).reshape(-1, 3)
+    flat_support = support_points.permute(0, 2, 1).reshape(-1, 3)
+
+    first_idx = torch.full((b * m, n_sample), n, dtype=torch.long, device=device)
+    count = torch.zeros(b * m, dtype=torch.long, device=device)
+    if chunk_size is None:
+        mean_cell = max(1.0, b * n / max(1, (sorted_keys[1:] != sorted_keys[:-1]).sum().item() + 1))
+        chunk_size = max(1, int(2**24 // (27 * mean_cell)))
+
+    for start in range(0, b * m, chunk_size):
+        qi = torch.arange(start, min(start + chunk_size, b * m), device=device)
+        # [q, 27] neighbor cells, out of range cells are dropped
+        ncells = query_cells[qi, None, :] + offsets[None]
+        inside = ((ncells >= 0) & (ncells < dims.view(1, 1, 3))).all(-1)
+        nkeys = key_of(ncells.clamp(min=0), query_batch[qi, None])
+        lo = torch.searchsorted(sorted_keys, nkeys)
+        hi = torch.searchsorted(sorted_keys, nkeys, right=True)
+        ncount = torch.where(inside, hi - lo, torch.zeros_like(lo)).view(-1)
+
+        # flatten the candidate ranges: (query, position in sorted order)
+        cand_query = torch.repeat_interleave(qi.repeat_interleave(27), ncount)
+        cand_start = torch.repeat_interleave(lo.view(-1) - ncount.cumsum(0) + ncount, ncount)
+        cand_pos = cand_start + torch.arange(cand_query.shape[0], device=device)
+        cand_support = order[cand_pos]
+
+        # exact test with the kernel's operation order
+        diff = flat_query[cand_query] - flat_support[cand_support]
+        d2 = diff[:, 0]**2
+        d2 += diff[:, 1]**2
+        d2 += diff[:, 2]**2
+        within = d2 < radius2
+        cand_query, cand_support = cand_query[within], cand_support[within] - query_batch[cand_query[within]] * n
+
+        # keep the first n_sample hits per query in index order
+        sort_key = cand_query * n + cand_support
+        sort_key, _ = torch.sort(sort_key)
+        cand_query, cand_support = sort_key // n, sort_key % n
+        hits = torch.bincount(cand_query - start, minlength=qi.shape[0])
+        rank = torch.arange(cand_query.shape[0], device=device) - torch.repeat_interleave(hits.cumsum(0) - hits, hits)
+        keep = rank < n_sample
+        first_idx[cand_query[keep], rank[keep]] = cand_support[keep]
+        count[qi] = hits.clamp(max=n_sample)
+
+    idx = _pad_ball_query_index(first_idx.view(b, m, n_sample), count.view(b, m))
+    return idx.contiguous()
+
+
 # [b, 3, n] x [m] -> [b, m]
-def furthest_sample_index(pc, n_sample, lazy_sample):
+def furthest_sample_index(pc, n_sample, lazy_sample, backend=None):
     if pc.shape[2] == n_sample or lazy_sample:
         nb = pc.shape[0]
         rst = torch.arange(n_sample).view(1, -1).expand(nb,-1).int().contiguous().to(pc.device)
@@ -68,18 +246,44 @@ def furthest_sample_index(pc, n_sample, lazy_sample):
 
     # TODO
     # pc = pc.permute(0,2,1).contiguous()
-    rst = cuda_nn.furthest_point_sampling(pc, n_sample)
+    with profiler.record('fps', 8 * pc.shape[0] * pc.shape[2] * n_sample) as rec:
+        rst = ops.get('furthest_point_sampling', pc.device, backend)(pc, n_sample)
+        rec.output(rst)
     return rst
 
+def furthest_point_sampling_torch(pc, n_sample):
+    '''
+    reference furthest point sampling in pytorch, matching
+    furthest_point_sampling_cuda_kernel: starts from index 0, never picks
+    points at the origin (norm**2 <= 1e-3) and breaks ties towards the lower index
+    pc: [b, 3, n]
+    return: [b, n_sample] int
+    '''
+    b, _, n = pc.shape
+    idx = torch.zeros(b, n_sample, dtype=torch.long, device=pc.device)
+    if n_sample <= 0:
+        return idx.int()
+    mag = (pc[:, 0]**2 + pc[:, 1]**2 + pc[:, 2]**2).double()
+    valid = mag > 1e-3
+    temp = torch.full((b, n), 1e10, dtype=pc.dtype, device=pc.device)
+    old = idx[:, 0]
+    for j in range(1, n_sample):
+        last = torch.gather(pc, 2, old.view(b, 1, 1).expand(-1, 3, -1))
+        d = _squared_distance(last, pc).squeeze(1)
+        temp = torch.where(valid, torch.minimum(d, temp), temp)
+        # invalid points score below every candidate, argmax returns the first max
+        old = torch.where(valid, temp, temp.new_tensor(-1.0)).argmax(1)
+        idx[:, j] = old
+    return idx.int()
+
 # [b, 3, n] x [m] -> [b, m] x [b, 3, m]
 def furthest_sample(pc, n_sample, lazy_sample=True):
     idx = furthest_sample_index(pc, n_sample, lazy_sample)
     return idx, group_nd(pc, idx)
 
 
-from sklearn.neighbors import NearestNeighbors as nnbrs
-
 def ball_search_np(pc, kpt, knn, search_radius, subsample_ratio=4):
+    from sklearn.neighbors import NearestNeighbors as nnbrs
     if subsample_ratio > 1:
         _, pc_sub = uniform_resample_np(pc, pc.shape[0]//subsample_ratio)
     else:
@@ -110,9 +314,8 @@ def ball_search_np(pc, kpt, knn, search_radius, subsample_ratio=4):
     print("inclusion ratio: ", 1 - float(maxcount)/float(len(dists)))
     return np.array(true_indices, dtype=np.int32), pc_sub
 
-from scipy.spatial import KDTree
-
 def radius_ball_search_np(pc, kpt, search_radius, maxpoints):
+    from scipy.spatial import KDTree
 
     '''
         pc: Nx3
@@ -25,7 +25,7 @@ def centralize_np(pc, batch=False):
 def normalize(pc):
     pc = centralize(pc)
     var = pc.pow(2).sum(dim=1, keepdim=True).sqrt()
-    return pc / var.max(dim=2, keepdim=True)
+    return pc / var.max(dim=2, keepdim=True)[0]
 
 def normalize_np(pc, batch=False):
     pc = centralize_np(pc, batch)
@@ -0,0 +1,213 @@
+import json
+import time
+from collections import OrderedDict
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.modules.instancenorm import _InstanceNorm
+
+'''
+Per-layer profiling of the SO(3) backbones.
+
+The point cloud and convolution operators report their stages to the active
+Profiler, if any (a no-op otherwise):
+
+    fps, ball_query      sampling / neighbor search (vgtk.pc)
+    kernel_weights       inter conv kernel weights (vgtk.so3conv)
+    gather               neighbor feature gathering + kernel contraction (vgtk.spconv)
+    intra_conv           anchor neighborhood gathering of the intra conv (vgtk.so3conv)
+    basic_conv           BasicSO3Conv matmul
+    norm                 batch / instance norms
+
+Each record holds the wall time, a rough FLOPs estimate, the output shape and
+size and, on gpu, the peak memory allocated above the memory at the start of
+the stage. Records are attributed to the inter / intra conv module they run in
+(norms to their parent module), named as in model.named_modules():
+
+    with vgtk.profiler.Profiler(model) as prof:
+        model(x)
+    print(prof.table())
+    prof.save_json('profile.json')
+'''
+
+STAGES = ['fps', 'ball_query', 'kernel_weights', 'gather', 'intra_conv', 'basic_conv', 'norm']
+
+_ACTIVE = None
+
+
+def active():
+    return _ACTIVE
+
+
+class _NullRecord():
+    def output(self, *tensors):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_RECORD = _NullRecord()
+
+
+class _Record():
+    def __init__(self, profiler, stage, flops, layer):
+        self.profiler = profiler
+        self.entry = {'layer': layer, 'stage': stage, 'flops': flops, 'shape': None, 'bytes': 0}
+
+    def output(self, *tensors):
+        tensors = [t for t in tensors if torch.is_tensor(t)]
+        self.entry['shape'] = [list(t.shape) for t in tensors]
+        self.entry['bytes'] = sum(t.numel() * t.element_size() for t in tensors)
+
+    def __enter__(self):
+        self.device = self.profiler._sync()
+        if self.device is not None:
+            self.mem_start = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._sync()
+        self.entry['time'] = time.time() - self.start
+        self.entry['peak_bytes'] = None if self.device is None else \
+            torch.cuda.max_memory_allocated(self.device) - self.mem_start
+        self.profiler.records.append(self.entry)
+        return False
+
+
+def record(stage, flops=0):
+    '''
+    context of a profiled stage, call .output(tensors) on it to log the output shapes
+    '''
+    if _ACTIVE is None:
+        return _NULL_RECORD
+    return _Record(_ACTIVE, stage, int(flops), _ACTIVE.layer())
+
+
+class Profiler():
+    '''
+    model: optional module, whose inter / intra convs name the records and
+           whose BasicSO3Conv and norm layers are timed through forward hooks
+    sync: synchronize cuda around every stage (accurate gpu timings)
+    '''
+    def __init__(self, model=None, sync=True):
+        self.model = model
+        self.sync = sync
+        self.records = []
+        self._scopes = []
+        self._hooks = []
+
+    def layer(self):
+        return self._scopes[-1] if len(self._scopes) > 0 else '-'
+
+    def _sync(self):
+        if self.sync and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+            return torch.cuda.current_device()
+        return None
+
+    def __enter__(self):
+        global _ACTIVE
+        if _ACTIVE is not None:
+            raise RuntimeError('A profiler is already active')
+        _ACTIVE = self
+        if self.model is not None:
+            self._register(self.model)
+        return self
+
+    def __exit__(self, *exc):
+        global _ACTIVE
+        _ACTIVE = None
+        for h in self._hooks:
+            h.remove()
+        self._hooks = []
+        self._scopes = []
+        return False
+
+    def _register(self, model):
+        from vgtk.so3conv import InterSO3Conv, IntraSO3Conv, BasicSO3Conv
+
+        def push(name):
+            def hook(module, inputs):
+                self._scopes.append(name)
+            return hook
+
+        def pop(module, inputs, output):
+            self._scopes.pop()
+
+        def stage_hooks(stage, name, flops_fn):
+            state = {}
+            def pre(module, inputs):
+                layer = name if stage == 'norm' else self.layer()
+                state['record'] = _Record(self, stage, flops_fn(module, inputs[0]), layer).__enter__()
+            def post(module, inputs, output):
+                rec = state.pop('record')
+                rec.output(output)
+                rec.__exit__(None, None, None)
+            return pre, post
+
+        for name, m in model.named_modules():
+            if isinstance(m, (InterSO3Conv, IntraSO3Conv)):
+                self._hooks.append(m.register_forward_pre_hook(push(name)))
+                self._hooks.append(m.register_forward_hook(pop))
+            elif isinstance(m, BasicSO3Conv):
+                pre, post = stage_hooks('basic_conv', name, basic_conv_flops)
+                self._hooks.append(m.register_forward_pre_hook(pre))
+                self._hooks.append(m.register_forward_hook(post))
+            elif isinstance(m, (_BatchNorm, _InstanceNorm)):
+                # the layer of a norm is its parent module
+                pre, post = stage_hooks('norm', name.rpartition('.')[0] or '-', norm_flops)
+                self._hooks.append(m.register_forward_pre_hook(pre))
+                self._hooks.append(m.register_forward_hook(post))
+
+    def summary(self, by_layer=True):
+        '''
+        records aggregated per (layer, stage) (per stage if not by_layer), in call order
+        '''
+        rows = OrderedDict()
+        for r in self.records:
+            key = (r['layer'], r['stage']) if by_layer else ('*', r['stage'])
+            if key not in rows:
+                rows[key] = {'layer': key[0], 'stage': key[1], 'calls': 0, 'time': 0.0, 'flops': 0,
+                             'bytes': 0, 'peak_bytes': None, 'shape': r['shape']}
+            row = rows[key]
+            row['calls'] += 1
+            row['time'] += r['time']
+            row['flops'] += r['flops']
+            row['bytes'] = max(row['bytes'], r['bytes'])
+            if r['peak_bytes'] is not None:
+                row['peak_bytes'] = max(row['peak_bytes'] or 0, r['peak_bytes'])
+        return list(rows.values())
+
+    def table(self, by_layer=True):
+        rows = self.summary(by_layer)
+        total = sum(r['time'] for r in rows)
+        lines = ['%-40s %-15s %6s %10s %7s %10s %9s %10s %10s  %s' % ('layer', 'stage', 'calls', 'time(ms)', '%',
+                 'GFLOP', 'GFLOP/s', 'out(MB)', 'peak(MB)', 'shape')]
+        for r in rows:
+            peak = '-' if r['peak_bytes'] is None else '%.1f' % (r['peak_bytes'] / 2**20)
+            shape = ' '.join('x'.join(str(d) for d in s) for s in (r['shape'] or []))
+            lines.append('%-40s %-15s %6d %10.2f %7.1f %10.3f %9.1f %10.1f %10s  %s' % (
+                r['layer'][-40:], r['stage'], r['calls'], 1e3 * r['time'], 100 * r['time'] / max(total, 1e-12),
+                r['flops'] / 1e9, r['flops'] / 1e9 / max(r['time'], 1e-12), r['bytes'] / 2**20, peak, shape))
+        lines.append('%-40s %-15s %6s %10.2f' % ('total', '', '', 1e3 * total))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {'records': self.records, 'layers': self.summary(True), 'stages': self.summary(False)}
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+# rough FLOPs estimates (multiply-adds count as 2)
+def basic_conv_flops(module, x):
+    # [b, c1, k, p, a] -> [b, c2, p, a]
+    return 2 * module.dim_out * x.numel()
+
+def norm_flops(module, x):
+    return 5 * x.numel()
@@ -1,3 +1,4 @@
 from vgtk.spconv import SphericalPointCloud
 from .functional import *
 from .modules import *
+from .cache import NeighborhoodCache
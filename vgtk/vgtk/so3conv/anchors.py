@@ -0,0 +1,101 @@
+import os
+import hashlib
+import numpy as np
+
+import vgtk
+
+'''
+Precomputed icosahedral SO(3) anchor tables.
+
+Building the 60 anchor rotations from sphere12.ply (fr.icosahedron_so3_trimesh)
+takes trimesh and several 60x12x12x3x3 contractions, so the result is shipped
+as a versioned .npz in vgtk/data/anchors and only loaded on first use. The
+table is rebuilt from the mesh (and written back if possible) when the file is
+missing, was built for another gamma size or from another mesh, or has an
+older version. To regenerate it after changing the construction, bump
+ANCHOR_TABLE_VERSION and run:
+
+python -m vgtk.data.anchors
+'''
+
+ANCHOR_TABLE_VERSION = 1
+GAMMA_SIZE = 3
+ROOT = vgtk.__path__[0]
+ANCHOR_PATH = os.path.join(ROOT, 'data', 'anchors/sphere12.ply')
+ANCHOR_TABLE_PATH = os.path.join(ROOT, 'data', 'anchors', f'so3_anchors_v{ANCHOR_TABLE_VERSION}.npz')
+
+TABLES = ['Rs', 'R_idx', 'canonical_relative']
+
+# anchor subsets used by the models with fewer anchors (see select_anchor)
+ANCHOR_SUBSETS = [1, 20, 40]
+
+_TABLE = None
+
+
+def select_anchor(anchors, k):
+    if k == 1:
+        return anchors[29][None]
+    elif k == 20:
+        return anchors[::3]
+    elif k == 40:
+        return anchors.reshape(20,3,3,3)[:,:2].reshape(-1,3,3)
+    else:
+        return anchors
+
+
+def _mesh_hash(mesh_path):
+    with open(mesh_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def build_anchor_table(mesh_path=ANCHOR_PATH, gamma_size=GAMMA_SIZE):
+    import vgtk.functional as fr
+    Rs, R_idx, canonical_relative = fr.icosahedron_so3_trimesh(mesh_path, gamma_size)
+    table = {'Rs': Rs, 'R_idx': R_idx, 'canonical_relative': canonical_relative,
+             'version': np.array(ANCHOR_TABLE_VERSION), 'gamma_size': np.array(gamma_size),
+             'mesh_hash': np.array(_mesh_hash(mesh_path))}
+    for k in ANCHOR_SUBSETS:
+        table[f'anchors_{k}'] = select_anchor(Rs, k)
+    return table
+
+
+def save_anchor_table(path=ANCHOR_TABLE_PATH, mesh_path=ANCHOR_PATH, gamma_size=GAMMA_SIZE):
+    table = build_anchor_table(mesh_path, gamma_size)
+    # written through a temporary file: concurrent workers never read a partial table
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **{k: v for k, v in table.items() if v is not None})
+    os.replace(path + '.tmp', path)
+    return table
+
+
+def _valid(table):
+    if any(table.get(k) is None for k in ['version', 'gamma_size', 'mesh_hash', 'Rs']):
+        return False
+    return int(table['version']) == ANCHOR_TABLE_VERSION and int(table['gamma_size']) == GAMMA_SIZE \
+        and str(table['mesh_hash']) == _mesh_hash(ANCHOR_PATH)
+
+
+def anchor_table():
+    '''
+    the anchor table (dict of arrays), loaded once per process
+    '''
+    global _TABLE
+    if _TABLE is None:
+        table = None
+        if os.path.exists(ANCHOR_TABLE_PATH):
+            with np.load(ANCHOR_TABLE_PATH) as f:
+                # tables that are not defined (None) are not stored
+                table = {k: f[k] if k in f.files else None for k in TABLES}
+                table.update({k: f[k] for k in f.files})
+            if not _valid(table):
+                table = None
+        if table is None:
+            print(f'[Anchors] {ANCHOR_TABLE_PATH} is missing or outdated, rebuilding it')
+            try:
+                table = save_anchor_table()
+            except OSError:
+                # read-only install: keep the table in memory only
+                table = build_anchor_table()
+        _TABLE = table
+    return _TABLE
+
@@ -0,0 +1,93 @@
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+class NeighborhoodCache():
+    '''
+    Content-addressed LRU cache of the neighborhood structure computed by
+    inter_so3conv_grouping. Entries are stored per sample, keyed by a hash of
+    the sample coordinates and the layer hyper-parameters, so a batch hits the
+    cache whenever all of its clouds have been grouped before by a layer with
+    the same settings (in any batch order).
+
+    Stored per sample: inter_idx [p2, nn], sample_idx [p2], new_xyz [3, p2]
+    and, if store_weights is set, inter_w [p2, na, ks, nn] (large: usually
+    cheaper to recompute from the cached indices).
+    '''
+    def __init__(self, max_bytes, store_weights=False):
+        self.max_bytes = int(max_bytes)
+        self.store_weights = store_weights
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.n_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+    def keys(self, xyz, layer_key):
+        '''
+        xyz: [nb, 3, p1]
+        layer_key: hashable tuple of layer hyper-parameters
+        '''
+        xyz = xyz.detach().cpu().contiguous().numpy()
+        layer_bytes = repr(layer_key).encode()
+        keys = []
+        for sample in xyz:
+            h = hashlib.blake2b(sample.tobytes(), digest_size=16)
+            h.update(str(sample.shape).encode())
+            h.update(layer_bytes)
+            keys.append(h.hexdigest())
+        return keys
+
+    def lookup(self, keys):
+        '''
+        return batched (inter_idx, sample_idx, new_xyz, inter_w) if every
+        sample is cached, None otherwise. inter_w is None when not stored.
+        '''
+        if not all(k in self.entries for k in keys):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries = []
+        for k in keys:
+            self.entries.move_to_end(k)
+            entries.append(self.entries[k])
+        fields = []
+        for i in range(4):
+            if entries[0][i] is None:
+                fields.append(None)
+            else:
+                fields.append(torch.stack([e[i] for e in entries], 0))
+        return tuple(fields)
+
+    def store(self, keys, inter_idx, sample_idx, new_xyz, inter_w=None):
+        if not self.store_weights or not torch.is_tensor(inter_w):
+            # sparse (top-k) weights are recomputed from the cached indices
+            inter_w = None
+        for bi, k in enumerate(keys):
+            if k in self.entries:
+                self.entries.move_to_end(k)
+                continue
+            entry = tuple(None if t is None else t[bi].detach().clone()
+                          for t in (inter_idx, sample_idx, new_xyz, inter_w))
+            size = sum(t.numel() * t.element_size() for t in entry if t is not None)
+            if size > self.max_bytes:
+                continue
+            self.entries[k] = entry
+            self.n_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and len(self.entries) > 0:
+            _, entry = self.entries.popitem(last=False)
+            self.n_bytes -= sum(t.numel() * t.element_size() for t in entry if t is not None)
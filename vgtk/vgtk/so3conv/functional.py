@@ -11,9 +11,8 @@ from torch.nn.modules.batchnorm import _BatchNorm
 # from utils_cuda import _neighbor_query, _spherical_conv
 import vgtk
 import vgtk.pc as pctk
-import vgtk.cuda.zpconv as cuda_zpconv
-import vgtk.cuda.gathering as gather
-import vgtk.cuda.grouping as cuda_nn
+import vgtk.ops as ops
+import vgtk.profiler as profiler
 
 import vgtk.spconv as zpconv
 
@@ -102,13 +101,15 @@ def get_sphereical_kernel_points_from_ply(radius, kernel_size):
 #     at::Tensor kernel_points, // [ks, na, 3]
 #     const float radius, const float sigma)
 def initial_anchor_query(frag, centers, kernels, r, sigma):
-    return cuda_nn.initial_anchor_query(centers, frag, kernels, r, sigma)
+    return ops.get('initial_anchor_query', frag.device)(centers, frag, kernels, r, sigma)
 
 
 def inter_so3conv_blurring(xyz, feats, n_neighbor, radius, stride,
-                           inter_idx=None, lazy_sample=True, radius_expansion=1.0):
+                           inter_idx=None, lazy_sample=True, radius_expansion=1.0,
+                           neighbor_search='brute'):
     if inter_idx is None:
-        _, inter_idx, sample_idx, sample_xyz = zpconv.inter_zpconv_grouping_ball(xyz, stride, radius * radius_expansion, n_neighbor, lazy_sample)
+        _, inter_idx, sample_idx, sample_xyz = zpconv.inter_zpconv_grouping_ball(xyz, stride, radius * radius_expansion,
+                                                                                 n_neighbor, lazy_sample, neighbor_search)
 
     if stride == 1:
         return zpconv.inter_blurring_naive(inter_idx, feats), xyz
@@ -118,7 +119,8 @@ def inter_so3conv_blurring(xyz, feats, n_neighbor, radius, stride,
 def inter_so3conv_grouping(xyz, feats, stride, n_neighbor,
                           anchors, kernels, radius, sigma,
                           inter_idx=None, inter_w=None, lazy_sample=True,
-                          radius_expansion=1.0, pooling=None):
+                          radius_expansion=1.0, pooling=None, neighbor_search='brute',
+                          cache=None, cache_key=None, sample_idx=None, kernel_topk=0):
     '''
         xyz: [nb, 3, p1] coordinates
         feats: [nb, c_in, p1, na] features
@@ -128,6 +130,12 @@ def inter_so3conv_grouping(xyz, feats, stride, n_neighbor,
         inter_w: [nb, p2, na, ks, nn] kernel weights:
                     Influences of each neighbor points on each kernel points
                     under the respective SO3 rotations
+        neighbor_search: 'brute' | 'grid' ball query mode
+        cache: optional NeighborhoodCache, looked up with cache_key (a tuple of
+               the layer hyper-parameters) when the neighborhood is not given
+        sample_idx: [nb, p2] sampled centers of a given inter_idx (None if p2 = p1)
+        kernel_topk: if > 0, keep only the kernel_topk most influential neighbors of
+                     each kernel point (inter_w is then a zpconv.SparseKernelWeight)
     '''
 
     if pooling is not None and stride > 1 and feats.shape[1] > 1:
@@ -144,13 +152,48 @@ def inter_so3conv_grouping(xyz, feats, stride, n_neighbor,
         else:
             raise NotImplementedError(f"Pooling mode {pooling} is not implemented!")
 
-        feats, xyz = inter_so3conv_blurring(xyz, feats, stride_nn, radius, pool_stride, inter_idx, lazy_sample)
+        feats, xyz = inter_so3conv_blurring(xyz, feats, stride_nn, radius, pool_stride, inter_idx, lazy_sample,
+                                            neighbor_search=neighbor_search)
         inter_idx = None
 
-    if inter_idx is None:
+    inter_idx, inter_w, new_xyz, sample_idx = \
+        inter_so3conv_neighborhood(xyz, stride, n_neighbor, anchors, kernels, radius, sigma,
+                                   inter_idx, inter_w, lazy_sample, radius_expansion, neighbor_search,
+                                   cache, cache_key, sample_idx, kernel_topk)
+
+    feats = zpconv.add_shadow_feature(feats)
+
+    new_feats = inter_so3conv_feat_grouping(inter_idx, inter_w, feats) # [nb, c_in, ks, np, na]
+
+    return inter_idx, inter_w, new_xyz, new_feats, sample_idx
+
+def inter_so3conv_neighborhood(xyz, stride, n_neighbor, anchors, kernels, radius, sigma,
+                               inter_idx=None, inter_w=None, lazy_sample=True,
+                               radius_expansion=1.0, neighbor_search='brute',
+                               cache=None, cache_key=None, sample_idx=None, kernel_topk=0):
+    '''
+        neighborhood and kernel weights of inter_so3conv_grouping (see its arguments),
+        without the feature grouping
+        return: inter_idx [nb, p2, nn], inter_w, new_xyz [nb, 3, p2], sample_idx [nb, p2]
+    '''
+    cached = None
+    if inter_idx is None and cache is not None:
+        cache_keys = cache.keys(xyz, (cache_key, stride, radius * radius_expansion, n_neighbor,
+                                      lazy_sample, neighbor_search))
+        cached = cache.lookup(cache_keys)
+
+    if cached is not None:
+        inter_idx, sample_idx, new_xyz, inter_w = cached
+        if inter_w is None:
+            grouped_xyz = inter_so3conv_grouped_xyz(xyz, inter_idx, new_xyz)
+            inter_w = inter_so3conv_kernel_weights(grouped_xyz, inter_idx, anchors, kernels, sigma, kernel_topk)
+    elif inter_idx is None:
         grouped_xyz, inter_idx, sample_idx, new_xyz = zpconv.inter_zpconv_grouping_ball(xyz, stride,
-                                                                         radius * radius_expansion, n_neighbor, lazy_sample)
-        inter_w = inter_so3conv_grouping_anchor(grouped_xyz, anchors, kernels, sigma)
+                                                                         radius * radius_expansion, n_neighbor, lazy_sample,
+                                                                         neighbor_search)
+        inter_w = inter_so3conv_kernel_weights(grouped_xyz, inter_idx, anchors, kernels, sigma, kernel_topk)
+        if cache is not None:
+            cache.store(cache_keys, inter_idx, sample_idx, new_xyz, inter_w)
 
 
         #####################DEBUGDEBUGDEBUGDEBUG####################################
@@ -168,14 +211,75 @@ def inter_so3conv_grouping(xyz, feats, stride, n_neighbor,
         # # import ipdb; ipdb.set_trace()
         #############################################################################
     else:
-        sample_idx = None
-        new_xyz = xyz
+        # given neighborhood: reused from the previous layer or precomputed
+        new_xyz = xyz if sample_idx is None else pctk.group_nd(xyz, sample_idx)
+        if inter_w is None:
+            grouped_xyz = inter_so3conv_grouped_xyz(xyz, inter_idx, new_xyz)
+            inter_w = inter_so3conv_kernel_weights(grouped_xyz, inter_idx, anchors, kernels, sigma, kernel_topk)
+
+    return inter_idx, inter_w, new_xyz, sample_idx
 
+def inter_so3conv_grouping_chunks(xyz, feats, inter_idx, new_xyz, anchors, kernels, sigma,
+                                  chunk_size, kernel_topk=0):
+    '''
+        inter_so3conv_grouping of a given neighborhood over blocks of chunk_size centers:
+        the kernel weights and grouped features of a block are only alive while it is
+        consumed, bounding the peak memory of large clouds
+        xyz: [nb, 3, p1], feats: [nb, c_in, p1, na]
+        inter_idx: [nb, p2, nn], new_xyz: [nb, 3, p2]
+        yield: [nb, c_in, ks, chunk_size, na] grouped features of consecutive blocks
+    '''
     feats = zpconv.add_shadow_feature(feats)
+    for start in range(0, inter_idx.shape[1], chunk_size):
+        chunk_idx = inter_idx[:, start:start+chunk_size].contiguous()
+        grouped_xyz = inter_so3conv_grouped_xyz(xyz, chunk_idx, new_xyz[:, :, start:start+chunk_size])
+        chunk_w = inter_so3conv_kernel_weights(grouped_xyz, chunk_idx, anchors, kernels, sigma, kernel_topk)
+        yield inter_so3conv_feat_grouping(chunk_idx, chunk_w, feats)
+
+# neighbor offsets from precomputed neighborhoods, as returned by inter_zpconv_grouping_ball
+# [b, 3, p1] x [b, p2, nn] x [b, 3, p2] -> [b, 3, p2, nn]
+def inter_so3conv_grouped_xyz(xyz, inter_idx, new_xyz):
+    grouped_xyz = pctk.group_nd(zpconv.add_shadow_point(xyz), inter_idx)
+    return grouped_xyz - new_xyz.unsqueeze(3)
+
+# kernel weights of a neighborhood, dense or top-k sparse
+def inter_so3conv_kernel_weights(grouped_xyz, inter_idx, anchors, kernels, sigma, kernel_topk=0):
+    b, _, p2, nn = grouped_xyz.shape
+    with profiler.record('kernel_weights', 10 * b * p2 * nn * anchors.shape[0] * kernels.shape[0]) as rec:
+        if kernel_topk > 0:
+            inter_w = inter_so3conv_grouping_anchor_sparse(grouped_xyz, inter_idx, anchors, kernels, sigma, kernel_topk)
+            rec.output(inter_w.idx, inter_w.w)
+        else:
+            inter_w = inter_so3conv_grouping_anchor(grouped_xyz, anchors, kernels, sigma)
+            rec.output(inter_w)
+    return inter_w
 
-    new_feats = inter_so3conv_feat_grouping(inter_idx, inter_w, feats) # [nb, c_in, ks, np, na]
+# max number of dense weights materialized at once by the sparse weight computation
+SPARSE_WEIGHT_BUFFER = 2**22
 
-    return inter_idx, inter_w, new_xyz, new_feats, sample_idx
+def inter_so3conv_grouping_anchor_sparse(grouped_xyz, inter_idx, anchors, kernels, sigma, k, chunk_size=None):
+    '''
+        top-k sparse inter_so3conv_grouping_anchor, computed over chunks of centers
+        so that the dense [b, p2, na, ks, nn] weights are never materialized. Exact
+        whenever no kernel point has more than k neighbors in its support.
+        grouped_xyz: [b, 3, p2, nn]
+        inter_idx: [b, p2, nn]
+        return: SparseKernelWeight, idx and w [b, p2, na, ks, k]
+    '''
+    b, _, p2, nn = grouped_xyz.shape
+    na, ks = anchors.shape[0], kernels.shape[0]
+    k = min(k, nn)
+    if chunk_size is None:
+        chunk_size = max(1, SPARSE_WEIGHT_BUFFER // (b * na * ks * nn))
+
+    idx, w = [], []
+    for start in range(0, p2, chunk_size):
+        chunk_w = inter_so3conv_grouping_anchor(grouped_xyz[:, :, start:start+chunk_size], anchors, kernels, sigma)
+        chunk_w, pos = chunk_w.topk(k, dim=4, sorted=False)
+        chunk_idx = inter_idx[:, start:start+chunk_size, None, None].expand(-1, -1, na, ks, -1)
+        idx.append(torch.gather(chunk_idx, 4, pos.to(chunk_idx.device)))
+        w.append(chunk_w)
+    return zpconv.SparseKernelWeight(torch.cat(idx, 1).int().contiguous(), torch.cat(w, 1).contiguous())
 
 def inter_so3conv_grouping_anchor(grouped_xyz, anchors,
                                   kernels, sigma, interpolate='linear'):
@@ -229,8 +333,10 @@ def intra_so3conv_grouping(intra_idx, feature):
     nb, c_in, nq, na = feature.shape
     _, pnn = intra_idx.shape
 
-    feature1 = feature.index_select(3, intra_idx.view(-1)).view(nb, c_in, nq, na, pnn)
-    grouped_feat =  feature1.permute([0,1,4,2,3]).contiguous()
+    with profiler.record('intra_conv') as rec:
+        feature1 = feature.index_select(3, intra_idx.view(-1)).view(nb, c_in, nq, na, pnn)
+        grouped_feat =  feature1.permute([0,1,4,2,3]).contiguous()
+        rec.output(grouped_feat)
 
     # print(torch.sort(grouped_feat[0,0].mean(0)))
     # print(torch.sort(grouped_feat[1,0].mean(0)))
@@ -267,33 +373,23 @@ def intra_so3conv_grouping(intra_idx, feature):
 
     return grouped_feat
 
-# initialize so3 sampling
-import vgtk.functional as fr
-import os
-
-GAMMA_SIZE = 3
-ROOT = vgtk.__path__[0]
-ANCHOR_PATH = os.path.join(ROOT, 'data', 'anchors/sphere12.ply')
-
-Rs, R_idx, canonical_relative = fr.icosahedron_so3_trimesh(ANCHOR_PATH, GAMMA_SIZE)
-
-
-def select_anchor(anchors, k):
-    if k == 1:
-        return anchors[29][None]
-    elif k == 20:
-        return anchors[::3]
-    elif k == 40:
-        return anchors.reshape(20,3,3,3)[:,:2].reshape(-1,3,3)
-    else:
-        return anchors
+# so3 sampling: precomputed anchor tables, loaded on first use (see anchors.py)
+from .anchors import GAMMA_SIZE, ROOT, ANCHOR_PATH, ANCHOR_SUBSETS, TABLES, select_anchor, anchor_table
 
 
 def get_anchors(k=60):
-    return select_anchor(Rs,k)
+    if k in ANCHOR_SUBSETS:
+        return anchor_table()[f'anchors_{k}']
+    return anchor_table()['Rs']
 
 def get_intra_idx():
-    return R_idx
+    return anchor_table()['R_idx']
 
 def get_canonical_relative():
-    return canonical_relative
+    return anchor_table()['canonical_relative']
+
+# lazy module attributes for the tables formerly built at import
+def __getattr__(name):
+    if name in TABLES:
+        return anchor_table()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,6 +6,7 @@ from collections import namedtuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from vgtk.spconv import SphericalPointCloud
 import vgtk.pc as pctk
@@ -125,7 +126,7 @@ class KernelPropagation(nn.Module):
 class InterSO3Conv(nn.Module):
     def __init__(self, dim_in, dim_out, kernel_size, stride,
                  radius, sigma, n_neighbor,
-                 lazy_sample=True, pooling=None, kanchor=60):
+                 lazy_sample=True, pooling=None, kanchor=60, neighbor_search='brute', kernel_topk=0):
         super(InterSO3Conv, self).__init__()
 
         # get kernel points
@@ -148,18 +149,38 @@ class InterSO3Conv(nn.Module):
         self.n_neighbor = n_neighbor
         self.lazy_sample = lazy_sample
         self.pooling = pooling
+        self.neighbor_search = neighbor_search
+        self.kernel_topk = kernel_topk
+        # if set, the conv is evaluated over blocks of chunk_size centers (see set_chunk_size)
+        self.chunk_size = None
+        # if set, the feature grouping and basic conv are recomputed in the backward pass (see set_checkpoint)
+        self.checkpoint = False
 
         self.basic_conv = BasicSO3Conv(dim_in, dim_out, self.kernel_size)
 
         self.register_buffer('anchors', torch.from_numpy(anchors))
         self.register_buffer('kernels', torch.from_numpy(kernels))
 
-    def forward(self, x, inter_idx=None, inter_w=None):
+    def forward(self, x, inter_idx=None, inter_w=None, cache=None, sample_idx=None):
+        if self.chunk_size and inter_w is None and self.pooling is None:
+            return self.forward_chunked(x, inter_idx, sample_idx)
+
+        if self.checkpoint and self.pooling is None and torch.is_grad_enabled():
+            # the neighborhood is computed once, outside of the recomputed region
+            inter_idx, inter_w, sample_idx, xyz = self.neighborhood(x.xyz, inter_idx, inter_w, cache, sample_idx)
+            feats = checkpoint(self.conv_features, x.feats, inter_idx, inter_w, use_reentrant=False)
+            return inter_idx, inter_w, sample_idx, SphericalPointCloud(xyz, feats, self.anchors)
+
         inter_idx, inter_w, xyz, feats, sample_idx = \
             L.inter_so3conv_grouping(x.xyz, x.feats, self.stride, self.n_neighbor,
                                   self.anchors, self.kernels,
                                   self.radius, self.sigma,
-                                  inter_idx, inter_w, self.lazy_sample, pooling=self.pooling)
+                                  inter_idx, inter_w, self.lazy_sample, pooling=self.pooling,
+                                  neighbor_search=self.neighbor_search,
+                                  cache=cache,
+                                  cache_key=self.cache_key(),
+                                  sample_idx=sample_idx,
+                                  kernel_topk=self.kernel_topk)
 
 
         # torch.set_printoptions(sci_mode=False)
@@ -173,6 +194,70 @@ class InterSO3Conv(nn.Module):
 
         return inter_idx, inter_w, sample_idx, SphericalPointCloud(xyz, feats, self.anchors)
 
+    def neighborhood(self, xyz, inter_idx=None, inter_w=None, cache=None, sample_idx=None):
+        '''
+        neighborhood and kernel weights of forward, for a layer without xyz pooling
+            -> inter_idx, inter_w, sample_idx, new_xyz
+        '''
+        inter_idx, inter_w, new_xyz, sample_idx = \
+            L.inter_so3conv_neighborhood(xyz, self.stride, self.n_neighbor, self.anchors, self.kernels,
+                                         self.radius, self.sigma, inter_idx, inter_w, self.lazy_sample,
+                                         neighbor_search=self.neighbor_search, cache=cache,
+                                         cache_key=self.cache_key(), sample_idx=sample_idx,
+                                         kernel_topk=self.kernel_topk)
+        return inter_idx, inter_w, sample_idx, new_xyz
+
+    def conv_features(self, feats, inter_idx, inter_w):
+        '''
+        [b, c1, p1, a] -> [b, c2, p2, a] over a given neighborhood
+        '''
+        feats = L.inter_so3conv_feat_grouping(inter_idx, inter_w, L.zpconv.add_shadow_feature(feats))
+        return self.basic_conv(feats)
+
+    def forward_chunked(self, x, inter_idx=None, sample_idx=None):
+        '''
+        same output as forward, with the kernel weights, grouping and basic conv
+        evaluated over blocks of self.chunk_size centers. The kernel weights are
+        not returned (inter_w is None): a following layer sharing the neighborhood
+        recomputes them per block as well. The neighborhood cache is not used.
+        '''
+        if inter_idx is None:
+            inter_idx, sample_idx, new_xyz = self.compute_neighbors(x.xyz)
+        else:
+            new_xyz = x.xyz if sample_idx is None else pctk.group_nd(x.xyz, sample_idx)
+
+        feats = [self.basic_conv(chunk) for chunk in
+                 L.inter_so3conv_grouping_chunks(x.xyz, x.feats, inter_idx, new_xyz, self.anchors, self.kernels,
+                                                 self.sigma, self.chunk_size, self.kernel_topk)]
+        return inter_idx, None, sample_idx, SphericalPointCloud(new_xyz, torch.cat(feats, 2), self.anchors)
+
+    def compute_neighbors(self, xyz):
+        '''
+        neighborhood of this layer without the feature computation
+            xyz: [nb, 3, p1] -> inter_idx [nb, p2, nn], sample_idx [nb, p2], new_xyz [nb, 3, p2]
+        '''
+        if self.pooling is not None:
+            raise NotImplementedError('Precomputed neighborhoods are not supported with xyz pooling')
+        _, inter_idx, sample_idx, new_xyz = L.zpconv.inter_zpconv_grouping_ball(xyz, self.stride, self.radius,
+                                                                              self.n_neighbor, self.lazy_sample,
+                                                                              self.neighbor_search)
+        return inter_idx, sample_idx, new_xyz
+
+    def cache_key(self):
+        # hyper-parameters that determine inter_w besides the neighborhood
+        return ('inter', self.sigma, self.kernel_size, self.anchors.shape[0], self.radius)
+
+
+def set_chunk_size(module, chunk_size):
+    '''
+    evaluate every InterSO3Conv of module over blocks of chunk_size centers
+    (None or 0 to disable). Outputs are unchanged, as the norms that follow the
+    convolutions still see the whole cloud; meant for inference on large clouds.
+    '''
+    for m in module.modules():
+        if isinstance(m, InterSO3Conv):
+            m.chunk_size = chunk_size if chunk_size else None
+
 
 class IntraSO3Conv(nn.Module):
     '''
@@ -5,15 +5,14 @@ import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from torch.nn.modules.batchnorm import _BatchNorm
 
 # from utils_cuda import _neighbor_query, _spherical_conv
 import vgtk
 import vgtk.pc as pctk
-import vgtk.cuda.zpconv as cuda_zpconv
-import vgtk.cuda.gathering as gather
-import vgtk.cuda.grouping as cuda_nn
+import vgtk.ops as ops
+import vgtk.profiler as profiler
 
 
 # load anchors -> [na, 3]
@@ -109,7 +108,7 @@ class Gathering(torch.autograd.Function):
         Returns:
             gathered_points: [nb, c_in, m]
         '''
-        gathered_points = gather.gather_points_forward(points, idx)
+        gathered_points = ops.get('gather_points_forward', points.device)(points, idx)
         ctx.save_for_backward(idx, points)
         return gathered_points
 
@@ -124,7 +123,7 @@ class Gathering(torch.autograd.Function):
         '''
         idx, points = ctx.saved_tensors
         np = points.size(2)
-        grad_points = gather.gather_points_backward(grad_gathered_points.contiguous(), idx, np)
+        grad_points = ops.get('gather_points_backward', points.device)(grad_gathered_points.contiguous(), idx, np)
         return grad_points, None
 
 
@@ -219,7 +218,7 @@ class IntraZPConvGrouping(torch.autograd.Function):
         Returns:
             grouped_feats:  [nb, c_in, ks, np, na_out]
         '''
-        grouped_feats = cuda_zpconv.intra_zpconv_forward(intra_idx,
+        grouped_feats = ops.get('intra_zpconv_forward', feats.device)(intra_idx,
                                                          intra_w,
                                                          feats)
         ctx.save_for_backward(intra_idx, intra_w, feats)
@@ -230,43 +229,27 @@ class IntraZPConvGrouping(torch.autograd.Function):
 
         intra_idx, intra_w, feats = ctx.saved_tensors
         anchor_in = feats.shape[3]
-        grad_feats = cuda_zpconv.intra_zpconv_backward(intra_idx,
-                                                       intra_w,
-                                                       grad_grouped_feats.contiguous(),
-                                                       anchor_in)
+        grad_feats = ops.get('intra_zpconv_backward', feats.device)(intra_idx,
+                                                                  intra_w,
+                                                                  grad_grouped_feats.contiguous(),
+                                                                  anchor_in)
         return None, None, grad_feats
 
 def intra_zpconv_grouping(intra_idx, intra_w, feats):
-    torch.cuda.synchronize()
-    end = time.time()
-
-    new_feats = IntraZPConvGrouping.apply(intra_idx, intra_w, feats)
-
-    # torch.cuda.synchronize()
-    # print('timer5:', time.time()-end, new_feats.shape)
-    # end = time.time()
-
+    with profiler.record('intra_conv', 2 * feats.numel() * intra_w.shape[1] * intra_w.shape[2]) as rec:
+        new_feats = IntraZPConvGrouping.apply(intra_idx, intra_w, feats)
+        rec.output(new_feats)
     return new_feats
 
 def intra_zpconv_grouping_naive(intra_idx, intra_w, feats):
     a, k, nn = intra_w.shape
     b, c, p, _ = feats.shape
 
-    torch.cuda.synchronize()
-    end = time.time()
-
-    # new_feats = feats[..., intra_idx.long()]
-    new_feats = torch.index_select(feats, 3, intra_idx.long().view(-1)).view(b, c, p, a, nn)
-
-    # torch.cuda.synchronize()
-    # print('timer1:', time.time()-end, new_feats.shape)
-    # end = time.time()
-
-    new_feats = torch.einsum('bcpan,akn->bckpa',new_feats, intra_w).contiguous()
-
-    # torch.cuda.synchronize()
-    # print('timer2:', time.time()-end, new_feats.shape, intra_w.shape)
-    # end = time.time()
+    with profiler.record('intra_conv', 2 * b * c * p * a * k * nn) as rec:
+        # new_feats = feats[..., intra_idx.long()]
+        new_feats = torch.index_select(feats, 3, intra_idx.long().view(-1)).view(b, c, p, a, nn)
+        new_feats = torch.einsum('bcpan,akn->bckpa',new_feats, intra_w).contiguous()
+        rec.output(new_feats)
 
     return new_feats
 
@@ -322,24 +305,48 @@ class InterZPConvGrouping(torch.autograd.Function):
         Returns:
             grouped_feats:  [nb, c_in, ks, np, na]
         '''
-        grouped_feats = cuda_zpconv.inter_zpconv_forward(inter_idx, inter_w, feats)
+        grouped_feats = ops.get('inter_zpconv_forward', feats.device)(inter_idx, inter_w, feats)
         ctx.save_for_backward(inter_idx, inter_w, feats)
         return grouped_feats
 
     @staticmethod
     def backward(ctx, grad_grouped_feats):
         inter_idx, inter_w, feats = ctx.saved_tensors
-        grad_feats = cuda_zpconv.inter_zpconv_backward(inter_idx, inter_w,
-                                                       grad_grouped_feats.contiguous(), feats.size(2))
+        grad_feats = ops.get('inter_zpconv_backward', feats.device)(inter_idx, inter_w,
+                                                                  grad_grouped_feats.contiguous(), feats.size(2))
         return None, None, grad_feats
 
 
+class InterZPConvFusedGrouping(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, inter_idx, inter_w, feats):
+        '''
+        Params:
+            inter_idx:  [nb, np, ann]
+            inter_w:    [nb, np, na, ks, ann]
+            feats:      [nb, c_in, nq+1, na]
+        Returns:
+            grouped_feats:  [nb, c_in, ks, np, na]
+        '''
+        grouped_feats = ops.get('inter_zpconv_fused_forward', feats.device)(inter_idx, inter_w, feats)
+        ctx.save_for_backward(inter_idx, inter_w)
+        ctx.npoint = feats.size(2)
+        return grouped_feats
+
+    @staticmethod
+    def backward(ctx, grad_grouped_feats):
+        inter_idx, inter_w = ctx.saved_tensors
+        grad_feats = ops.get('inter_zpconv_fused_backward', grad_grouped_feats.device)(inter_idx, inter_w,
+                                                                    grad_grouped_feats.contiguous(), ctx.npoint)
+        return None, None, grad_feats
+
 
 # [b, 3, n] x [b, 3, m] x r x k x [b, c, m] ->
 # [b, n, k] x [b, 3, n, k] x [b, c, n, k]
-def ball_query(query_points, support_points, radius, n_sample, support_feats=None):
+def ball_query(query_points, support_points, radius, n_sample, support_feats=None, search='brute'):
     # TODO remove add_shadow_point here
-    idx = pctk.ball_query_index(query_points, support_points, radius, n_sample)
+    idx = pctk.ball_query_index(query_points, support_points, radius, n_sample, search=search)
     support_points = add_shadow_point(support_points)
     # import ipdb; ipdb.set_trace()
 
@@ -369,24 +376,40 @@ def batched_index_select(input, dim, index):
     return torch.gather(input, dim, index)
 
 
+# top-k sparse kernel weights: for every center, anchor and kernel point, the k most
+# influential neighbors (idx: indices into the support features, w: their weights),
+# both [b, p, na, ks, k]
+SparseKernelWeight = namedtuple('SparseKernelWeight', ['idx', 'w'])
+
+
 def inter_zpconv_grouping_naive(inter_idx, inter_w, feats):
+    '''
+        inter_idx: [b, p, nn], feats: [b, c, q+1, a]
+        inter_w: [b, p, a, ks, nn] dense weights or SparseKernelWeight
+        return: [b, c, ks, p, a]
+    '''
+    w = inter_w.w if isinstance(inter_w, SparseKernelWeight) else inter_w
+    # [b, p, a, ks, nn] weights, each applied to c features
+    with profiler.record('gather', 2 * w.numel() * feats.shape[1]) as rec:
+        new_feats = _inter_zpconv_grouping_naive(inter_idx, inter_w, feats)
+        rec.output(new_feats)
+    return new_feats
+
+
+def _inter_zpconv_grouping_naive(inter_idx, inter_w, feats):
+    if isinstance(inter_w, SparseKernelWeight):
+        return InterZPConvGrouping.apply(inter_w.idx, inter_w.w, feats.contiguous())
+
+    # fused gather-contract op, where available (no gradient w.r.t. the weights)
+    if not inter_w.requires_grad and ops.is_native('inter_zpconv_fused_forward', feats.device):
+        return InterZPConvFusedGrouping.apply(inter_idx.int().contiguous(), inter_w.contiguous(), feats.contiguous())
+
     b, p, pnn = inter_idx.shape
     _, c, q, a = feats.shape
-    device = inter_idx.device
 
-    # torch.cuda.synchronize()
-    # end = time.time()
     new_feats = batched_index_select(feats, 2, inter_idx.long().view(b, -1)).view(b, -1, p, pnn, a)
-
-    # torch.cuda.synchronize()
-    # print('timer3:', time.time()-end, new_feats.shape)
-    # end = time.time()
     new_feats = torch.einsum('bcpna,bpakn->bckpa', new_feats, inter_w).contiguous()
 
-    # torch.cuda.synchronize()
-    # print('timer4:', time.time()-end, new_feats.shape, inter_w.shape)
-    # end = time.time()
-
     return new_feats
 
 
@@ -409,13 +432,14 @@ def inter_blurring_naive(inter_idx, feats, alpha=0.5):
 
 # inter zpconv grouping
 # [b, 3, p1] x [b, 3, p2, a] -> [b, 3, p2, nn+1]
-def inter_zpconv_grouping_ball(xyz, stride, radius, n_neighbor, lazy_sample=True):
+# neighbor_search: 'brute' | 'grid' (uniform grid index, for large clouds)
+def inter_zpconv_grouping_ball(xyz, stride, radius, n_neighbor, lazy_sample=True, neighbor_search='brute'):
 
     n_sample = math.ceil(xyz.shape[2] / stride)
     # [b, 3, p1] x [p2] -> [b,p2] x [b, 3, p2]
     idx, sample_xyz = pctk.furthest_sample(xyz, n_sample, lazy_sample)
     # [b, p2, nn]
-    ball_idx, grouped_xyz = ball_query(sample_xyz, xyz, radius, n_neighbor)
+    ball_idx, grouped_xyz = ball_query(sample_xyz, xyz, radius, n_neighbor, search=neighbor_search)
     # [b, 3, p1+1] x [b, p2, nn] -> [b, 3, p2, nn]
     grouped_xyz = grouped_xyz - sample_xyz.unsqueeze(3)
     return grouped_xyz, ball_idx, idx, sample_xyz
@@ -1,8 +1,9 @@
 
 import numpy as np
+from multiprocessing import shared_memory
 import torch
 
-import vgtk.cuda.gathering as cuda_gather
+import vgtk.ops as ops
 
 
 # promote input in batch
@@ -23,7 +24,7 @@ def promote_input_np(x, n_dim):
 
 # gather operators with batch
 def batch_gather(x, idx, dim=1):
-    x = cuda_gather.gather_points_forward(x, idx.int())
+    x = ops.get('gather_points_forward', x.device)(x, idx.int())
     return x
 
 def batch_zip(x, y, idx):
@@ -110,3 +111,27 @@ def np_expands(tensor, axis, tiles=None):
         return tensor
 
 
+def pack_shared(arrays):
+    '''
+    copy a dict of arrays into one shared memory block
+    return: the SharedMemory (to close / unlink) and its layout, from which
+            attach_shared maps the arrays in other processes
+    '''
+    offsets, size = {}, 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        size = (size + 63) // 64 * 64
+        offsets[key] = (size, array.shape, array.dtype.str)
+        size += array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, array in arrays.items():
+        offset, shape, dtype = offsets[key]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+    return shm, {'name': shm.name, 'offsets': offsets}
+
+
+def attach_shared(layout):
+    shm = shared_memory.SharedMemory(name=layout['name'])
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+              for key, (offset, shape, dtype) in layout['offsets'].items()}
+    return shm, arrays